@@ -6,12 +6,25 @@ import sys
 import datetime
 import bz2
 import gzip
+import math
+import heapq
+import multiprocessing
 import colibricore
 import argparse
 import pickle
 import os
+import zlib
+import numpy
 from collections import defaultdict
 from urllib.parse import quote_plus
+from colibrimt.instrumentation import metrics, addmetricsarguments, setupmetrics
+from colibrimt.logger import log, debugging, Progress, addloggingarguments, setuplogging
+import colibrimt.native
+from colibrimt.bloomfilter import BloomFilter, rejectline
+from colibrimt.scorestore import ScoreStore
+from colibrimt.checkpoint import Checkpoint, INTERVAL, filekey, syncedsize, truncate
+from colibrimt.spill import SpillBuffer
+from colibrimt.keywordstore import KeywordStore, FILENAME as KEYWORDSTORE, BITSETPREFIX
 
 MAXKEYWORDS = 25
 
@@ -29,7 +42,99 @@ class Configuration:
         self.keywordmodel = None
         self.kw_absolute_threshold = 0
         self.kw_prob_threshold = 0
+        self.maxkeywords = MAXKEYWORDS
+
+
+class FeatureRows:
+    """Buffer of integer-coded context feature vectors for one source/target pair. Context unigrams are coded per configuration
+    (factor), the focus is left out (it is the source pattern itself) and the keyword features of a configuration are packed as a
+    bitmask in 63-bit words, so every feature vector is a fixed-width int64 row. Duplicates are counted with a vectorised unique
+    over the rows, and only the distinct rows are decoded back to patterns. With maxmemory (bytes), the buffer is compacted to
+    its distinct rows (with counts) whenever it is full rather than grown beyond the cap. With sparsekeywords, the keyword
+    features of a configuration are decoded as a single bitset (int) rather than as one (keyword, bool) tuple per keyword"""
+
+    def __init__(self, configurations, codes, keywords, capacity=1024, maxmemory=0, sparsekeywords=False):
+        self.configurations = configurations
+        self.codes = codes #per configuration: [pattern => code, code => pattern], shared between pairs
+        self.keywords = keywords #configuration index => keywords of the current source pattern
+        self.sparsekeywords = sparsekeywords
+        self.width = 0
+        for k, conf in enumerate(configurations):
+            self.width += conf.leftcontext + conf.rightcontext
+            if k in keywords:
+                self.width += (len(keywords[k]) + 62) // 63
+        self.rows = 0
+        self.data = numpy.zeros((capacity, max(1,self.width)), dtype=numpy.int64)
+        self.weights = numpy.zeros(capacity, dtype=numpy.int64) #occurrence count of every row, 1 until compacted
+        self.maxrows = maxmemory // (8 * (max(1,self.width) + 1)) if maxmemory else 0
+
+    def code(self, k, unigram):
+        patterncodes, codepatterns = self.codes[k]
+        c = patterncodes.get(unigram)
+        if c is None:
+            c = patterncodes[unigram] = len(codepatterns)
+            codepatterns.append(unigram)
+        return c
+
+    def append(self, row):
+        if self.rows == len(self.data) and self.maxrows and self.rows * 2 > self.maxrows:
+            self.compact()
+        if self.rows == len(self.data):
+            data = numpy.zeros((len(self.data) * 2, self.data.shape[1]), dtype=numpy.int64)
+            data[:self.rows] = self.data[:self.rows]
+            self.data = data
+            weights = numpy.zeros(len(self.data), dtype=numpy.int64)
+            weights[:self.rows] = self.weights[:self.rows]
+            self.weights = weights
+        self.data[self.rows,:len(row)] = row
+        self.weights[self.rows] = 1
+        self.rows += 1
+
+    def _distinct(self):
+        """Returns (distinct rows, summed weights), in order of first occurrence"""
+        rows, first, inverse = numpy.unique(self.data[:self.rows], axis=0, return_index=True, return_inverse=True)
+        weights = numpy.bincount(inverse.reshape(-1), weights=self.weights[:self.rows], minlength=len(rows)).astype(numpy.int64)
+        order = numpy.argsort(first, kind='stable')
+        return rows[order], weights[order]
+
+    def compact(self):
+        """Replace the rows by the distinct rows and their counts, keeps the buffer within its memory cap as long as the distinct rows fit"""
+        rows, weights = self._distinct()
+        self.data[:len(rows)] = rows
+        self.weights[:len(rows)] = weights
+        self.rows = len(rows)
+        metrics.count('featurerows_compacted')
+
+    def decode(self, row, sourcepattern):
+        """Turn a row back into a feature vector (list of patterns and (keyword, bool) tuples or keyword bitsets), as produced by extractcontextfeatures before"""
+        featurevector = []
+        i = 0
+        for k, conf in enumerate(self.configurations):
+            codepatterns = self.codes[k][1]
+            for j in range(conf.leftcontext):
+                featurevector.append(codepatterns[row[i+j]])
+            i += conf.leftcontext
+            if conf.focus:
+                featurevector.append(sourcepattern)
+            for j in range(conf.rightcontext):
+                featurevector.append(codepatterns[row[i+j]])
+            i += conf.rightcontext
+            if k in self.keywords:
+                words = (len(self.keywords[k]) + 62) // 63
+                if self.sparsekeywords:
+                    featurevector.append( sum( int(row[i + w]) << (63 * w) for w in range(words) ) )
+                else:
+                    for j, keyword in enumerate(x[0] for x in self.keywords[k]):
+                        featurevector.append( (keyword, bool((int(row[i + j // 63]) >> (j % 63)) & 1)) )
+                i += words
+        return featurevector
 
+    def counts(self, sourcepattern):
+        """Returns [(featurevector, count)] for all distinct rows, in order of first occurrence"""
+        if not self.rows:
+            return []
+        rows, counts = self._distinct()
+        return [ (tuple(self.decode(row, sourcepattern)), int(count)) for row, count in zip(rows, counts) ]
 
 
 class AlignmentModel(colibricore.PatternAlignmentModel_float):
@@ -88,7 +193,9 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
             raise Exception("sumover can't be " + sumover)
 
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, compact=None):
+        """Set compact to 'float16' or 'uint8' to keep the score vectors in a compact ScoreStore rather than in the model itself, the model then only holds a reference to a row of the store. Models saved in compact mode are loaded in compact mode automatically."""
+        self.scores = ScoreStore(compact) if compact else None
         if filename:
             self.load(filename)
 
@@ -96,29 +203,148 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
     def load(self, filename, options=None):
         if not options:
             options = colibricore.PatternModelOptions()
-        if os.path.exists(filename):
+        if not os.path.exists(filename):
+            raise IOError("File not found: " + filename)
+        if os.path.exists(filename + '.scores'):
             super().load(filename, options)
+            self.scores = ScoreStore.load(filename + '.scores')
+        elif self.scores is not None:
+            #convert a normal model to compact storage
+            plain = AlignmentModel()
+            plain.load(filename, options)
+            for sourcepattern, targetpattern, features in plain.triples():
+                self.add(sourcepattern, targetpattern, features)
+            del plain
+            self.freeze()
         else:
-            raise IOError("File not found: " + filename)
+            super().load(filename, options)
 
     def save(self, filename):
         super().write(filename)
+        if self.scores is not None:
+            self.scores.save(filename + '.scores')
 
+    def add(self, sourcepattern, targetpattern, features):
+        if self.scores is None:
+            super().add(sourcepattern, targetpattern, features)
+        else:
+            try:
+                #the pair is already stored: overwrite its row rather than leaving it orphaned in the store
+                self.scores[self._row(super().__getitem__((sourcepattern, targetpattern)))] = list(features)
+                return
+            except KeyError:
+                pass
+            row = self.scores.append(list(features))
+            super().add(sourcepattern, targetpattern, (row >> 16, row & 0xFFFF)) #two parts so the row number is exact in single precision
+
+    def _row(self, value):
+        return int(value[0]) * 65536 + int(value[1])
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if self.scores is None:
+            return value
+        elif isinstance(key, tuple):
+            return self.scores[self._row(value)]
+        else:
+            return { targetpattern: self.scores[self._row(rowvalue)] for targetpattern, rowvalue in value.items() }
 
+    def triples(self):
+        if self.scores is None:
+            for triple in super().triples():
+                yield triple
+        else:
+            for sourcepattern, targetpattern, value in super().triples():
+                yield sourcepattern, targetpattern, self.scores[self._row(value)]
 
+    def setfeatures(self, sourcepattern, targetpattern, features):
+        """Replace the score vector of an existing phrase pair"""
+        if self.scores is None:
+            super().add(sourcepattern, targetpattern, features)
+        else:
+            self.scores[self._row(super().__getitem__((sourcepattern, targetpattern)))] = features
 
-    def savemosesphrasetable(self, filename, sourcedecoder, targetdecoder):
-        """Output for moses"""
-        with open(filename,'w',encoding='utf-8') as f:
-            for sourcepattern, targetpattern, features in self.triples():
-                f.write(sourcepattern.tostring(sourcedecoder) + " ||| " + targetpattern.tostring(targetdecoder) + " ||| ")
-                for i, feature in enumerate(features):
-                    if (i > 0): f.write(" ")
-                    f.write(str(feature))
-                f.write("\n")
+    def freeze(self):
+        """Finalise compact storage after loading: in uint8 mode the scores are quantised now"""
+        if self.scores is not None:
+            self.scores.freeze()
+            log.info("Compact score storage: " + str(len(self.scores)) + " score vectors in " + str(round(self.scores.memory() / 1024 / 1024,2)) + " MB (" + self.scores.mode + ")")
 
-    def loadmosesphrasetable(self, filename, sourceencoder, targetencoder,constrainsourcemodel=None,constraintargetmodel=None, quiet=False, reverse=False, delimiter="|||", score_column = 3, max_sourcen = 0, scorefilter = lambda x:True, divergencefrombestthreshold=0.0, divfrombestindex=2):
-        """Load a phrase table from file into memory (memory intensive!), preferably use the tool colibri-mosesphrasetable2alignmodel (should be faster)"""
+
+
+
+    def savemosesphrasetable(self, filename, sourcedecoder, targetdecoder, processes=1, chunksize=10000, compresslevel=6):
+        """Output for moses: writes a phrase table sorted by source phrase. The output is compressed if the filename ends in .gz or .zst (the latter requires the zstandard module).
+
+        Rows are formatted in chunks of source patterns, each chunk is joined into one buffer and compressed as an independent gzip member or zstd frame (their concatenation is a valid stream). With processes > 1 chunks are formatted and compressed by a pool of forked worker processes, the output order is preserved."""
+        global _exportstate
+        if filename.endswith('.zst'):
+            import zstandard #pylint: disable=import-error
+        compression = 'gz' if filename.endswith('.gz') else 'zst' if filename.endswith('.zst') else None
+
+        with metrics.span('savemosesphrasetable', profile=True) as span:
+            sourcepatterns = sorted( (sourcepattern.tostring(sourcedecoder), sourcepattern) for sourcepattern in self.sourcepatterns() )
+            chunks = [ (begin, min(begin + chunksize, len(sourcepatterns))) for begin in range(0, len(sourcepatterns), chunksize) ]
+            _exportstate = (self, sourcepatterns, targetdecoder, compression, compresslevel)
+            progress = Progress(lambda count: "chunks of " + str(chunksize) + " source patterns written", total=len(chunks))
+            rows = 0
+            written = 0
+            try:
+                with open(filename,'wb') as f:
+                    if processes > 1 and len(chunks) > 1:
+                        pool = multiprocessing.get_context('fork').Pool(processes)
+                        results = pool.imap(_formatchunk, chunks)
+                    else:
+                        pool = None
+                        results = map(_formatchunk, chunks)
+                    try:
+                        for chunkrows, buffer in results:
+                            f.write(buffer)
+                            rows += chunkrows
+                            written += len(buffer)
+                            progress.update()
+                        if pool is not None:
+                            pool.close()
+                            pool.join()
+                    finally:
+                        if pool is not None:
+                            pool.terminate() #no-op after a clean join, kills the workers if writing failed
+            finally:
+                _exportstate = None
+            progress.done()
+            span.add(rows)
+        metrics.count('export_rows', rows)
+        metrics.count('export_bytes', written)
+        log.info("Wrote " + str(rows) + " phrase pairs to " + filename + " (" + str(written) + " bytes)")
+        return rows
+
+    def loadmosesphrasetable(self, filename, sourceencoder, targetencoder,constrainsourcemodel=None,constraintargetmodel=None, quiet=False, reverse=False, delimiter="|||", score_column = 3, max_sourcen = 0, scorefilter = None, divergencefrombestthreshold=0.0, divfrombestindex=2, pts=0.0, pst=0.0, joinedthreshold=0.0, native=None, prefilter=True, topk=0, topkindex=2, significance=0.0, corpussize=0, counts_column=5):
+        """Load a phrase table from file into memory (memory intensive!).
+
+        Pruning is done in a single pass: if topk is set, only the k best translation options (by score topkindex, p(t|s) by default) are kept per source phrase. If significance is set, options with a significance (negative log p-value of Fisher's exact test on the counts c(t) c(s) c(s,t) in column counts_column) below it are pruned; this requires the number of sentence pairs in the training corpus (corpussize).
+
+        If constraint models are given and prefilter is set, a Bloom filter over the phrase strings of the constraint models rejects most non-matching lines before they are parsed and encoded.
+
+        If the native converter colibri-mosesphrasetable2alignmodel is installed and the options are supported by it (no custom scorefilter, use pts/pst/joinedthreshold instead), loading is delegated to it transparently. Set native to False to always use the Python loader, or to True to raise an exception if the native loader can not be used.
+
+        Constraint models are never delegated to the native converter automatically: it also discards all lines following a rejected source phrase that share its first word if that word (a unigram) is not in the source constraint model or is not the first word of any of its patterns, so it may keep fewer translation options than the Python loader. Set native to True to accept this."""
+
+        if significance > 0 and corpussize <= 0:
+            raise ValueError("Significance pruning requires the corpus size")
+
+        if native is not False:
+            if not topk and not significance and (native or (constrainsourcemodel is None and constraintargetmodel is None)) and colibrimt.native.available() and colibrimt.native.supported(filename, sourceencoder, targetencoder, reverse, delimiter, score_column, scorefilter, divfrombestindex):
+                span = metrics.span('loadmosesphrasetable').start()
+                stats = colibrimt.native.loadmosesphrasetable(self, filename, sourceencoder, targetencoder, constrainsourcemodel, constraintargetmodel, max_sourcen, pts, pst, joinedthreshold, divergencefrombestthreshold, quiet=quiet)
+                span.add(stats['lines'])
+                span.stop()
+                for key, value in stats.items():
+                    metrics.count('phrasetable_' + key, value)
+                if not quiet:
+                    log.info("Loaded phrase-table using native loader: total added: " + str(stats['added']) + ", skipped because of threshold: " + str(stats['skipped']) + ", skipped because of constraint model: " + str(stats['constrained']))
+                return
+            elif native:
+                raise Exception("Native phrase-table loader is not available (" + colibrimt.native.EXEC_MOSESPHRASETABLE2ALIGNMODEL + " not found in PATH) or does not support the requested options (top-k and significance pruning are only supported by the Python loader)")
 
         if filename.split(".")[-1] == "bz2":
             f = bz2.BZ2File(filename,'r')
@@ -135,28 +361,45 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
         constrained = 0
 
 
-        buffer = []
+        buffer = [] #translation options of the current source, a min-heap of at most topk items when topk is set
+        bestscore = 0
+
+        sourcebloom = targetbloom = None
+        if prefilter:
+            sourcebloom = self._bloomfilter(constrainsourcemodel, sourceencoder)
+            targetbloom = self._bloomfilter(constraintargetmodel, targetencoder)
+        if reverse:
+            sourcebloom, targetbloom = targetbloom, sourcebloom #filters apply to the first and second column respectively
 
+        def progressmessage(count):
+            s = "Loading phrase-table (" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ") total added: " + str(added) + ", skipped because of threshold: " + str(skipped)
+            if constrainsourcemodel or constraintargetmodel:
+                s += ", skipped because of constraint model: " + str(constrained)
+            return s
+        progress = Progress(progressmessage)
+
+        span = metrics.span('loadmosesphrasetable', profile=True).start()
         while True:
 
+            linenum += 1
             if not quiet:
-                linenum += 1
-                if (linenum % 100000) == 0:
-                    s = ""
-                    if constrainsourcemodel or constraintargetmodel:
-                        s = ", skipped because of constraint model: " + str(constrained)
-                    print("Loading phrase-table: @" + str(linenum) + "\t(" + datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + ") total added: " + str(added) + ", skipped because of threshold: " + str(skipped) + s,file=sys.stderr)
+                progress.update()
             line = f.readline()
             if not line:
                 break
             if filename.split(".")[-1] == "bz2" or filename.split(".")[-1] == "gz":
                 line = str(line,'utf-8')
 
+            if (sourcebloom is not None or targetbloom is not None) and rejectline(line, delimiter, sourcebloom, targetbloom):
+                #cheap rejection on the raw strings, before splitting and parsing the full line
+                constrained += 1
+                continue
+
             #split into (trimmed) segments
             segments = [ segment.strip() for segment in line.split(delimiter) ]
 
             if len(segments) < 3:
-                print("Invalid line: ", line, file=sys.stderr)
+                log.warning("Invalid line: " + str(line))
                 continue
 
 
@@ -175,8 +418,8 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
             #else:
             #    null_alignments = 0
 
-            if scorefilter and not scorefilter(scores):
-                print("SKIPPED: ", scores,file=sys.stderr)
+            if (scorefilter and not scorefilter(scores)) or (pst > 0 and scores[0] < pst) or (pts > 0 and scores[2] < pts) or (joinedthreshold > 0 and scores[0] * scores[2] < joinedthreshold):
+                log.debug("SKIPPED: %s", scores)
                 skipped += 1
                 continue
 
@@ -206,22 +449,11 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                 target = targetencoder.buildpattern(segments[1]) #tuple(segments[1].split(" "))
 
             if buffer and source != prevsource:
-                bestscore = 0
-                if divergencefrombestthreshold > 0:
-                    for item in buffer:
-                        source_buffer,target_buffer, scores_buffer = item
-                        if scores_buffer[divfrombestindex] > bestscore:
-                            bestscore = scores_buffer[divfrombestindex]
-
-                for item in buffer:
-                    source_buffer,target_buffer, scores_buffer = item
-                    if scores_buffer[divfrombestindex] >= bestscore * divergencefrombestthreshold:
-                        added += 1
-                        self.add(source_buffer,target_buffer, tuple(scores_buffer))
-                    else:
-                        skipped += 1
-
+                groupadded, groupskipped = self._flushbuffer(buffer, bestscore, divergencefrombestthreshold, divfrombestindex)
+                added += groupadded
+                skipped += groupskipped
                 buffer = []
+                bestscore = 0
 
             if constrainsourcemodel and source not in constrainsourcemodel:
                 constrained += 1
@@ -231,46 +463,99 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                 continue
 
 
-            buffer.append( ( source,target, scores) )
+            if significance > 0:
+                try:
+                    counts = [ float(x) for x in segments[counts_column-1].split() ]
+                    if reverse: counts[0], counts[1] = counts[1], counts[0]
+                    pairsignificance = fishersignificance(counts[2], counts[1], counts[0], corpussize)
+                except (IndexError, ValueError):
+                    pairsignificance = None #no (valid) counts, can not prune
+                if pairsignificance is not None and pairsignificance < significance:
+                    skipped += 1
+                    prevsource = source
+                    continue
+
+            if divergencefrombestthreshold > 0 and scores[divfrombestindex] > bestscore:
+                bestscore = scores[divfrombestindex]
+
+            #the (negated) line number breaks ties, so patterns are never compared and of equally scored options the latest is the smallest item, evicted first
+            item = (scores[topkindex] if topk > 0 else 0, -linenum, source, target, scores)
+            if topk > 0 and len(buffer) >= topk:
+                if item[:2] > buffer[0][:2]:
+                    heapq.heapreplace(buffer, item)
+                skipped += 1
+            elif topk > 0:
+                heapq.heappush(buffer, item)
+            else:
+                buffer.append(item)
             prevsource = source
 
 
         f.close()
 
         #don't forget last item
-        if buffer and source != prevsource:
-            bestscore = 0
-            if divergencefrombestthreshold > 0:
-                for item in buffer:
-                    source,target, scores = item
-                    if scores[divfrombestindex] > bestscore:
-                        bestscore = scores[divfrombestindex]
-
-            for item in buffer:
+        if buffer:
+            groupadded, groupskipped = self._flushbuffer(buffer, bestscore, divergencefrombestthreshold, divfrombestindex)
+            added += groupadded
+            skipped += groupskipped
+
+        span.add(linenum - 1)
+        span.stop()
+        if not quiet:
+            progress.done()
+        self.freeze()
+        metrics.count('phrasetable_lines', linenum - 1)
+        metrics.count('phrasetable_added', added)
+        metrics.count('phrasetable_skipped', skipped)
+        metrics.count('phrasetable_constrained', constrained)
+
+
+
+    def _flushbuffer(self, buffer, bestscore, divergencefrombestthreshold, divfrombestindex):
+        """Adds the buffered translation options of one source phrase to the model, returns (added, skipped)"""
+        added = skipped = 0
+        for _, _, source, target, scores in sorted(buffer, key=lambda item: -item[1]): #restore file order
+            if divergencefrombestthreshold > 0 and scores[divfrombestindex] < bestscore * divergencefrombestthreshold:
+                skipped += 1
+            else:
+                self.add(source, target, tuple(scores))
                 added += 1
-                source,target, scores = item
-                if bestscore * divergencefrombestthreshold >= scores[divfrombestindex]:
-                    self.add( ( source,target, scores) )
-                    added += 1
-                else:
-                    skipped += 1
-
-
-
-
-    def patternswithindexes(self, sourcemodel, targetmodel, sourcedecoder,showprogress=True):
-        """Finds occurrences (positions in the source and target models) for all patterns in the alignment model. """
+        return added, skipped
+
+    def _bloomfilter(self, constraintmodel, encoder):
+        """Builds a Bloom filter over the phrase strings of a constraint model, returns None if there is no constraint model or the encoder's class file is unknown"""
+        if constraintmodel is None or isinstance(constraintmodel, str):
+            return None
+        classfile = colibrimt.native.classfile(encoder)
+        if not classfile:
+            return None
+        with metrics.span('bloomfilter'):
+            bloom = BloomFilter.frommodel(constraintmodel, colibricore.ClassDecoder(classfile))
+        log.info("Built prefilter for constraint model: " + str(len(bloom)) + " patterns, " + str(round(bloom.memory() / 1024 / 1024,2)) + " MB")
+        return bloom
+
+    def patternswithindexes(self, sourcemodel, targetmodel, sourcedecoder,showprogress=True, maxmemory=0, tmpdir=None):
+        """Finds occurrences (positions in the source and target models) for all patterns in the alignment model. With maxmemory (bytes), the occurrences of a source pattern are grouped out-of-core (see externalpatternwithindexes)"""
         l = len(self)
+        debug = debugging()
+        progress = Progress("source patterns processed", l)
         for i, sourcepattern in enumerate(self.sourcepatterns()):
             if showprogress:
-                print("@" + str(i+1) + "/" + str(l), " " , round(((i+1)/l)*100,2),'% -- Processing ' + sourcepattern.tostring(sourcedecoder), file=sys.stderr)
+                progress.update()
+            if debug: log.debug("@" + str(i+1) + "/" + str(l) + " -- Processing " + sourcepattern.tostring(sourcedecoder))
 
             if not (sourcepattern in sourcemodel):
-                print("\tPattern not in model.. skipping", file=sys.stderr)
+                if debug: log.debug("\tPattern not in model.. skipping")
                 continue
 
-            for result in self.patternwithindexes(sourcepattern, sourcemodel, targetmodel, sourcedecoder, showprogress):
+            if maxmemory:
+                results = self.externalpatternwithindexes(sourcepattern, sourcemodel, targetmodel, sourcedecoder, maxmemory, tmpdir, showprogress and debug)
+            else:
+                results = self.patternwithindexes(sourcepattern, sourcemodel, targetmodel, sourcedecoder, showprogress and debug)
+            for result in results:
                 yield result
+        if showprogress:
+            progress.done()
 
 
     def patternwithindexes(self, sourcepattern, sourcemodel, targetmodel, sourcedecoder, showprogress=True):
@@ -305,17 +590,68 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                         break #multiple possible matches in same sentence? just pick first one... no word alignments here to resolve this
 
         if showprogress:
-            print("\tFound " + str(len(tmpdata)) + " occurrences for " + sourcepattern.tostring(sourcedecoder) + ", with " + str(targetl) + " different translation options", file=sys.stderr)
+            log.debug("\tFound " + str(len(tmpdata)) + " occurrences for " + sourcepattern.tostring(sourcedecoder) + ", with " + str(targetl) + " different translation options")
 
         #make sure only the strongest targetpattern for a given occurrence is chosen, in case multiple options exist
         for (sentence,token, targettoken),targets  in tmpdata.items():
             ptsscore,sourcepattern2, targetpattern = sorted(targets)[-1] #sorted by ptsscore, last item will be highest
             yield sourcepattern2, targetpattern, sentence, token, sentence, targettoken
 
+    def externalpatternwithindexes(self, sourcepattern, sourcemodel, targetmodel, sourcedecoder, maxmemory, tmpdir=None, showprogress=True):
+        """Like patternwithindexes(), but the occurrences are collected in spill buffers of at most maxmemory bytes each (sorted runs on disk, merged when read back), for patterns too frequent to group in memory. Yields the same occurrences, with the same choice of target pattern and in the same order, as patternwithindexes()"""
+        targetpatterns = [ targetpattern for targetpattern in self.targetpatterns(sourcepattern) if targetpattern in targetmodel ] #index => targetpattern, runs store the index
+        #rank of every target pattern in pattern order: on equal p(t|s), patternwithindexes() chooses the highest target pattern
+        ranks = [0] * len(targetpatterns)
+        for rank, targetindex in enumerate(sorted(range(len(targetpatterns)), key=lambda x: targetpatterns[x])):
+            ranks[targetindex] = rank
+        sourceindexes = None #loading deferred until really needed
+        seq = 0 #order in which patternwithindexes() first sees an occurrence
+        with SpillBuffer(maxmemory, tmpdir) as occurrences, SpillBuffer(maxmemory, tmpdir) as chosen:
+            for targetindex, targetpattern in enumerate(targetpatterns):
+                if not sourceindexes:
+                    sourceindexes = defaultdict(list)
+                    for sourcesentence, sourcetoken in sourcemodel[sourcepattern]:
+                        sourceindexes[sourcesentence].append(sourcetoken)
+
+                targetindexes = defaultdict(list)
+                for targetsentence, targettoken in targetmodel[targetpattern]:
+                    if targetsentence in sourceindexes:
+                        targetindexes[targetsentence].append(targettoken)
+
+                ptsscore = self[(sourcepattern,targetpattern)][2] #assuming moses style score vector!
+                for sentence in targetindexes:
+                    for token in sourceindexes[sentence]:
+                        #first target occurrence in the same sentence, as in patternwithindexes(); negated score and rank so the strongest target sorts first
+                        occurrences.append( (sentence, token, targetindexes[sentence][0], -ptsscore, -ranks[targetindex], seq, targetindex) )
+                        seq += 1
+
+            if showprogress:
+                log.debug("\tFound " + str(len(occurrences)) + " occurrences for " + sourcepattern.tostring(sourcedecoder) + ", with " + str(len(targetpatterns)) + " different translation options, in " + str(len(occurrences.runs)) + " runs")
+
+            #make sure only the strongest targetpattern for a given occurrence is chosen, in case multiple options exist; the
+            #occurrence keeps the position where it was first seen
+            prev = best = None
+            firstseq = 0
+            for sentence, token, targettoken, _, _, occurrenceseq, targetindex in occurrences:
+                if (sentence, token, targettoken) != prev:
+                    if best is not None:
+                        chosen.append( (firstseq,) + best )
+                    best = (targetindex, sentence, token, targettoken)
+                    firstseq = occurrenceseq
+                    prev = (sentence, token, targettoken)
+                elif occurrenceseq < firstseq:
+                    firstseq = occurrenceseq
+            if best is not None:
+                chosen.append( (firstseq,) + best )
+
+            for _, targetindex, sentence, token, targettoken in chosen:
+                yield sourcepattern, targetpatterns[targetindex], sentence, token, sentence, targettoken
 
 
 
-    def extractcontextfeatures(self, sourcemodel, targetmodel, configurations, sourcedecoder, targetdecoder, crosslingual=False, savekeywordsindir='.'):
+
+    def extractcontextfeatures(self, sourcemodel, targetmodel, configurations, sourcedecoder, targetdecoder, crosslingual=False, keywordstore=None, skip=None, maxmemory=0, tmpdir=None, sparsekeywords=False):
+        """Yields (sourcepattern, targetpattern, [(featurevector, count)], scorevector) for all pairs with occurrences. The keywords found for every source pattern are added to keywordstore (a KeywordStore), if set. Skip is a set of source patterns not to process. With maxmemory (bytes), occurrences are grouped out-of-core and feature rows are kept within the memory cap. With sparsekeywords, keyword features are yielded as a bitset per configuration (see FeatureRows)"""
         featurevector = []
         assert isinstance(sourcemodel, colibricore.IndexedPatternModel)
         assert isinstance(targetmodel, colibricore.IndexedPatternModel)
@@ -327,16 +663,18 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
 
         prev = None
         prevsource = None
-        tmpdata = defaultdict(int) # featurevector => occurrencecount
+        codes = [ ({}, []) for _ in configurations ] #per configuration: unigram => code, code => unigram
+        tmpdata = None #FeatureRows for the current pair
 
         keywords = {} #configuration index => (keywords)
+        keywordsets = {} #configuration index => { keyword: bit }
         kwcount = {}
         tcount = {}
 
         count = 0
 
         extracted = 0
-        for data in self.patternswithindexes(sourcemodel, targetmodel, sourcedecoder):
+        for data in self.patternswithindexes(sourcemodel, targetmodel, sourcedecoder, maxmemory=maxmemory, tmpdir=tmpdir):
             if crosslingual:
                 #we're interested in the target-side sentence and token
                 sourcepattern, targetpattern, _,_, sentence,token  = data
@@ -346,40 +684,42 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                 sourcepattern, targetpattern, sentence, token,_,_  = data
                 n = len(sourcepattern)
             count+=1
+            if skip and sourcepattern in skip:
+                #already processed (resuming from a checkpoint)
+                continue
 
 
 
             if (sourcepattern, targetpattern) != prev:
                 if prev:
                     #process previous
-                    allfeaturevectors = []
                     scorevector = self[prev]
+                    yield prev[0], prev[1], tmpdata.counts(prev[0]), scorevector
 
-                    for featurevector, count in tmpdata.items():
-                        allfeaturevectors.append( (featurevector, count) )
-
-                    yield prev[0], prev[1], allfeaturevectors, scorevector
-
-                tmpdata = defaultdict(int) #reset
+                tmpdata = None #reset
                 prev = (sourcepattern,targetpattern)
 
             if dokeywords and (not prevsource or prevsource != sourcepattern):
                 if keywords:
                     keywords = {}
+                    keywordsets = {}
                 #we have a new source frgment, time to compute keywords for this source
                 for k, configuration in enumerate(configurations):
                     if configuration.keywordmodel:
                         kwcount, tcount = self.countkeywords(sourcepattern, sourcemodel, targetmodel, configuration.corpus, configuration.keywordmodel, sourcedecoder, crosslingual)
-                        keywords[k] = self.findkeywords(configuration.keywordmodel, kwcount, tcount, configuration.kw_absolute_threshold, configuration.kw_prob_threshold)
-                        if savekeywordsindir:
-                            self.savekeywords(keywords[k], sourcepattern, sourcedecoder, targetdecoder, savekeywordsindir, crosslingual)
+                        keywords[k] = self.findkeywords(configuration.keywordmodel, kwcount, tcount, configuration.kw_absolute_threshold, configuration.kw_prob_threshold, configuration.maxkeywords)
+                        keywordsets[k] = { x[0]: j for j, x in enumerate(keywords[k]) }
+                        if keywordstore is not None:
+                            self.savekeywords(keywords[k], sourcepattern, sourcedecoder, targetdecoder, keywordstore, crosslingual)
                 prevsource = sourcepattern
 
+            if tmpdata is None:
+                tmpdata = FeatureRows(configurations, codes, keywords, maxmemory=maxmemory, sparsekeywords=sparsekeywords)
 
-            featurevector = [] #local context features
+            row = [] #local context features, integer coded (see FeatureRows)
 
             for k, configuration in enumerate(configurations):
-                factoredcorpus,classdecoder, leftcontext, focus, rightcontext, keywordmodel = (configuration.corpus, configuration.classdecoder, configuration.leftcontext, configuration.focus, configuration.rightcontext, configuration.keywordmodel)
+                factoredcorpus, leftcontext, rightcontext, keywordmodel = (configuration.corpus, configuration.leftcontext, configuration.rightcontext, configuration.keywordmodel)
 
                 sentencelength = factoredcorpus.sentencelength(sentence)
                 for i in range(token - leftcontext,token):
@@ -388,9 +728,8 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                     else:
                         unigram = factoredcorpus[(sentence,i)]
                     assert len(unigram) == 1
-                    featurevector.append(unigram)
-                if focus: #focus needs a different class decoder if run with crosslingual! will be handled by featurestostring()
-                    featurevector.append(sourcepattern)
+                    row.append(tmpdata.code(k, unigram))
+                #focus is not stored in the row, it is the source pattern (featurestostring() handles the decoder for crosslingual)
                 #print("DEBUG: l" + str(leftcontext) + "r" + str(rightcontext) + "n" + str(n) +"  : " + str(token+n) + "-" + str(token+n+rightcontext), file=sys.stderr)
                 for i in range(token + n , token + n + rightcontext):
                     if i >= sentencelength:
@@ -398,45 +737,35 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                     else:
                         unigram = factoredcorpus[(sentence,i)]
                     assert len(unigram) == 1
-                    featurevector.append(unigram)
+                    row.append(tmpdata.code(k, unigram))
 
                 if keywordmodel:
-                    #print("\t\tProcessing " + str(len(keywords[k])) + " keywords, sentencelength=" + str(sentencelength) ,file=sys.stderr)
-                    #extract keywords and add to featurevector
-                    bagofwords = {}
+                    #extract keywords and add to the row as a bitmask (63 keywords per word)
+                    words = [0] * ((len(keywords[k]) + 62) // 63)
                     for i in range(0, sentencelength):
-                        unigram = factoredcorpus[(sentence,i)]
-                        if unigram in ( x[0] for x in keywords[k] ):
-                            bagofwords[unigram] = True
-
-                    for keyword in (x[0] for x in  keywords[k] ):
-                        if keyword in bagofwords:
-                            featurevector.append( (keyword, True) )
-                        else:
-                            featurevector.append( (keyword, False) )
+                        bit = keywordsets[k].get(factoredcorpus[(sentence,i)])
+                        if bit is not None:
+                            words[bit // 63] |= 1 << (bit % 63)
+                    row += words
 
 
-            #print(featurevector,file=sys.stderr)
             extracted += 1
-            tmpdata[tuple(featurevector)] += 1
+            tmpdata.append(row)
 
         #process final pair:
         if prev:
             #process previous
-            allfeaturevectors = []
             scorevector = self[prev]
-
-            for featurevector, count in tmpdata.items():
-                allfeaturevectors.append( (featurevector, count) )
-
-            yield prev[0], prev[1], allfeaturevectors, scorevector
+            yield prev[0], prev[1], tmpdata.counts(prev[0]), scorevector
 
 
-        print("Extracted features for " + str(extracted) + " sentences",file=sys.stderr)
+        log.info("Extracted features for " + str(extracted) + " sentences")
 
 
     def normalize(self, sumover='s'):
         total = {}
+        if self.scores is not None:
+            self.scores.thaw() #quantise again afterwards, the codebooks no longer fit the normalised scores
 
         for sourcepattern, targetpattern, features in self.triples():
             #if not isinstance(value, list) and not isinstance(value, tuple):
@@ -477,6 +806,9 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                     features[i] = 0
                 elif sumover[i] == '-':
                     pass
+            if self.scores is not None:
+                self.setfeatures(sourcepattern, targetpattern, features)
+        self.freeze()
 
 
     def countkeywords(self, sourcepattern, sourcemodel, targetmodel, corpus, keywordmodel, sourcedecoder, crosslingual):
@@ -504,7 +836,7 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
 
 
 
-    def findkeywords(self, keywordmodel, kwcount, tcount, kw_absolute_threshold, kw_prob_threshold):
+    def findkeywords(self, keywordmodel, kwcount, tcount, kw_absolute_threshold, kw_prob_threshold, maxkeywords=MAXKEYWORDS):
         bag = []
         #select all words that occur at least 3 times for a sense, and have a probability_sense_given_keyword >= 0.001
         for targetfragment in kwcount:
@@ -522,32 +854,81 @@ class AlignmentModel(colibricore.PatternAlignmentModel_float):
                 if not keyword in found:
                     newbag.append( (keyword,targetfragment, freq, p) )
                     found[keyword] = True
-                    if len(newbag) == MAXKEYWORDS:
+                    if len(newbag) == maxkeywords:
                         break
-            print("\tFound " + str(len(newbag)) + " keywords (for "+ str(len(kwcount)) + " translation options)", file=sys.stderr)
+            log.debug("\tFound " + str(len(newbag)) + " keywords (for "+ str(len(kwcount)) + " translation options)")
             return tuple(newbag)
         else:
-            print("\tNo keywords found (for "+ str(len(kwcount)) + " translation options)", file=sys.stderr)
+            log.debug("\tNo keywords found (for "+ str(len(kwcount)) + " translation options)")
         return bag
 
 
-    def savekeywords(self, bag, sourcepattern, sourcedecoder, targetdecoder, workdir='.', crosslingual=False):
-        f = open(workdir + '/' + quote_plus(sourcepattern.tostring(sourcedecoder)) + '.keywords','w',encoding='utf-8')
+    def savekeywords(self, bag, sourcepattern, sourcedecoder, targetdecoder, keywordstore, crosslingual=False):
+        """Add the keywords of a source pattern to the keyword store"""
+        debug = debugging()
+        decoded = []
         for keyword, targetpattern, c, p in bag:
             if not crosslingual:
                 keyword = keyword.tostring(sourcedecoder)
             else:
                 keyword = keyword.tostring(targetdecoder)
-            s = keyword + '\t' + targetpattern.tostring(targetdecoder) + '\t' + str(c) + '\t' + str(p)
-            f.write(s +'\n')
-            print("\t\t" + s, file=sys.stderr)
-        f.close()
+            decoded.append( (keyword, targetpattern.tostring(targetdecoder), c, p) )
+            if debug: log.debug("\t\t" + "\t".join(str(x) for x in decoded[-1]))
+        keywordstore.add(sourcepattern.tostring(sourcedecoder), decoded)
+
+
 
+_exportstate = None #(model, sorted source patterns, target decoder, compression, level), set by savemosesphrasetable() and inherited by forked workers
+
+def _formatchunk(bounds):
+    """Formats (and compresses) the phrase-table rows for a range of the sorted source patterns, returns (number of rows, buffer)"""
+    model, sourcepatterns, targetdecoder, compression, compresslevel = _exportstate
+    lines = []
+    targetstrings = {}
+    for sourcestring, sourcepattern in sourcepatterns[bounds[0]:bounds[1]]:
+        prefix = sourcestring + " ||| "
+        for targetpattern in model.targetpatterns(sourcepattern):
+            features = model[(sourcepattern, targetpattern)]
+            try:
+                targetstring = targetstrings[targetpattern]
+            except KeyError:
+                targetstring = targetstrings[targetpattern] = targetpattern.tostring(targetdecoder)
+            if features and isinstance(features[-1], (list, tuple)):
+                #word alignments go in a separate field
+                lines.append(prefix + targetstring + " ||| " + " ".join([ str(x) for x in features[:-1] ]) + " ||| " + " ".join([ str(i) + "-" + str(j) for i, j in features[-1] ]) + "\n")
+            else:
+                lines.append(prefix + targetstring + " ||| " + " ".join([ str(x) for x in features ]) + "\n")
+    buffer = "".join(lines).encode('utf-8')
+    if compression == 'gz':
+        buffer = gzip.compress(buffer, compresslevel)
+    elif compression == 'zst':
+        import zstandard #pylint: disable=import-error
+        buffer = zstandard.ZstdCompressor(level=compresslevel).compress(buffer)
+    return len(lines), buffer
+
+
+def fishersignificance(jointcount, sourcecount, targetcount, n):
+    """Significance of the co-occurrence of a phrase pair (Johnson et al., 2007): the negative natural log of the p-value of Fisher's exact test (one-tailed), i.e. of the hypergeometric probability of observing at least the joint count, given the source count, target count and the number of sentence pairs n"""
+    jointcount = int(jointcount)
+    sourcecount = int(sourcecount)
+    targetcount = int(targetcount)
+    n = max(int(n), sourcecount, targetcount)
+
+    def logchoose(a, b):
+        return math.lgamma(a + 1) - math.lgamma(b + 1) - math.lgamma(a - b + 1)
+
+    denominator = logchoose(n, targetcount)
+    logps = [ logchoose(sourcecount, k) + logchoose(n - sourcecount, targetcount - k) - denominator for k in range(jointcount, min(sourcecount, targetcount) + 1) if targetcount - k <= n - sourcecount ]
+    if not logps:
+        return 0.0
+    m = max(logps)
+    logp = m + math.log(sum( math.exp(x - m) for x in logps ))
+    return max(0.0, -logp)
 
 
 def probability_translation_given_keyword(target, keyword, kwcount, keywordmodel):
     if not target in kwcount:
-        print("target not seen:", target, file=sys.stderr)
+        log.debug("target not seen: %s", target)
         return 0 #sense has never been seen for this focus word
 
     Ns_kloc = 0.0
@@ -562,13 +943,29 @@ def probability_translation_given_keyword(target, keyword, kwcount, keywordmodel
 
     Nkcorp = keywordmodel.occurrencecount(keyword) #/ float(totalcount_sum)
     if Nkcorp == 0:
-        print("keyword not seen:", keyword, file=sys.stderr)
+        log.debug("keyword not seen: %s", keyword)
         return 0 #keyword has never been seen
 
     return (Ns_kloc / Nkloc) * (1/Nkcorp)
 
 
 
+def shardof(sourcepattern_s, shards):
+    """Shard of the monolithic classifier that holds the instances of a source pattern (stable across processes and runs, unlike hash())"""
+    return zlib.crc32(sourcepattern_s.encode('utf-8')) % shards
+
+def shardprefix(directory, shard, shards):
+    """File prefix of a shard of the monolithic classifier, a single shard is the classic train.train"""
+    return directory + "/train" if shards <= 1 else directory + "/train-" + str(shard)
+
+def loadsourcepatternindex(directory):
+    """Set of source patterns covered by the monolithic classifier, from the pickled index or else from sourcepatterns.list"""
+    if os.path.exists(directory + "/sourcepatterns.index"):
+        with open(directory + "/sourcepatterns.index",'rb') as f:
+            return pickle.load(f)
+    with open(directory + "/sourcepatterns.list",'r',encoding='utf-8') as f:
+        return set( line.strip() for line in f )
+
 def featurestostring(features, configurations, crosslingual=False, sourcedecoder=None):
         if crosslingual and not sourcedecoder:
             raise Exception("Source decoder must be specified when doing crosslingual")
@@ -581,8 +978,8 @@ def featurestostring(features, configurations, crosslingual=False, sourcedecoder
             if conf.focus: n += 1
 
         if len(features) < n:
-            print("Configurations: ", repr(configurations),file=sys.stderr)
-            print("Features: ", repr(features),file=sys.stderr)
+            log.error("Configurations: " + str(repr(configurations)))
+            log.error("Features: " + str(repr(features)))
             raise Exception("Expected " + str(n) + " features, got " + str(len(features)))
 
         featcursor = 0
@@ -599,8 +996,8 @@ def featurestostring(features, configurations, crosslingual=False, sourcedecoder
                 else:
                     feature_s = p.tostring(conf.classdecoder)
                 if not feature_s:
-                    print("Feature: " + str(repr(bytes(p))) ,file=sys.stderr)
-                    print("Feature vector thus far: " + str(repr(s)),file=sys.stderr)
+                    log.error("Feature: " + str(repr(bytes(p))))
+                    log.error("Feature vector thus far: " + str(repr(s)))
                     raise Exception("Empty feature! Not allowed!")
                 s.append(feature_s)
 
@@ -608,9 +1005,13 @@ def featurestostring(features, configurations, crosslingual=False, sourcedecoder
 
             if conf.keywordmodel:
                 keywordcount = 0
-                #remaining str instances are keywords (decoded earlier)
+                #remaining str instances are keywords (decoded earlier), or a single bitset over the keywords of the source pattern (sparse)
                 for d in features[featcursor:]:
-                    if isinstance(d, tuple) and len(d) == 2:
+                    if isinstance(d, int) and not isinstance(d, bool):
+                        s.append(BITSETPREFIX + format(d, 'x')) #bit j: keyword j of the source pattern (in the keyword store) occurs
+                        keywordcount += 1
+                        break
+                    elif isinstance(d, tuple) and len(d) == 2:
                         keyword, occurs = d
                         keywordcount += 1
                         feature_s = keyword.tostring(conf.classdecoder)
@@ -652,43 +1053,55 @@ def main_extractfeatures():
     parser.add_argument('-I','--instancethreshold',type=int,help="Classifiers (-C) having less than the specified number of instances will be not be generated", action='store',default=2)
     parser.add_argument('-X','--experts', help="Classifier experts, one per source pattern", action="store_true", default=False)
     parser.add_argument('-M','--monolithic', help="Monolithic classifier (won't work with keywords enabled!)", action="store_true", default=False)
+    parser.add_argument('--shards', type=int, help="Split the monolithic classifier (-M) into this many shards, partitioned by a hash of the source pattern, so they can be trained in parallel and each lookup only hits a smaller instance base", action="store", default=1)
     parser.add_argument('-k','--keywords',help="Add global keywords in context", action='store_true',default=False)
     parser.add_argument('--km',dest='keywordmodel',type=str,help="Source-side unigram model (target-side if crosslingual is set!) for keyword extraction. Needs to be an indexed model with only unigrams.", action='store',required=False,default="")
     parser.add_argument("--kt",dest="bow_absolute_threshold", help="Keyword needs to occur at least this many times in the context (absolute number)", type=int, action='store',default=3)
     parser.add_argument("--kp",dest="bow_prob_threshold", help="minimal P(translation|keyword)", type=float, action='store',default=0.001)
+    parser.add_argument("--kn",dest="maxkeywords", help="Maximum number of keywords per source pattern (i.e. per classifier expert)", type=int, action='store',default=MAXKEYWORDS)
+    parser.add_argument('--sparsekeywords',help="Write the keyword features of an instance as a single sparse column, a bitset of the keywords present (kw:<hex>, bit j is the j-th keyword of the source pattern in the keyword store), rather than as one keyword=0/1 column per keyword. Smaller training files; the numpy backend of colibri-contextmoses compares these bitsets per keyword, Timbl compares them as a whole", action='store_true',default=False)
     parser.add_argument("--kg",dest="bow_filter_threshold", help="Keyword needs to occur at least this many times globally in the entire corpus (absolute number)", type=int, action='store',default=20)
     #parser.add_argument("--ka",dest="compute_bow_params", help="Attempt to automatically compute --kt,--kp and --kg parameters", action='store_false',default=True)
     parser.add_argument('--crosslingual', help="Extract target-language context features instead of source-language features (for use with Colibrita). In this case, the corpus in -f and in any additional factor must be the *target* corpus", action="store_true", default=False)
+    parser.add_argument('--maxmemory',type=int,help="Memory cap (MB) for grouping the occurrences and training instances of a single source pattern, beyond which they are spilled to sorted, compressed run files on disk and merged back in a streaming pass (for huge corpora). 0 keeps everything in memory", action='store',default=0)
+    parser.add_argument('--tmpdir',type=str,help="Directory for the run files of --maxmemory (system default if not set)", action='store',default=None)
+    parser.add_argument('--checkpointinterval',type=int,help="When building classifier data (-C), save progress every this many seconds in <outputdir>/.checkpoint, so an interrupted job can be resumed with --resume. 0 disables checkpointing", action='store',default=0)
+    parser.add_argument('--resume',help="Resume from the checkpoint of an earlier, interrupted, run with the same input and parameters (-C), checkpoints continue to be saved (every " + str(INTERVAL) + " seconds unless --checkpointinterval is set)", action='store_true',default=False)
+    addmetricsarguments(parser)
+    addloggingarguments(parser)
     args = parser.parse_args()
+    setuplogging(args)
+    setupmetrics(args, 'colibri-extractfeatures')
 
     if not (len(args.corpusfile) == len(args.classfile) == len(args.leftsize) == len(args.rightsize)):
-        print("Number of mentions of -f, -c, -l and -r has to match",file=sys.stderr)
+        log.error("Number of mentions of -f, -c, -l and -r has to match")
         sys.exit(2)
 
 
     options = colibricore.PatternModelOptions(mintokens=1,doreverseindex=False)
 
-    print("Loading alignment model",file=sys.stderr)
+    loadspan = metrics.span('load').start()
+    log.info("Loading alignment model")
     model = AlignmentModel()
     model.load(args.inputfile,options)
 
 
-    print("Loading source decoder " + args.sourceclassfile,file=sys.stderr)
+    log.info("Loading source decoder " + args.sourceclassfile)
     sourcedecoder = colibricore.ClassDecoder(args.sourceclassfile)
-    print("Loading target decoder " + args.targetclassfile,file=sys.stderr)
+    log.info("Loading target decoder " + args.targetclassfile)
     targetdecoder = colibricore.ClassDecoder(args.targetclassfile)
 
-    print("Loading source model " , args.sourcemodel, file=sys.stderr)
+    log.info("Loading source model " + str(args.sourcemodel))
     sourcemodel = colibricore.IndexedPatternModel(args.sourcemodel, options)
 
-    print("Loading target model ", args.targetmodel, file=sys.stderr)
+    log.info("Loading target model " + str(args.targetmodel))
     targetmodel = colibricore.IndexedPatternModel(args.targetmodel, options)
 
 
 
     model.conf = []
     for corpusfile, classfile,left, right in zip(args.corpusfile, args.classfile, args.leftsize, args.rightsize):
-        print("Loading corpus file ", corpusfile, file=sys.stderr)
+        log.info("Loading corpus file " + str(corpusfile))
         if classfile == args.sourceclassfile:
             d = sourcedecoder
         elif classfile == args.targetclassfile:
@@ -699,18 +1112,20 @@ def main_extractfeatures():
 
     if args.keywords:
         if not args.keywordmodel:
-            print("Supply an indexed pattern model containing unigrams to extract keywords from!",file=sys.stderr)
+            log.error("Supply an indexed pattern model containing unigrams to extract keywords from!")
             sys.exit(2)
-        print("Loading keyword model ", args.keywordmodel, file=sys.stderr)
+        log.info("Loading keyword model " + str(args.keywordmodel))
         kmoptions = colibricore.PatternModelOptions(mintokens=max(args.bow_absolute_threshold,args.bow_filter_threshold),minlength=1,maxlength=1,doreverseindex=True)
         reverseindex = colibricore.IndexedCorpus(args.corpusfile[0])
         model.conf[0].keywordmodel = colibricore.IndexedPatternModel(args.keywordmodel, kmoptions, None, reverseindex)
         model.conf[0].kw_absolute_threshold = args.bow_absolute_threshold
         model.conf[0].kw_prob_threshold = args.bow_prob_threshold
+        model.conf[0].maxkeywords = args.maxkeywords
+    loadspan.stop()
 
 
     if args.buildclassifiers:
-        print("Building classifiers",file=sys.stderr)
+        log.info("Building classifiers")
         if not args.monolithic and not args.experts:
             args.experts = True
 
@@ -718,22 +1133,54 @@ def main_extractfeatures():
             try:
                 os.mkdir(args.outputdir)
             except:
-                print("Unable to build directory " + args.outputdir,file=sys.stderr)
+                log.error("Unable to build directory " + args.outputdir)
                 sys.exit(2)
 
 
+        checkpoint = resumed = None
+        done = None
+        if args.resume and args.checkpointinterval <= 0:
+            args.checkpointinterval = INTERVAL
+        if args.checkpointinterval > 0:
+            key = (filekey(args.inputfile), filekey(args.sourcemodel), filekey(args.targetmodel), tuple( filekey(x) for x in args.corpusfile ), tuple(args.leftsize), tuple(args.rightsize), args.experts, args.monolithic, args.shards, args.weighbyoccurrence, args.weighbyscore, args.instancethreshold, args.keywords, args.maxkeywords, args.sparsekeywords, args.crosslingual)
+            checkpoint = Checkpoint(args.outputdir + "/.checkpoint", key, args.checkpointinterval)
+            if args.resume:
+                resumed = checkpoint.resume()
+                if resumed:
+                    sourceencoder = colibricore.ClassEncoder(args.sourceclassfile)
+                    done = set( sourceencoder.buildpattern(sourcepattern_s) for sourcepattern_s in resumed[1] )
+                    log.info("Resuming, " + str(len(done)) + " source patterns already processed")
+                else:
+                    log.info("No checkpoint found, starting from scratch")
+            checkpoint.start(resumed is not None)
+
         f = None
         trainfile = ""
         if args.monolithic:
-            f = open(args.outputdir + "/train.train",'w',encoding='utf-8')
-            f2 = open(args.outputdir + "/sourcepatterns.list",'w',encoding='utf-8')
+            shardfilenames = [ shardprefix(args.outputdir, shard, args.shards) + ".train" for shard in range(max(1,args.shards)) ]
+            sourcepatternindex = set()
+            if resumed:
+                #discard anything written after the checkpoint and append
+                for shardfilename, size in zip(shardfilenames, resumed[0]['shards']):
+                    truncate(shardfilename, size)
+                truncate(args.outputdir + "/sourcepatterns.list", resumed[0]['list'])
+                with open(args.outputdir + "/sourcepatterns.list",'r',encoding='utf-8') as f2:
+                    sourcepatternindex = set( line.strip() for line in f2 )
+            shardfiles = [ open(shardfilename,'a' if resumed else 'w',encoding='utf-8') for shardfilename in shardfilenames ]
+            f2 = open(args.outputdir + "/sourcepatterns.list",'a' if resumed else 'w',encoding='utf-8')
+
+        keywordstore = None
+        if args.keywords:
+            if resumed and resumed[0] and 'keywords' in resumed[0]:
+                truncate(args.outputdir + "/" + KEYWORDSTORE, resumed[0]['keywords'])
+            keywordstore = KeywordStore(args.outputdir + "/" + KEYWORDSTORE, 'a' if resumed else 'w')
 
         fconf = open(args.outputdir + "/classifier.conf",'wb')
 
         confser = []
         for conf in model.conf:
             confser.append({'corpus': conf.corpus.filename(), 'classdecoder': conf.classdecoder.filename(), 'leftcontext': conf.leftcontext, 'focus': conf.focus,'rightcontext': conf.rightcontext})
-        classifierconf = { 'weighbyoccurrence': args.weighbyoccurrence, 'weighbyscore': args.weighbyscore, 'experts': args.experts, 'monolithic': args.monolithic, 'featureconf': confser}
+        classifierconf = { 'weighbyoccurrence': args.weighbyoccurrence, 'weighbyscore': args.weighbyscore, 'experts': args.experts, 'monolithic': args.monolithic, 'shards': max(1,args.shards) if args.monolithic else 1, 'featureconf': confser, 'keywords': [ k for k, conf in enumerate(model.conf) if conf.keywordmodel ], 'sparsekeywords': args.sparsekeywords}
         pickle.dump(classifierconf, fconf)
         fconf.close()
 
@@ -741,7 +1188,12 @@ def main_extractfeatures():
         prevsourcepattern = None
         firsttargetpattern = None
         prevtargetpattern = None
-        for sourcepattern, targetpattern, featurevectors, scorevector in model.extractcontextfeatures(sourcemodel, targetmodel, model.conf, sourcedecoder, targetdecoder, args.crosslingual, args.outputdir ):
+        span = metrics.span('extractfeatures', profile=True).start()
+        progress = Progress(lambda count: "source/target pairs processed, " + str(metrics.counters['trainfiles']) + " training files written")
+        #with a memory cap, it is divided over the occurrence runs, the chosen occurrences, the feature rows and the training instances
+        maxmemory = args.maxmemory * 1024 * 1024 // 4
+        buffer = SpillBuffer(maxmemory, args.tmpdir) if maxmemory else []
+        for sourcepattern, targetpattern, featurevectors, scorevector in model.extractcontextfeatures(sourcemodel, targetmodel, model.conf, sourcedecoder, targetdecoder, args.crosslingual, keywordstore, done, maxmemory, args.tmpdir, args.sparsekeywords):
             if prevsourcepattern is None or sourcepattern != prevsourcepattern:
                 #write previous buffer to file:
                 if prevsourcepattern and firsttargetpattern:
@@ -749,17 +1201,23 @@ def main_extractfeatures():
                     if prevtargetpattern and firsttargetpattern != prevtargetpattern:
                         #only bother if there are at least two distinct target options
                         if len(buffer) < min(args.instancethreshold,2):
-                            print("Omitting " + trainfile + ", only " + str(len(buffer)) + " instances",file=sys.stderr)
+                            log.debug("Omitting " + trainfile + ", only " + str(len(buffer)) + " instances")
+                            metrics.count('omitted')
                         else:
                             trainfile = args.outputdir + "/" + quote_plus(sourcepattern_s) + ".train"
                             if len(quote_plus(sourcepattern_s) + ".train") > 100:
-                                print("ERROR: Filename too long, skipping: " + trainfile,file=sys.stderr)
+                                log.error("ERROR: Filename too long, skipping: " + trainfile)
+                                metrics.count('skipped')
                             else:
-                                print("Writing " + trainfile + " (" + str(len(buffer)) + " instances)",file=sys.stderr)
+                                log.debug("Writing " + trainfile + " (" + str(len(buffer)) + " instances)")
+                                metrics.count('trainfiles')
+                                metrics.count('instances', len(buffer))
                                 if args.experts:
                                     f = open(trainfile,'w',encoding='utf-8')
                                 elif args.monolithic:
                                     f2.write(sourcepattern_s+"\n")
+                                    sourcepatternindex.add(sourcepattern_s)
+                                    f = shardfiles[shardof(sourcepattern_s, len(shardfiles))]
                                 for line, occurrences,pts in buffer:
                                     if args.weighbyscore:
                                         f.write(line + "\t" + str(occurrences*pts) +  "\n")
@@ -771,12 +1229,30 @@ def main_extractfeatures():
                                 if args.experts:
                                     f.close()
                     else:
-                        print("Only one target option for " + sourcepattern_s + " (" + str(len(buffer)) + " instances), no classifier needed",file=sys.stderr)
-
-                buffer = []
+                        log.debug("Only one target option for " + sourcepattern_s + " (" + str(len(buffer)) + " instances), no classifier needed")
+                        metrics.count('singletarget')
+                    if checkpoint:
+                        #the previous source pattern is complete
+                        checkpoint.log(sourcepattern_s)
+                        if checkpoint.due():
+                            state = {}
+                            if args.monolithic:
+                                state['shards'] = [ syncedsize(shardfile) for shardfile in shardfiles ]
+                                state['list'] = syncedsize(f2)
+                            if keywordstore is not None:
+                                state['keywords'] = syncedsize(keywordstore.file)
+                            checkpoint.save(state or None)
+
+                if maxmemory:
+                    buffer.close()
+                    buffer = SpillBuffer(maxmemory, args.tmpdir)
+                else:
+                    buffer = []
                 prevsourcepattern = sourcepattern
                 firsttargetpattern = targetpattern
 
+            span.add(len(featurevectors))
+            progress.update()
             for featurevector, count in featurevectors:
                 buffer.append( (featurestostring(featurevector, model.conf, args.crosslingual, sourcedecoder) + "\t" + targetpattern.tostring(targetdecoder) , count, scorevector[2] ) ) #buffer holds (ine, occurrences, pts)
                 #(model.itemtostring(sourcepattern, targetpattern, featurevector,sourcedecoder, targetdecoder,False,True,False), count,scorevector[2] )  )  #buffer holds (line, occurrences, pts)
@@ -789,13 +1265,20 @@ def main_extractfeatures():
         if prevsourcepattern and firsttargetpattern and prevtargetpattern and firsttargetpattern != prevtargetpattern:
             #only bother if there are at least two distinct target options
             if len(buffer) < args.instancethreshold:
-                print("Omitting " + trainfile + ", only " + str(len(buffer)) + " instances",file=sys.stderr)
+                log.debug("Omitting " + trainfile + ", only " + str(len(buffer)) + " instances")
+                metrics.count('omitted')
             else:
                 sourcepattern_s = prevsourcepattern.tostring(sourcedecoder)
                 trainfile = args.outputdir + "/" + quote_plus(sourcepattern_s) + ".train"
-                print("Writing " + trainfile + " (" + str(len(buffer)) + " instances)",file=sys.stderr)
+                log.debug("Writing " + trainfile + " (" + str(len(buffer)) + " instances)")
+                metrics.count('trainfiles')
+                metrics.count('instances', len(buffer))
                 if args.experts:
                     f = open(trainfile,'w',encoding='utf-8')
+                elif args.monolithic:
+                    f2.write(sourcepattern_s+"\n")
+                    sourcepatternindex.add(sourcepattern_s)
+                    f = shardfiles[shardof(sourcepattern_s, len(shardfiles))]
                 for line, occurrences,pts in buffer:
                     if args.weighbyscore:
                         f.write(line + "\t" + str(occurrences*pts) +  "\n")
@@ -806,11 +1289,27 @@ def main_extractfeatures():
                             f.write(line + "\n")
                 if args.experts:
                     f.close()
+        if maxmemory:
+            buffer.close()
+
+        span.stop()
+        progress.done()
 
         if args.monolithic:
-            f.close()
+            for shardfile in shardfiles:
+                shardfile.close()
             f2.close()
+            with open(args.outputdir + "/sourcepatterns.index",'wb') as f:
+                pickle.dump(sourcepatternindex, f)
+
+        if keywordstore is not None:
+            keywordstore.close()
+            log.info("Keywords of " + str(len(keywordstore)) + " source patterns written to " + keywordstore.filename)
+
+        if checkpoint:
+            checkpoint.remove()
 
+    metrics.close()
 
 
 
@@ -822,21 +1321,33 @@ def main_alignmodel():
     parser.add_argument('-p','--pts',type=float,help="Constrain by minimum probability p(t|s), assumes a moses-style score vector",default=0.0, action='store',required=False)
     parser.add_argument('-P','--pst',type=float,help="Constrain by minimum probability p(s|t), assumes a moses-style score vector", default=0.0,action='store',required=False)
     parser.add_argument('--debug',help="Enabled debug", action='store_true',required=False)
+    parser.add_argument('--export-moses',dest='exportmoses',type=str,help="Export the alignment model as a Moses phrase table (sorted by source phrase) to the specified file rather than viewing it, compressed if the filename ends in .gz or .zst", action='store',required=False)
+    parser.add_argument('--threads',type=int,help="Number of processes to use for --export-moses", action='store',default=1,required=False)
+    parser.add_argument('--chunksize',type=int,help="Number of source patterns per chunk for --export-moses", action='store',default=10000,required=False)
+    addloggingarguments(parser)
+    addmetricsarguments(parser)
     args = parser.parse_args()
+    setuplogging(args)
+    setupmetrics(args, 'colibri-alignmodel')
     #args.storeconst, args.dataset, args.num, args.bar
 
 
-    print("Loading source decoder " + args.sourceclassfile,file=sys.stderr)
+    log.info("Loading source decoder " + args.sourceclassfile)
     sourcedecoder = colibricore.ClassDecoder(args.sourceclassfile)
-    print("Loading target decoder " + args.targetclassfile,file=sys.stderr)
+    log.info("Loading target decoder " + args.targetclassfile)
     targetdecoder = colibricore.ClassDecoder(args.targetclassfile)
-    print("Loading alignment model",file=sys.stderr)
+    log.info("Loading alignment model")
     model = AlignmentModel()
     options = colibricore.PatternModelOptions(debug=args.debug)
-    if options.DEBUG: print("Debug enabled",file=sys.stderr)
+    if options.DEBUG: log.info("Debug enabled")
     sys.stderr.flush()
     model.load(args.inputfile, options)
-    print("Outputting",file=sys.stderr)
+    if args.exportmoses:
+        log.info("Exporting to " + args.exportmoses)
+        model.savemosesphrasetable(args.exportmoses, sourcedecoder, targetdecoder, args.threads, args.chunksize)
+        metrics.close()
+        return
+    log.info("Outputting")
     if args.pts or args.pst:
         scorefilter = lambda scores: scores[2] > args.pts and scores[0] > args.pst
     else:
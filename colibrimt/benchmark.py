@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import argparse
+import sys
+import os
+import json
+import time
+import random
+import datetime
+import subprocess
+import shutil
+import tempfile
+import pickle
+from collections import defaultdict
+from colibrimt.instrumentation import peakrss
+
+
+#################################################################################################################################################3
+# Deterministic synthetic data generation
+#################################################################################################################################################3
+
+def zipfweights(size, exponent=1.0):
+    return [ 1.0 / (rank ** exponent) for rank in range(1, size+1) ]
+
+def generatecorpus(rng, sentences, vocabsize, minlength=5, maxlength=25):
+    """Generates a list of tokenised sentences (lists of word ids), word frequencies follow a Zipfian distribution"""
+    words = list(range(vocabsize))
+    weights = zipfweights(vocabsize)
+    corpus = []
+    for _ in range(sentences):
+        length = rng.randint(minlength, maxlength)
+        corpus.append( rng.choices(words, weights, k=length) )
+    return corpus
+
+def generatelexicon(rng, vocabsize, ambiguity=0.3):
+    """Maps every source word id to one or two target word ids, a fraction (ambiguity) of the source words gets two possible translations, so classifiers have something to choose between"""
+    lexicon = {}
+    for word in range(vocabsize):
+        if rng.random() < ambiguity:
+            lexicon[word] = (word, vocabsize + word)
+        else:
+            lexicon[word] = (word,)
+    return lexicon
+
+def translatecorpus(rng, corpus, lexicon):
+    """Produces a word-by-word (monotone) translation of the corpus, with its word alignments"""
+    target = []
+    alignments = []
+    for sentence in corpus:
+        target.append( [ rng.choice(lexicon[word]) for word in sentence ] )
+        alignments.append( [ (i,i) for i in range(len(sentence)) ] )
+    return target, alignments
+
+def sourceword(i):
+    return "s" + str(i)
+
+def targetword(i):
+    return "t" + str(i)
+
+def extractphrasepairs(sourcecorpus, targetcorpus, maxn=3):
+    """Collects all consistent phrase pairs (given the monotone alignment) up to length maxn, returns joint, source and target counts"""
+    joint = defaultdict(int)
+    sourcecount = defaultdict(int)
+    targetcount = defaultdict(int)
+    for source, target in zip(sourcecorpus, targetcorpus):
+        for n in range(1, maxn+1):
+            for i in range(0, len(source) - n + 1):
+                s = " ".join( sourceword(w) for w in source[i:i+n] )
+                t = " ".join( targetword(w) for w in target[i:i+n] )
+                joint[(s,t)] += 1
+                sourcecount[s] += 1
+                targetcount[t] += 1
+    return joint, sourcecount, targetcount
+
+def writecorpus(filename, corpus, wordformat):
+    with open(filename,'w',encoding='utf-8') as f:
+        for sentence in corpus:
+            f.write(" ".join( wordformat(w) for w in sentence ) + "\n")
+
+def writealignments(filename, alignments):
+    with open(filename,'w',encoding='utf-8') as f:
+        for alignment in alignments:
+            f.write(" ".join( str(i) + "-" + str(j) for i,j in alignment ) + "\n")
+
+def writephrasetable(filename, joint, sourcecount, targetcount):
+    """Writes a Moses-style phrase table (sorted by source), score vector: p(s|t) lex(s|t) p(t|s) lex(t|s), followed by word alignments and counts"""
+    count = 0
+    with open(filename,'w',encoding='utf-8') as f:
+        for (s,t) in sorted(joint):
+            c = joint[(s,t)]
+            pst = c / targetcount[t]
+            pts = c / sourcecount[s]
+            n = s.count(" ") + 1
+            f.write(s + " ||| " + t + " ||| " + " ".join([str(pst), str(pst), str(pts), str(pts)]) + " ||| " + " ".join( str(i) + "-" + str(i) for i in range(n) ) + " ||| " + str(targetcount[t]) + " " + str(sourcecount[s]) + " " + str(c) + "\n")
+            count += 1
+    return count
+
+def generate(workdir, sentences=1000, testsentences=100, vocabsize=1000, maxn=3, seed=1):
+    """Generates a synthetic parallel training corpus, test corpus, word alignments and phrase table in workdir, deterministic for a given seed. Returns a dictionary of the generated files and their sizes."""
+    rng = random.Random(seed)
+    lexicon = generatelexicon(rng, vocabsize)
+    sourcetrain = generatecorpus(rng, sentences, vocabsize)
+    targettrain, alignments = translatecorpus(rng, sourcetrain, lexicon)
+    sourcetest = generatecorpus(rng, testsentences, vocabsize)
+    targettest, _ = translatecorpus(rng, sourcetest, lexicon)
+
+    data = {
+        'sourcetrain': os.path.join(workdir, 'source-train.txt'),
+        'targettrain': os.path.join(workdir, 'target-train.txt'),
+        'alignments': os.path.join(workdir, 'train.align'),
+        'sourcetest': os.path.join(workdir, 'source-test.txt'),
+        'targettest': os.path.join(workdir, 'target-test.txt'),
+        'phrasetable': os.path.join(workdir, 'train.phrasetable'),
+    }
+    writecorpus(data['sourcetrain'], sourcetrain, sourceword)
+    writecorpus(data['targettrain'], targettrain, targetword)
+    writealignments(data['alignments'], alignments)
+    writecorpus(data['sourcetest'], sourcetest, sourceword)
+    writecorpus(data['targettest'], targettest, targetword)
+    data['phrasepairs'] = writephrasetable(data['phrasetable'], *extractphrasepairs(sourcetrain, targettrain, maxn))
+    data['sentences'] = sentences
+    data['testsentences'] = testsentences
+    return data
+
+
+#################################################################################################################################################3
+# Benchmark runner
+#################################################################################################################################################3
+
+def currentrss():
+    """Current resident set size of this process in kilobytes, or None if it can not be determined (no /proc)"""
+    try:
+        with open('/proc/self/statm','r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return None
+
+
+def runisolated(func, *args, **kwargs):
+    """Runs func in a forked child process and returns (result, duration, peak RSS of the child in kB, RSS of the child in kB just before func started). Both are measured in the child, the peak is the high-water mark of the child only and not of any earlier, larger, stage run by the parent. Side effects in memory are lost, side effects on disk are not"""
+    sys.stdout.flush()
+    sys.stderr.flush()
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        baseline = currentrss()
+        try:
+            begintime = time.perf_counter()
+            result = (func(*args, **kwargs), time.perf_counter() - begintime, peakrss(), baseline, None)
+        except BaseException as e: #pylint: disable=broad-except
+            result = (None, 0.0, peakrss(), baseline, repr(e))
+        with os.fdopen(w,'wb') as f:
+            pickle.dump(result, f)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+    os.close(w)
+    try:
+        with os.fdopen(r,'rb') as f:
+            result, duration, peak, baseline, error = pickle.load(f)
+    except EOFError:
+        result, duration, peak, baseline, error = None, 0.0, 0, None, "benchmark process died"
+    finally:
+        os.waitpid(pid, 0)
+    if error:
+        raise RuntimeError("Benchmarked stage failed: " + error)
+    return result, duration, peak, baseline
+
+
+class Benchmark:
+    def __init__(self, only=None, isolate=True):
+        self.only = only
+        self.isolate = isolate and hasattr(os, 'fork') #run every stage in its own process, for a per-stage peak RSS
+        self.results = []
+
+    def run(self, name, func, *args, **kwargs):
+        """Runs func and records its duration, the peak RSS and the throughput. func is expected to return the number of items it processed. Returns the number of items, or None if the benchmark was skipped.
+
+        The stage runs in a forked process (see runisolated()), peak_rss_kb is the peak of that process (including what was already loaded when it started, baseline_rss_kb, both measured in the child) and rss_delta_kb the memory the stage added on top of that. Without isolation, peak_rss_kb is the process-wide high-water mark so far, which may stem from an earlier stage, so no baseline or delta is reported."""
+        if self.only and name not in self.only:
+            return None
+        print("Benchmarking " + name + "...",file=sys.stderr)
+        baseline = None
+        if self.isolate:
+            items, duration, peak, baseline = runisolated(func, *args, **kwargs)
+        else:
+            begintime = time.perf_counter()
+            items = func(*args, **kwargs)
+            duration = time.perf_counter() - begintime
+            peak = peakrss()
+        result = {'name': name, 'seconds': duration, 'peak_rss_kb': peak, 'baseline_rss_kb': baseline, 'rss_delta_kb': max(0, peak - baseline) if baseline is not None else None, 'isolated': self.isolate, 'items': items, 'throughput': items / duration if items and duration > 0 else 0.0}
+        print("\t" + str(round(duration,3)) + "s, " + str(items) + " items, " + str(round(result['throughput'],1)) + " items/s, peak RSS " + str(result['peak_rss_kb']) + " kB" + (" (+" + str(result['rss_delta_kb']) + " kB)" if result['rss_delta_kb'] is not None else ""),file=sys.stderr)
+        self.results.append(result)
+        return items
+
+    def skip(self, name, reason):
+        if self.only and name not in self.only:
+            return
+        print("Skipping benchmark " + name + ": " + reason,file=sys.stderr)
+
+
+def callmain(main, argv):
+    """Calls an entry point in-process with the given command line arguments"""
+    oldargv = sys.argv
+    sys.argv = [ 'colibri-benchmark' ] + argv
+    try:
+        main()
+    finally:
+        sys.argv = oldargv
+
+def countlines(filename):
+    with open(filename,'r',encoding='utf-8') as f:
+        return sum(1 for _ in f)
+
+def gitcommit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def runbenchmarks(workdir, data, maxn=3, only=None, matrexdir=None, isolate=True):
+    import colibricore #pylint: disable=import-error
+    from colibrimt.alignmentmodel import AlignmentModel, Configuration, main_extractfeatures
+    from colibrimt.extractskipgrams import extractskipgrams
+    import colibrimt.native
+
+    benchmark = Benchmark(only, isolate)
+
+    #class encoding and pattern models are a prerequisite for all other stages, not benchmarked themselves
+    print("Encoding corpora and building pattern models",file=sys.stderr)
+    files = {}
+    for side in ('source','target'):
+        classfile = os.path.join(workdir, side + '-train.colibri.cls')
+        corpusfile = os.path.join(workdir, side + '-train.colibri.dat')
+        encoder = colibricore.ClassEncoder()
+        encoder.processcorpus(data[side + 'train'])
+        encoder.buildclasses()
+        encoder.save(classfile)
+        encoder.encodefile(data[side + 'train'], corpusfile)
+        options = colibricore.PatternModelOptions(mintokens=1, maxlength=maxn)
+        model = colibricore.IndexedPatternModel()
+        model.train(corpusfile, options)
+        modelfile = os.path.join(workdir, side + '-train.colibri.indexedpatternmodel')
+        model.write(modelfile)
+        files[side] = (classfile, corpusfile, modelfile)
+
+    sourceencoder = colibricore.ClassEncoder(files['source'][0])
+    targetencoder = colibricore.ClassEncoder(files['target'][0])
+    sourcedecoder = colibricore.ClassDecoder(files['source'][0])
+    targetdecoder = colibricore.ClassDecoder(files['target'][0])
+    options = colibricore.PatternModelOptions(mintokens=1,doreverseindex=False)
+    sourcemodel = colibricore.IndexedPatternModel(files['source'][2], options)
+    targetmodel = colibricore.IndexedPatternModel(files['target'][2], options)
+
+    alignmodelfile = os.path.join(workdir, 'train.colibri.alignmodel')
+    alignmodel = AlignmentModel()
+    def loadphrasetable():
+        alignmodel.loadmosesphrasetable(data['phrasetable'], sourceencoder, targetencoder, quiet=True, native=False)
+        return data['phrasepairs']
+    if benchmark.run('loadmosesphrasetable', loadphrasetable) is None or benchmark.isolate:
+        loadphrasetable() #the later stages need the model in this process
+    alignmodel.save(alignmodelfile)
+
+    def loadphrasetablenative():
+        AlignmentModel().loadmosesphrasetable(data['phrasetable'], sourceencoder, targetencoder, quiet=True, native=True)
+        return data['phrasepairs']
+    if colibrimt.native.available():
+        benchmark.run('loadmosesphrasetable-native', loadphrasetablenative)
+    else:
+        benchmark.skip('loadmosesphrasetable-native', colibrimt.native.EXEC_MOSESPHRASETABLE2ALIGNMODEL + " not found")
+
+    def normalize():
+        model = AlignmentModel(alignmodelfile)
+        model.normalize('s-t-')
+        return model.itemcount()
+    benchmark.run('normalize', normalize)
+
+    def skipgrams():
+        model = AlignmentModel(alignmodelfile)
+        extractskipgrams(model, maxn, 2, workdir, quiet=True)
+        return data['phrasepairs']
+    benchmark.run('extractskipgrams', skipgrams)
+
+    def patternswithindexes():
+        return sum( 1 for _ in alignmodel.patternswithindexes(sourcemodel, targetmodel, sourcedecoder, False) )
+    benchmark.run('patternswithindexes', patternswithindexes)
+
+    def contextfeatures():
+        configurations = [ Configuration(colibricore.IndexedCorpus(files['source'][1]), sourcedecoder, 1, True, 1) ]
+        count = 0
+        for _, _, featurevectors, _ in alignmodel.extractcontextfeatures(sourcemodel, targetmodel, configurations, sourcedecoder, targetdecoder, False, None):
+            count += sum( c for _, c in featurevectors )
+        return count
+    benchmark.run('extractcontextfeatures', contextfeatures)
+
+    classifierdir = os.path.join(workdir, 'classifierdata')
+    def trainfiles():
+        if os.path.isdir(classifierdir):
+            shutil.rmtree(classifierdir)
+        callmain(main_extractfeatures, ['-i', alignmodelfile, '-o', classifierdir, '-s', files['source'][2], '-t', files['target'][2], '-S', files['source'][0], '-T', files['target'][0], '-f', files['source'][1], '-c', files['source'][0], '-l','1','-r','1','-C','-X'])
+        return sum( countlines(os.path.join(classifierdir, f)) for f in os.listdir(classifierdir) if f.endswith('.train') )
+    if benchmark.run('trainingfiles', trainfiles) is None and (not only or 'intermediatephrasetable' in only):
+        trainfiles()
+
+    try:
+        from colibrimt import contextmoses
+    except ImportError as e:
+        benchmark.skip('intermediatephrasetable', str(e))
+    else:
+        decodedir = os.path.join(workdir, 'decode')
+        def intermediatephrasetable():
+            if not os.path.isdir(decodedir):
+                os.mkdir(decodedir)
+            cwd = os.getcwd()
+            os.chdir(workdir) #contextmoses writes the encoded test corpus to the current directory
+            try:
+                callmain(contextmoses.main, ['-f', data['sourcetest'], '-S', files['source'][0], '-T', files['target'][0], '-a', alignmodelfile, '-w', classifierdir, '--decodedir', decodedir, '-I', '--skipdecoder'])
+            finally:
+                os.chdir(cwd)
+            return countlines(os.path.join(decodedir, 'phrase-table'))
+        benchmark.run('intermediatephrasetable', intermediatephrasetable)
+
+    if matrexdir:
+        from colibrimt.evaluation import initevaluate, mtscore
+        def evaluate():
+            out = os.path.join(workdir, 'output.txt')
+            shutil.copyfile(data['targettest'], out) #the evaluation scripts' speed does not depend on the output quality
+            matrexsrcfile, matrextgtfile, matrexoutfile = initevaluate(data['sourcetest'], data['targettest'], out, matrexdir)
+            mtscore(matrexdir, matrexsrcfile, matrextgtfile, matrexoutfile, os.path.join(workdir, 'output'))
+            return data['testsentences']
+        benchmark.run('mtscore', evaluate)
+    else:
+        benchmark.skip('mtscore', "no --matrexdir specified")
+
+    return benchmark.results
+
+
+def compare(results, baselinefile):
+    """Prints the relative difference in time and peak RSS against a previous benchmark result file"""
+    with open(baselinefile,'r',encoding='utf-8') as f:
+        baseline = { r['name']: r for r in json.load(f)['benchmarks'] }
+    print("BENCHMARK\tSECONDS\tBASELINE\tRATIO\tPEAK_RSS_KB\tBASELINE\tRATIO")
+    for result in results:
+        if result['name'] in baseline:
+            old = baseline[result['name']]
+            print("\t".join([ result['name'], str(round(result['seconds'],3)), str(round(old['seconds'],3)), str(round(result['seconds'] / old['seconds'],3)) if old['seconds'] else "-", str(result['peak_rss_kb']), str(old['peak_rss_kb']), str(round(result['peak_rss_kb'] / old['peak_rss_kb'],3)) if old['peak_rss_kb'] else "-" ]))
+        else:
+            print(result['name'] + "\t" + str(round(result['seconds'],3)) + "\t(new)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the colibri-mt stages on deterministic synthetic data", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-o','--outputfile',type=str,help="JSON file to write the benchmark results to", action='store',default="benchmark.json")
+    parser.add_argument('-n','--sentences',type=int,help="Number of sentence pairs in the synthetic training corpus", action='store',default=1000)
+    parser.add_argument('--testsentences',type=int,help="Number of sentences in the synthetic test corpus", action='store',default=100)
+    parser.add_argument('-V','--vocabulary',type=int,help="Vocabulary size of the synthetic data", action='store',default=1000)
+    parser.add_argument('-l','--maxlength',type=int,help="Maximum phrase length", action='store',default=3)
+    parser.add_argument('--seed',type=int,help="Random seed for data generation", action='store',default=1)
+    parser.add_argument('-W','--workdir',type=str,help="Work directory for the generated data (a temporary directory is used and removed if not specified)", action='store',default="")
+    parser.add_argument('-b','--benchmark',type=str,help="Only run the specified benchmark (may be specified multiple times): loadmosesphrasetable, normalize, extractskipgrams, patternswithindexes, extractcontextfeatures, trainingfiles, intermediatephrasetable, mtscore", action='append',default=None)
+    parser.add_argument('--matrexdir',type=str,help="Path to Matrex evaluation scripts (enables the mtscore benchmark)", action='store',default="")
+    parser.add_argument('--compare',type=str,help="Compare against an earlier benchmark result file", action='store',default="")
+    parser.add_argument('--noisolate',help="Run all stages in the same process rather than each in a forked process; peak RSS is then the process-wide high-water mark, which later stages inherit from the largest earlier one", action='store_true',default=False)
+    parser.add_argument('--generateonly',help="Only generate the synthetic data (requires -W)", action='store_true',default=False)
+    args = parser.parse_args()
+
+    if args.generateonly and not args.workdir:
+        print("--generateonly requires a work directory (-W)",file=sys.stderr)
+        sys.exit(2)
+
+    if args.workdir:
+        workdir = os.path.abspath(args.workdir)
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="colibri-benchmark-")
+
+    try:
+        print("Generating synthetic data in " + workdir,file=sys.stderr)
+        data = generate(workdir, args.sentences, args.testsentences, args.vocabulary, args.maxlength, args.seed)
+        print("\t" + str(data['phrasepairs']) + " phrase pairs",file=sys.stderr)
+        if args.generateonly:
+            return
+
+        results = runbenchmarks(workdir, data, args.maxlength, args.benchmark, args.matrexdir, not args.noisolate)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = {
+        'commit': gitcommit(),
+        'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'python': sys.version.split()[0],
+        'parameters': {'sentences': args.sentences, 'testsentences': args.testsentences, 'vocabulary': args.vocabulary, 'maxlength': args.maxlength, 'seed': args.seed},
+        'benchmarks': results,
+    }
+    with open(args.outputfile,'w',encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print("Results written to " + args.outputfile,file=sys.stderr)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
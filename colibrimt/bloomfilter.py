@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import math
+
+#Compact probabilistic set membership on strings: no false negatives, a configurable rate of false positives. Used to
+#reject phrase-table lines cheaply, on the raw phrase string, before any parsing or pattern encoding takes place.
+#Python's built-in string hash is used, so a filter is only valid within the process that built it.
+
+class BloomFilter:
+    def __init__(self, capacity, errorrate=0.01):
+        """Create an empty filter sized for capacity items with the given false positive rate"""
+        capacity = max(1,capacity)
+        self.size = max(64, int(math.ceil(-capacity * math.log(errorrate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round((self.size / capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, s):
+        #double hashing: derive all bit positions from a single hash value
+        h = hash(s)
+        h1 = h & 0xFFFFFFFF
+        h2 = ((h >> 32) & 0xFFFFFFFF) | 1
+        size = self.size
+        return [ (h1 + i * h2) % size for i in range(self.hashes) ]
+
+    def add(self, s):
+        bits = self.bits
+        for p in self.positions(s):
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, s):
+        bits = self.bits
+        for p in self.positions(s):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def memory(self):
+        """Memory used by the bit array, in bytes"""
+        return len(self.bits)
+
+    @staticmethod
+    def frommodel(model, classdecoder, errorrate=0.01):
+        """Build a filter over the string representations of all patterns in a pattern model (or any iterable of patterns)"""
+        bloom = BloomFilter(len(model), errorrate)
+        for pattern in model:
+            bloom.add(pattern.tostring(classdecoder))
+        return bloom
+
+
+def rejectline(line, delimiter, firstbloom=None, secondbloom=None):
+    """Cheap rejection of a phrase-table line on its raw strings, before splitting and parsing the full line: True if the first (second) phrase is certainly not in firstbloom (secondbloom). Lines without two delimiters are never rejected"""
+    first = line.find(delimiter)
+    if first == -1:
+        return False
+    second = line.find(delimiter, first + len(delimiter))
+    if second == -1:
+        return False
+    return (firstbloom is not None and line[:first].strip() not in firstbloom) or (secondbloom is not None and line[first+len(delimiter):second].strip() not in secondbloom)
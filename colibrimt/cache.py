@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import sys
+import json
+import time
+import shutil
+import fnmatch
+import hashlib
+import tempfile
+import argparse
+import subprocess
+from colibrimt.logger import log, addloggingarguments, setuplogging
+
+#Content-addressed cache for the artifacts of pipeline stages. The key of a stage is derived from the digests of its
+#input files and from its parameters (typically the full command line), so a stage is only reused if neither its inputs
+#nor its parameters changed. Artifacts (files or directories) are stored under their key in the cache directory, the
+#least recently used entries are evicted once the cache exceeds its maximum size.
+
+CACHEDIR = os.environ.get('COLIBRIMT_CACHE', os.path.join(os.path.expanduser("~"), ".cache", "colibri-mt"))
+MAXSIZE = int(os.environ.get('COLIBRIMT_CACHESIZE', 20 * 1024 ** 3)) #bytes
+
+_digests = {} #(path, size, mtime) => digest, so unchanged files are hashed only once per process
+
+
+def filedigest(path):
+    """SHA-256 digest of the contents of a file, or of all files (and their relative paths) in a directory"""
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+        h = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for filename in sorted(files):
+                filepath = os.path.join(root, filename)
+                h.update((os.path.relpath(filepath, path) + "\t" + filedigest(filepath) + "\n").encode('utf-8'))
+        return h.hexdigest()
+    st = os.stat(path)
+    memokey = (path, st.st_size, st.st_mtime_ns)
+    if memokey not in _digests:
+        h = hashlib.sha256()
+        with open(path,'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b""):
+                h.update(block)
+        _digests[memokey] = h.hexdigest()
+    return _digests[memokey]
+
+
+def stagekey(stage, inputs=(), params=None):
+    """Cache key of a stage given its input files and its parameters (any JSON-serialisable value)"""
+    h = hashlib.sha256()
+    h.update(stage.encode('utf-8') + b"\n")
+    h.update(json.dumps(params, sort_keys=True).encode('utf-8') + b"\n")
+    for inputfile in inputs:
+        if not os.path.exists(inputfile):
+            raise IOError("Input file of stage " + stage + " does not exist: " + inputfile)
+        h.update(filedigest(inputfile).encode('utf-8') + b"\n")
+    return h.hexdigest()
+
+
+def stampfile(outputfile):
+    outputfile = outputfile.rstrip("/")
+    return os.path.join(os.path.dirname(outputfile), "." + os.path.basename(outputfile) + ".cachekey")
+
+
+def uptodate(key, outputs):
+    """Were the outputs produced (or restored) by the stage with this key? Checked using a stamp file written next to each output"""
+    for outputfile in outputs:
+        if not os.path.exists(outputfile) or not os.path.exists(stampfile(outputfile)):
+            return False
+        with open(stampfile(outputfile),'r') as f:
+            if f.read().strip() != key:
+                return False
+    return True
+
+
+def stamp(key, outputs):
+    for outputfile in outputs:
+        with open(stampfile(outputfile),'w') as f:
+            f.write(key + "\n")
+
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+
+def excluded(name, exclude):
+    return any( fnmatch.fnmatch(name, pattern) for pattern in exclude )
+
+
+def copy(source, target, exclude=()):
+    """Copy a file or directory, replacing the target. Entries directly under a directory whose name matches one of the exclude patterns (shell wildcards) are neither copied nor removed from the target: they are the outputs of later stages"""
+    if not os.path.isdir(source):
+        remove(target)
+        shutil.copy2(source, target)
+        return
+    if os.path.isdir(target) and not os.path.islink(target):
+        for name in os.listdir(target):
+            if not excluded(name, exclude):
+                remove(os.path.join(target, name))
+    else:
+        remove(target)
+        os.makedirs(target)
+    for name in os.listdir(source):
+        if not excluded(name, exclude):
+            if os.path.isdir(os.path.join(source, name)):
+                shutil.copytree(os.path.join(source, name), os.path.join(target, name), symlinks=False)
+            else:
+                shutil.copy2(os.path.join(source, name), os.path.join(target, name))
+
+
+def disksize(path):
+    if os.path.isdir(path):
+        return sum( os.path.getsize(os.path.join(root, filename)) for root, _, files in os.walk(path) for filename in files )
+    return os.path.getsize(path)
+
+
+class ArtifactCache:
+    def __init__(self, cachedir=None, maxsize=None):
+        self.cachedir = cachedir if cachedir else CACHEDIR
+        self.maxsize = maxsize if maxsize is not None else MAXSIZE
+        os.makedirs(os.path.join(self.cachedir, "objects"), exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.cachedir, "objects", key[:2], key)
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self.path(key), "manifest.json"))
+
+    def restore(self, key, outputs, exclude=()):
+        """Restore the artifacts of the given key to the output paths, returns False if the key is not in the cache. Entries of output directories matching the exclude patterns are kept"""
+        if key not in self:
+            return False
+        entry = self.path(key)
+        with open(os.path.join(entry, "manifest.json"),'r') as f:
+            manifest = json.load(f)
+        if len(manifest['outputs']) != len(outputs):
+            log.warning("Cache entry " + key + " has " + str(len(manifest['outputs'])) + " artifacts, expected " + str(len(outputs)) + ", ignoring")
+            return False
+        for i, outputfile in enumerate(outputs):
+            copy(os.path.join(entry, str(i)), outputfile, exclude)
+        os.utime(os.path.join(entry, "manifest.json")) #last access, for eviction
+        stamp(key, outputs)
+        log.info("Restored " + " ".join(outputs) + " from cache (" + key[:12] + ")")
+        return True
+
+    def store(self, key, outputs, stage="", exclude=()):
+        """Store the artifacts (files or directories) under the given key. Entries of output directories matching the exclude patterns are not stored"""
+        for outputfile in outputs:
+            if not os.path.exists(outputfile):
+                raise IOError("Output file was not produced, can not cache: " + outputfile)
+        entry = self.path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+        try:
+            size = 0
+            for i, outputfile in enumerate(outputs):
+                copy(outputfile, os.path.join(tmpdir, str(i)), exclude)
+                size += disksize(os.path.join(tmpdir, str(i)))
+            with open(os.path.join(tmpdir, "manifest.json"),'w') as f:
+                json.dump({'stage': stage, 'outputs': [ os.path.abspath(x) for x in outputs ], 'size': size, 'created': time.time()}, f)
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpdir, entry) #atomic, concurrent readers never see a partial entry
+        except Exception:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            raise
+        stamp(key, outputs)
+        self.evict()
+
+    def entries(self):
+        """Returns (last access time, size, path) for all entries"""
+        entries = []
+        objects = os.path.join(self.cachedir, "objects")
+        for prefix in os.listdir(objects):
+            for key in os.listdir(os.path.join(objects, prefix)):
+                manifestfile = os.path.join(objects, prefix, key, "manifest.json")
+                if key.startswith(".tmp-") or not os.path.exists(manifestfile):
+                    continue
+                with open(manifestfile,'r') as f:
+                    size = json.load(f)['size']
+                entries.append( (os.path.getmtime(manifestfile), size, os.path.join(objects, prefix, key)) )
+        return entries
+
+    def size(self):
+        return sum( size for _, size, _ in self.entries() )
+
+    def evict(self, maxsize=None):
+        """Remove the least recently used entries until the cache fits in maxsize bytes, returns the number of entries removed"""
+        if maxsize is None: maxsize = self.maxsize
+        entries = sorted(self.entries())
+        total = sum( size for _, size, _ in entries )
+        removed = 0
+        for _, size, path in entries:
+            if total <= maxsize:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            log.info("Evicted " + str(removed) + " entries from the cache")
+        return removed
+
+    def run(self, stage, outputs, func, inputs=(), params=None, exclude=()):
+        """Run a stage through the cache: if the outputs are up to date nothing is done, if the key is cached the outputs are restored, otherwise func() is called and its outputs are stored. Returns 'uptodate', 'cached' or the return value of func.
+
+        If an output directory also holds the outputs of later stages (in subdirectories), these should match one of the exclude patterns, so they are neither stored with this stage nor removed when it is restored"""
+        key = stagekey(stage, inputs, params)
+        if uptodate(key, outputs):
+            log.info("Skipping " + stage + ", outputs are up to date")
+            return 'uptodate'
+        if self.restore(key, outputs, exclude):
+            return 'cached'
+        result = func()
+        if result is not False:
+            self.store(key, outputs, stage, exclude)
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Content-addressed cache for colibri-mt pipeline stages. Run a command only if its inputs or parameters changed, otherwise restore its outputs from the cache.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--cachedir',type=str,help="Cache directory (or set COLIBRIMT_CACHE)", action='store',default=CACHEDIR)
+    parser.add_argument('--maxsize',type=int,help="Maximum cache size in bytes (or set COLIBRIMT_CACHESIZE)", action='store',default=MAXSIZE)
+    addloggingarguments(parser)
+    subparsers = parser.add_subparsers(dest='action')
+    runparser = subparsers.add_parser('run', help="Run a command through the cache: colibri-cache run -s stage -i input -o output -- command")
+    runparser.add_argument('-s','--stage',type=str,help="Stage name", action='store',required=True)
+    runparser.add_argument('-i','--input',type=str,help="Input file or directory (may be specified multiple times)", action='append',default=[])
+    runparser.add_argument('-o','--output',type=str,help="Output file or directory (may be specified multiple times)", action='append',required=True)
+    runparser.add_argument('-x','--exclude',type=str,help="Do not store or replace entries of an output directory matching this pattern (shell wildcards), for subdirectories holding the outputs of later stages (may be specified multiple times)", action='append',default=[])
+    runparser.add_argument('-p','--param',type=str,help="Extra parameter (key=value) that affects the output but is not part of the command (may be specified multiple times)", action='append',default=[])
+    runparser.add_argument('command',nargs=argparse.REMAINDER,help="Command to run (through the shell), the command line is part of the key")
+    subparsers.add_parser('stats', help="Show the number of entries and total size")
+    subparsers.add_parser('evict', help="Evict least recently used entries until the cache fits in its maximum size")
+    subparsers.add_parser('clear', help="Remove all entries")
+    args = parser.parse_args()
+    setuplogging(args)
+
+    cache = ArtifactCache(args.cachedir, args.maxsize)
+    if args.action == 'run':
+        command = args.command[1:] if args.command and args.command[0] == '--' else args.command
+        if not command:
+            parser.error("No command specified")
+        command = " ".join(command)
+        params = {'command': command, 'params': sorted(args.param)}
+        def func():
+            log.info("Running " + args.stage + ": " + command)
+            r = subprocess.call(command, shell=True)
+            if r != 0:
+                log.error("Stage " + args.stage + " failed with exit code " + str(r))
+                sys.exit(r)
+            return True
+        cache.run(args.stage, args.output, func, args.input, params, args.exclude)
+    elif args.action == 'stats':
+        entries = cache.entries()
+        print("entries\t" + str(len(entries)))
+        print("size\t" + str(sum( size for _, size, _ in entries )))
+        print("maxsize\t" + str(cache.maxsize))
+    elif args.action == 'evict':
+        cache.evict()
+    elif args.action == 'clear':
+        cache.evict(0)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import time
+import pickle
+from colibrimt.instrumentation import metrics
+from colibrimt.logger import log
+
+#Checkpoints for long-running jobs (colibri-extractskipgrams, colibri-extractfeatures). Progress is appended to a journal
+#(filename.journal) as the job goes; periodically the journal is synced and a small state file (filename) is atomically
+#replaced, recording how much of the journal is valid, plus job-specific state such as the sizes of output files written so
+#far. On --resume, only the journal up to the recorded offset is trusted, so a job killed at any point resumes from its
+#last checkpoint. The cost of a checkpoint is a sync of the journal, independent of the amount of work done so far.
+#Checkpointing is opt-in (--checkpointinterval, or --resume), jobs run without it by default.
+
+INTERVAL = 600 #seconds, used when resuming without an explicit interval
+
+
+def filekey(filename):
+    """Identifies an input file for the key of a checkpoint: its absolute path, size and modification time, so a checkpoint is not resumed after the input changed (None for no file)"""
+    if not filename:
+        return None
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+
+
+class Checkpoint:
+    def __init__(self, filename, key, interval=INTERVAL):
+        """The key identifies the job (input files and parameters), a checkpoint of a job with a different key is never resumed"""
+        self.filename = filename
+        self.key = key
+        self.interval = interval
+        self.journal = None
+        self.lastsave = time.time()
+
+    def resume(self):
+        """Returns (state, journal entries) of the last checkpoint, or None if there is none. The journal is truncated to the last checkpoint"""
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename,'rb') as f:
+            checkpoint = pickle.load(f)
+        if checkpoint['key'] != self.key:
+            raise ValueError("Checkpoint " + self.filename + " belongs to a different job (other input or parameters), remove it or run without --resume")
+        entries = []
+        if os.path.exists(self.filename + ".journal"):
+            with open(self.filename + ".journal",'r+b') as f:
+                while f.tell() < checkpoint['journaloffset']:
+                    entries.append(pickle.load(f))
+                f.truncate(checkpoint['journaloffset'])
+        log.info("Resuming from checkpoint " + self.filename + " (" + str(len(entries)) + " journal entries, saved " + time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(checkpoint['time'])) + ")")
+        return checkpoint['state'], entries
+
+    def start(self, resume=False):
+        """Open the journal, appending to it when resuming. When not resuming, any earlier checkpoint is discarded"""
+        if not resume and os.path.exists(self.filename):
+            os.unlink(self.filename)
+        self.journal = open(self.filename + ".journal", 'ab' if resume else 'wb')
+        self.lastsave = time.time()
+
+    def log(self, entry):
+        pickle.dump(entry, self.journal, pickle.HIGHEST_PROTOCOL)
+
+    def due(self):
+        return time.time() - self.lastsave >= self.interval
+
+    def save(self, state=None):
+        """Write a checkpoint: everything logged so far plus the given state (any picklable object)"""
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        tmpfile = self.filename + ".tmp"
+        with open(tmpfile,'wb') as f:
+            pickle.dump({'key': self.key, 'journaloffset': self.journal.tell(), 'state': state, 'time': time.time()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpfile, self.filename) #atomic
+        self.lastsave = time.time()
+        metrics.count('checkpoints')
+        log.debug("Checkpoint written to " + self.filename)
+
+    def remove(self):
+        """Remove the checkpoint once the job has completed"""
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+        for filename in (self.filename, self.filename + ".journal", self.filename + ".tmp"):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+def syncedsize(f):
+    """Flush and sync an output file opened for writing, returns its size (the offset to truncate to on resume)"""
+    f.flush()
+    os.fsync(f.fileno())
+    return f.tell()
+
+
+def truncate(filename, size):
+    """Truncate an output file to the size recorded in a checkpoint, discarding anything written after it"""
+    with open(filename,'r+b') as f:
+        f.truncate(size)
@@ -7,23 +7,30 @@ import sys
 import os
 import glob
 from colibricore import IndexedCorpus, ClassEncoder, ClassDecoder, IndexedPatternModel,  PatternModelOptions, BOUNDARYPATTERN #pylint: disable=import-error
-from colibrimt.alignmentmodel import AlignmentModel, Configuration
+from colibrimt.alignmentmodel import AlignmentModel, Configuration, shardof, shardprefix, loadsourcepatternindex
+from colibrimt.filter import loadfiltered
+from colibrimt.ib1 import IB1Classifier, EXTENSION as IB1EXTENSION
+from colibrimt.keywordstore import KeywordStore, FILENAME as KEYWORDSTORE, BITSETPREFIX, bitset
+import colibrimt.oracle
+from colibrimt.instrumentation import metrics, addmetricsarguments, setupmetrics
+from colibrimt.logger import log, debugging, Progress, addloggingarguments, setuplogging
 import timbl
 import pickle
 import shutil
 import subprocess
 import itertools
+import multiprocessing
 from pynlpl.formats.moses import PhraseTable
 from urllib.parse import quote_plus, unquote_plus
 import xmlrpc.client
 import time
 import socket
 
-def extractcontextfeatures(classifierconf, pattern, sentence, token):
-    #For TEST corpus!!
+def extractcontextfeatures(classifierconf, pattern, sentence, token, keywords=()):
+    #For TEST corpus!! keywords are the keywords of the pattern (from the keyword store), if the classifiers use keyword features
     featurevector = []
     n = len(pattern)
-    for configuration in classifierconf['featureconf']:
+    for k, configuration in enumerate(classifierconf['featureconf']):
         factoredcorpus,classdecoder, leftcontext, focus, rightcontext = (configuration.corpus, configuration.classdecoder, configuration.leftcontext, configuration.focus, configuration.rightcontext)
         sentencelength = factoredcorpus.sentencelength(sentence)
         assert sentencelength > 0
@@ -47,7 +54,12 @@ def extractcontextfeatures(classifierconf, pattern, sentence, token):
             if len(unigram) != 1:
                 raise Exception("Unigram (" + str(sentence) + "," + str(i) + "), has invalid length " + str(len(unigram)))
             featurevector.append(unigram.tostring(classdecoder))
-        #TODO: process keywords
+        if k in classifierconf.get('keywords',()):
+            bits = bitset(keywords, ( factoredcorpus[(sentence,i)].tostring(classdecoder) for i in range(sentencelength) )) if keywords else 0
+            if classifierconf.get('sparsekeywords'):
+                featurevector.append(BITSETPREFIX + format(bits, 'x'))
+            else:
+                featurevector += [ keyword + "=" + str((bits >> j) & 1) for j, keyword in enumerate(keywords) ]
     return featurevector
 
 def gettimbloptions(args, classifierconf):
@@ -56,6 +68,73 @@ def gettimbloptions(args, classifierconf):
         timbloptions += " -s"
     return timbloptions
 
+def getclassifier(args, fileprefix, timbloptions):
+    """Returns a Timbl classifier or, with --backend numpy, the equivalent IB1Classifier (same interface)"""
+    if args.backend == 'numpy':
+        return IB1Classifier(fileprefix, timbloptions)
+    return timbl.TimblClassifier(fileprefix, timbloptions)
+
+def ibaseextension(args):
+    return IB1EXTENSION if args.backend == 'numpy' else ".ibase"
+
+class Result:
+    """Result of a job run in the current process, same interface as the AsyncResult of a pool job"""
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+_preparestate = {} #alignment model for the pattern model jobs, inherited by forked workers
+
+def encodefactor(i, inputfile, trainclassfile, devinputfile=None):
+    """Extend the class encoder of a factor with the test (and development) corpus and encode it, returns (classfile, corpusfile)"""
+    log.info("Processing factor #" + str(i))
+    corpusfile = os.path.basename(inputfile).replace('.txt','') + '.colibri.dat'
+    classfile = os.path.basename(inputfile).replace('.txt','') + '.colibri.cls'
+    log.info("Loading and extending source class encoder, from " + trainclassfile + " to " + classfile)
+    encoder = ClassEncoder(trainclassfile)
+    encoder.processcorpus(inputfile)
+    if devinputfile:
+        log.info("(including development corpus in extended class encoder)")
+        encoder.processcorpus(devinputfile)
+    encoder.buildclasses()
+    encoder.save(classfile)
+    log.info("Encoding test corpus, from " + inputfile + " to " + corpusfile)
+    encoder.encodefile(inputfile, corpusfile)
+    if devinputfile:
+        log.info("Encoding development corpus, from " + devinputfile + " to " + devinputfile + '.colibri.dat')
+        encoder.encodefile(devinputfile, devinputfile + '.colibri.dat')
+    return classfile, corpusfile
+
+def trainpatternmodel(corpus, outputfile, returnmodel=True):
+    """Train a pattern model on an encoded corpus (IndexedCorpus or filename), constrained by the alignment model, and write it. Returns the model, or None if returnmodel is False (in a worker process, the caller loads it from the output file)"""
+    options = PatternModelOptions(mintokens=1, maxlength=12, debug=True)
+    model = IndexedPatternModel(reverseindex=corpus if isinstance(corpus, IndexedCorpus) else IndexedCorpus(corpus))
+    model.train( "", options, _preparestate['alignmodel'])
+    model.write(outputfile)
+    return model if returnmodel else None
+
+def loadpatternmodel(model, filename, corpus):
+    if model is None:
+        model = IndexedPatternModel(filename, PatternModelOptions(mintokens=1, maxlength=12), None, corpus)
+    return model
+
+def trainshard(args, trainfile, timbloptions):
+    """Train a single shard of the monolithic classifier (trainfile is the file prefix), run in a worker process"""
+    if args.classifierdir:
+        #ugly hack since we want ibases in a different location
+        trainfilecopy = trainfile.replace(args.workdir, args.classifierdir)
+        shutil.copyfile(trainfile+".train", trainfilecopy+".train")
+        trainfile = trainfilecopy
+    classifier = getclassifier(args, trainfile, timbloptions)
+    classifier.train()
+    classifier.save()
+    if args.classifierdir:
+        #remove copy
+        os.unlink(trainfile+".train")
+    return trainfile
+
 EXEC_MOSES = "moses"
 
 def main():
@@ -65,6 +144,8 @@ def main():
     parser.add_argument('-S','--sourceclassfile', type=str, help="Source class file", action='store',required=True)
     parser.add_argument('-T','--targetclassfile', type=str, help="Target class file", action='store',required=True)
     parser.add_argument('-a','--alignmodelfile', type=str,help="Colibri alignment model (made from phrase translation table)", action='store',default="",required=False)
+    parser.add_argument('--filter', help="Filter the alignment model given the test (and development) input before loading it, the filtered model is cached in the work directory per test set", action="store_true", default=False)
+    parser.add_argument('--filtermaxlength', type=int, help="Maximum pattern length to consider when filtering (use with --filter)", action="store", default=8)
     parser.add_argument('-w','--workdir', type=str,help="Working directory, should contain classifier training files", action='store',default="",required=True)
     parser.add_argument('--train', help="Train classifiers", action="store_true", default=False)
     #parser.add_argument('-O','--timbloptions', type=str, help="Options for the Timbl classifier", action="store", default="-a 0 -k 1")
@@ -73,13 +154,18 @@ def main():
     parser.add_argument('--tw', type=str, help="Timbl weighting", action="store", default="gr")
     parser.add_argument('--tm', type=str, help="Timbl feature metrics", action="store", default="O")
     parser.add_argument('--td', type=str, help="Timbl distance metric", action="store", default="Z")
+    parser.add_argument('--backend', type=str, help="Classifier backend: timbl, or numpy for a vectorised IB1 implementation that classifies all occurrences of a pattern in one batch (supports -a 0, -m O, -d Z and gr/ig/nw weighting). Classifiers must be trained and tested with the same backend", action="store", choices=('timbl','numpy'), default="timbl")
+    parser.add_argument('--oracle', help="Before training, analyse the training data of all experts and only train (and later query) those that are worth it, the decisions are written to " + colibrimt.oracle.INDEXFILE + " in the classifier directory and are consulted at test time", action="store_true", default=False)
+    parser.add_argument('--oraclemajority', type=float, help="Expert oracle: skip experts whose most frequent translation has at least this share of the training instances and whose leave-one-out predictions also agree with the phrase-table argmax on at least this share (0 = disabled)", action="store", default=0)
+    parser.add_argument('--oracleagreement', type=float, help="Expert oracle: skip experts whose leave-one-out predictions agree with the phrase-table argmax p(t|s) on at least this share of the training instances (1.0: only skip experts that never override the phrase table)", action="store", default=1.0)
+    parser.add_argument('--oraclesample', type=int, help="Expert oracle: leave-one-out classification takes time quadratic in the number of instances, estimate the agreement of larger experts on a random sample of this many instances (0 = use all instances)", action="store", default=colibrimt.oracle.MAXINSTANCES)
     parser.add_argument('-I','--ignoreclassifier', help="Ignore classifier (for testing bypass method)", action="store_true", default=False)
     parser.add_argument('-H','--scorehandling', type=str, help="Score handling, can be 'append' (default), 'replace', or 'weighed'", action="store", default="append")
     parser.add_argument('--mosesinclusive',help="Pass full sentences through through Moses server using XML input (will start a moses server, requires --moseslm). Classifier output competes with normal translation table. Score handling (-H) has no effect as only the classifier score will be passed.", action='store_true',default=False)
     parser.add_argument('--mosesexclusive',help="Pass full sentences through through Moses server using XML input (will start a moses server, requires --moseslm). Classifier does NOT compete with normal translation table. Score handling (-H) has no effect as only the classifier score will be passed.", action='store_true',default=False)
     parser.add_argument('--mosesdir', type=str,help='Path to Moses directory (required for MERT)', default="")
     parser.add_argument('--mert', type=int,help="Do MERT parameter tuning, set to number of MERT runs to perform", required=False, default=0)
-    parser.add_argument('--threads', type=int, default=1, help="Number of threads to use for Moses or Mert")
+    parser.add_argument('--threads', type=int, default=1, help="Number of threads to use for Moses or Mert, and the number of processes for preparing the test data (encoding the factors and building the pattern models) and for training the shards of a monolithic classifier")
     parser.add_argument('--reordering', type=str,action="store",help="Reordering type (use with --reorderingtable)", required=False)
     parser.add_argument('--reorderingtable', type=str,action="store",help="Use reordering table (use with --reordering)", required=False)
     parser.add_argument('--ref', type=str,action="store",help="Reference corpus (target corpus, plain text)", required=False)
@@ -96,11 +182,15 @@ def main():
     parser.add_argument('--skipdecoder',action="store_true",default=False)
     parser.add_argument('--ignoreerrors',action="store_true",help="Attempt to ignore errors",default=False)
     parser.add_argument('--mosesport',type=int, help="Port for Moses server (will be started for you), if -Z is enabled",action='store',default=8080)
+    addmetricsarguments(parser)
+    addloggingarguments(parser)
     args = parser.parse_args()
+    setuplogging(args)
+    setupmetrics(args, 'colibri-contextmoses')
     #args.storeconst, args.dataset, args.num, args.bar
 
     if not os.path.isdir(args.workdir) or not os.path.exists(args.workdir + '/classifier.conf'):
-        print("Work directory " + args.workdir + " or classifier configuration therein does not exist. Did you extract features and create classifier training files using colibri-extractfeatures?" ,file=sys.stderr)
+        log.error("Work directory " + args.workdir + " or classifier configuration therein does not exist. Did you extract features and create classifier training files using colibri-extractfeatures?")
         sys.exit(2)
 
     if args.classifierdir:
@@ -115,10 +205,10 @@ def main():
 
 
     if args.mert and not args.mosesdir:
-        print("--mert requires --mosesdir to be set",file=sys.stderr)
+        log.error("--mert requires --mosesdir to be set")
         sys.exit(2)
     if args.mert and not args.ref:
-        print("--mert requires --ref to be set",file=sys.stderr)
+        log.error("--mert requires --ref to be set")
         sys.exit(2)
 
     if args.decodedir:
@@ -131,12 +221,12 @@ def main():
     elif decodedir and decodedir[0] != '/':
         decodedir = os.getcwd() + '/' + decodedir
 
-    print("Loading configuration (training corpora and class decoders)",file=sys.stderr)
+    log.info("Loading configuration (training corpora and class decoders)")
     f = open(args.workdir + '/classifier.conf','rb')
     classifierconf = pickle.load(f)
     f.close()
 
-    print("Configuration: ", classifierconf,file=sys.stderr)
+    log.debug("Configuration: %s", classifierconf)
 
 
     if args.inputfile:
@@ -149,140 +239,174 @@ def main():
 
 
 
-    if args.inputfile:
-        l = []
-        for i, (inputfile, conf) in enumerate(zip(args.inputfile, classifierconf['featureconf'])):
-            trainclassfile = conf['classdecoder']
-            print("Processing factor #" + str(i),file=sys.stderr)
-            #process inputfile
-            corpusfile =   os.path.basename(inputfile).replace('.txt','') + '.colibri.dat'
-            classfile = os.path.basename(inputfile).replace('.txt','') + '.colibri.cls'
-
-            #if os.path.exists(corpusfiles[i]) and os.path.exists(classfiles[i]):
-            #    print("Notice: Re-using previously generated corpusfile and classfile",file=sys.stderr)
-            #    print("Loading source class encoder and decoder",file=sys.stderr)
-            #    sourceencoders.append( ClassEncoder(classfiles[i]) )
-            #    sourcedecoders.append( ClassDecoder(classfiles[i]) )
-            #else:
-            print("Loading and extending source class encoder, from " + trainclassfile + " to " + classfile,file=sys.stderr)
-            sourceencoders.append( ClassEncoder(trainclassfile) )
-            sourceencoders[i].processcorpus(inputfile)
-            if i == 0 and args.devinputfile:
-                print("(including development corpus in extended class encoder)",file=sys.stderr)
-                sourceencoders[i].processcorpus(args.devinputfile)
-            sourceencoders[i].buildclasses()
-            sourceencoders[i].save(classfile)
-            print("Encoding test corpus, from " + inputfile + " to " + corpusfile,file=sys.stderr)
-            sourceencoders[i].encodefile(inputfile, corpusfile)
-            if i == 0 and args.devinputfile:
-                print("Encoding development corpus, from " + args.devinputfile + " to " + args.devinputfile + '.colibri.dat',file=sys.stderr)
-                sourceencoders[i].encodefile(args.devinputfile, args.devinputfile + '.colibri.dat')
-            print("Loading source class decoder " + classfile,file=sys.stderr)
-            sourcedecoder = ClassDecoder(classfile)
-
-            print("Loading test corpus " + corpusfile,file=sys.stderr)
-
-            l.append( Configuration( IndexedCorpus(corpusfile), sourcedecoder, conf['leftcontext'], conf['focus'], conf['rightcontext']) )
-
-        classifierconf['featureconf'] = l
-
-    else:
-        print("Loading source class decoders",file=sys.stderr)
-        l = []
-        for conf in classifierconf['featureconf']:
-            sourcedecoder = ClassDecoder(conf['classdecoder'])
-            l.append( Configuration( IndexedCorpus(), sourcedecoder, conf['leftcontext'], conf['focus'], conf['rightcontext'] ) )
-
-
-
-    if args.inputfile and args.alignmodelfile:
-
-        print("Loading target encoder " + args.targetclassfile,file=sys.stderr)
-        targetencoder = ClassEncoder(args.targetclassfile)
-        print("Loading target decoder " + args.targetclassfile,file=sys.stderr)
-        targetdecoder = ClassDecoder(args.targetclassfile)
+    #preparation plan: encoding the factors (and the development corpus) are independent jobs, run in a process pool with
+    #--threads > 1 while the alignment model is loaded, the test and development pattern models depend on the encoded corpus
+    #of factor 0 and the alignment model and are trained in parallel afterwards
+    pool = multiprocessing.get_context('fork').Pool(args.threads) if args.threads > 1 and args.inputfile else None
+    preparespan = metrics.span('prepare').start()
+    try:
+        if args.inputfile:
+            encodejobs = []
+            for i, (inputfile, conf) in enumerate(zip(args.inputfile, classifierconf['featureconf'])):
+                jobargs = (i, inputfile, conf['classdecoder'], args.devinputfile if i == 0 else None)
+                encodejobs.append( pool.apply_async(encodefactor, jobargs) if pool else Result(encodefactor(*jobargs)) )
+        else:
+            log.info("Loading source class decoders")
+            l = []
+            for conf in classifierconf['featureconf']:
+                sourcedecoder = ClassDecoder(conf['classdecoder'])
+                l.append( Configuration( IndexedCorpus(), sourcedecoder, conf['leftcontext'], conf['focus'], conf['rightcontext'] ) )
 
-        print("Loading alignment model " + args.alignmodelfile ,file=sys.stderr)
-        alignmodel = AlignmentModel(args.alignmodelfile)
-        print("\tAlignment model has " + str(len(alignmodel)) + " source patterns",file=sys.stderr)
 
+        if args.inputfile and args.alignmodelfile:
 
-        print("Building patternmodel on test corpus " + classifierconf['featureconf'][0].corpus.filename() ,file=sys.stderr)
-        options = PatternModelOptions(mintokens=1, maxlength=12, debug=True)
-        testmodel = IndexedPatternModel(reverseindex=classifierconf['featureconf'][0].corpus)
-        testmodel.train( "", options, alignmodel)
-        print("\tTest model has " + str(len(testmodel)) + " source patterns",file=sys.stderr)
+            log.info("Loading target encoder " + args.targetclassfile)
+            targetencoder = ClassEncoder(args.targetclassfile)
+            log.info("Loading target decoder " + args.targetclassfile)
+            targetdecoder = ClassDecoder(args.targetclassfile)
 
-        #saving just so we can inspect it for debug purposes:
-        testmodel.write(  decodedir + '/test.colibri.indexedpatternmodel'  )
+            if not args.filter:
+                #in parallel with the encoding jobs
+                log.info("Loading alignment model " + args.alignmodelfile)
+                alignmodel = AlignmentModel(args.alignmodelfile)
 
-        if args.devinputfile:
-            print("Building patternmodel on development corpus " + args.devinputfile + ".colibri.dat" ,file=sys.stderr)
-            devcorpus = IndexedCorpus(args.devinputfile + ".colibri.dat")
-            print("Development corpus has " + str(devcorpus.sentences()) + " sentences")
-            devmodel = IndexedPatternModel(reverseindex=devcorpus)
-            devmodel.train( "", options, alignmodel)
-            print("\tDevelopment model has " + str(len(testmodel)) + " source patterns",file=sys.stderr)
+        if args.inputfile:
+            l = []
+            for (classfile, corpusfile), conf in zip([ job.get() for job in encodejobs ], classifierconf['featureconf']):
+                sourceencoders.append( ClassEncoder(classfile) )
+                log.info("Loading source class decoder " + classfile)
+                sourcedecoder = ClassDecoder(classfile)
+
+                log.info("Loading test corpus " + corpusfile)
+
+                l.append( Configuration( IndexedCorpus(corpusfile), sourcedecoder, conf['leftcontext'], conf['focus'], conf['rightcontext']) )
+
+            classifierconf['featureconf'] = l
+
+            if not args.alignmodelfile:
+                if pool:
+                    pool.close()
+                    pool.join()
+                preparespan.stop()
+
+        if args.inputfile and args.alignmodelfile:
+            if args.filter:
+                log.info("Loading alignment model " + args.alignmodelfile + ", filtered given the test input")
+                filtercorpora = [ classifierconf['featureconf'][0].corpus.filename() ]
+                if args.devinputfile:
+                    filtercorpora.append(args.devinputfile + '.colibri.dat')
+                with metrics.span('filter'):
+                    alignmodel = loadfiltered(args.alignmodelfile, filtercorpora, sourceencoders[0], targetencoder, maxlength=args.filtermaxlength, cachedir=args.workdir)
+            log.info("\tAlignment model has " + str(len(alignmodel)) + " source patterns")
+
+            _preparestate['alignmodel'] = alignmodel
+            if pool:
+                #new pool, the workers need to be forked after the alignment model is loaded
+                pool.close()
+                pool.join()
+                pool = multiprocessing.get_context('fork').Pool(min(args.threads, 2))
+
+            log.info("Building patternmodel on test corpus " + classifierconf['featureconf'][0].corpus.filename())
+            #saving just so we can inspect it for debug purposes (and to pass it from a worker process)
+            if pool:
+                testjob = pool.apply_async(trainpatternmodel, (classifierconf['featureconf'][0].corpus.filename(), decodedir + '/test.colibri.indexedpatternmodel', False))
+            else:
+                testjob = Result(trainpatternmodel(classifierconf['featureconf'][0].corpus, decodedir + '/test.colibri.indexedpatternmodel'))
+            if args.devinputfile:
+                log.info("Building patternmodel on development corpus " + args.devinputfile + ".colibri.dat")
+                devcorpus = IndexedCorpus(args.devinputfile + ".colibri.dat")
+                log.info("Development corpus has " + str(devcorpus.sentences()) + " sentences")
+                if pool:
+                    devjob = pool.apply_async(trainpatternmodel, (args.devinputfile + ".colibri.dat", decodedir + '/dev.colibri.indexedpatternmodel', False))
+                else:
+                    devjob = Result(trainpatternmodel(devcorpus, decodedir + '/dev.colibri.indexedpatternmodel'))
 
-            #saving just so we can inspect it for debug purposes:
-            devmodel.write(  decodedir + '/dev.colibri.indexedpatternmodel'  )
-        else:
-            devmodel = {}
+            testmodel = loadpatternmodel(testjob.get(), decodedir + '/test.colibri.indexedpatternmodel', classifierconf['featureconf'][0].corpus)
+            log.info("\tTest model has " + str(len(testmodel)) + " source patterns")
 
-        if args.reorderingtable:
-            print("Loading reordering model (may take a while)",file=sys.stderr)
-            rtable = PhraseTable(args.reorderingtable) #TODO: convert to colibri alignmodel
+            if args.devinputfile:
+                devmodel = loadpatternmodel(devjob.get(), decodedir + '/dev.colibri.indexedpatternmodel', devcorpus)
+                log.info("\tDevelopment model has " + str(len(devmodel)) + " source patterns")
+            else:
+                devmodel = {}
 
+            if args.reorderingtable:
+                log.info("Loading reordering model (may take a while)")
+                rtable = PhraseTable(args.reorderingtable) #TODO: convert to colibri alignmodel
 
+            if pool:
+                pool.close()
+                pool.join()
+            preparespan.stop()
 
-    elif args.train and args.inputfile:
-        if not args.alignmodelfile:
-            print("No alignment model specified (-a)",file=sys.stderr)
-        sys.exit(2)
-    elif not args.train:
-        if not args.inputfile:
-            print("No input file specified (-f)",file=sys.stderr)
-        if not args.alignmodelfile:
-            print("No alignment model specified (-a)",file=sys.stderr)
-        sys.exit(2)
+        elif args.train and args.inputfile:
+            if not args.alignmodelfile:
+                log.error("No alignment model specified (-a)")
+            sys.exit(2)
+        elif not args.train:
+            if not args.inputfile:
+                log.error("No input file specified (-f)")
+            if not args.alignmodelfile:
+                log.error("No alignment model specified (-a)")
+            sys.exit(2)
+    finally:
+        if pool:
+            pool.terminate() #no-op once the pool is closed and joined, stops the workers if a job or the main process failed
 
     if args.train:
         #training mode
+        trainspan = metrics.span('train').start()
         if args.inputfile:
-            print("Training classifiers (constrained by test data)",file=sys.stderr)
+            log.info("Training classifiers (constrained by test data)")
         else:
-            print("Training all classifiers (you may want to constrain by test data using -f)",file=sys.stderr)
+            log.info("Training all classifiers (you may want to constrain by test data using -f)")
         if 'monolithic' in classifierconf and classifierconf['monolithic']:
-            #monolithic
-            trainfile = args.workdir + "/train"
-            #build a classifier
-            print("Training monolithic classifier " + trainfile,file=sys.stderr)
+            #monolithic, possibly split in shards that are trained in parallel
+            shards = classifierconf.get('shards',1)
             timbloptions = gettimbloptions(args, classifierconf)
-            if args.classifierdir:
-                #ugly hack since we want ibases in a different location
-                trainfilecopy = trainfile.replace(args.workdir, args.classifierdir)
-                shutil.copyfile(trainfile+".train", trainfilecopy+".train")
-                trainfile = trainfilecopy
-            classifier = timbl.TimblClassifier(trainfile, timbloptions)
-            classifier.train()
-            classifier.save()
-            if args.classifierdir:
-                #remove copy
-                os.unlink(trainfile+".train")
-            trained = 1
+            trainfiles = [ shardprefix(args.workdir, shard, shards) for shard in range(shards) ]
+            if shards > 1 and args.threads > 1:
+                log.info("Training " + str(shards) + " shards of the monolithic classifier in " + str(min(args.threads,shards)) + " processes")
+                with multiprocessing.get_context('fork').Pool(min(args.threads,shards)) as pool:
+                    for trainfile in pool.starmap(trainshard, [ (args, trainfile, timbloptions) for trainfile in trainfiles ]):
+                        log.info("Trained monolithic classifier " + trainfile)
+            else:
+                for trainfile in trainfiles:
+                    #build a classifier
+                    log.info("Training monolithic classifier " + trainfile)
+                    trainshard(args, trainfile, timbloptions)
+            trained = shards
         else:
             #experts
             trained = 0
+            trainfiles = []
             for trainfile in itertools.chain(glob.glob(args.workdir + "/*.train"), glob.glob(args.workdir + "/.*.train")): #explicitly add 'dotfiles', will be skipped by default
                 if args.inputfile:
                     sourcepattern_s = unquote_plus(os.path.basename(trainfile.replace('.train','')))
                     sourcepattern = sourceencoders[0].buildpattern(sourcepattern_s)
                     if not sourcepattern in testmodel and not sourcepattern in devmodel:
-                        print("Skipping " + trainfile + " (\"" + sourcepattern_s + "\" not in test/dev model)",file=sys.stderr)
+                        log.debug("Skipping " + trainfile + " (\"" + sourcepattern_s + "\" not in test/dev model)")
                         continue
-
+                trainfiles.append(trainfile)
+
+            if args.oracle:
+                def argmax(name):
+                    #phrase-table translation with the highest p(t|s), only available if the alignment model is loaded (-a with -f)
+                    if not args.inputfile:
+                        return None
+                    sourcepattern = sourceencoders[0].buildpattern(unquote_plus(name))
+                    targets = [ (alignmodel[(sourcepattern, targetpattern)][2], targetpattern.tostring(targetdecoder)) for targetpattern in alignmodel.targetpatterns(sourcepattern) ]
+                    return max(targets)[1] if targets else None
+                with metrics.span('oracle'):
+                    experts = colibrimt.oracle.buildindex(trainfiles, classifierdir + "/" + colibrimt.oracle.INDEXFILE, argmax, gettimbloptions(args, classifierconf), args.oraclemajority, args.oracleagreement, args.oraclesample)
+                metrics.count('oracleskipped', len(trainfiles) - len(experts))
+                trainfiles = [ trainfile for trainfile in trainfiles if os.path.basename(trainfile)[:-len('.train')] in experts ]
+            elif os.path.exists(classifierdir + "/" + colibrimt.oracle.INDEXFILE):
+                os.unlink(classifierdir + "/" + colibrimt.oracle.INDEXFILE) #stale index of an earlier run
+
+            for trainfile in trainfiles:
                 #build a classifier
-                print("Training " + trainfile,file=sys.stderr)
+                log.info("Training " + trainfile)
                 trained += 1
                 timbloptions = gettimbloptions(args, classifierconf)
                 if args.classifierdir:
@@ -290,65 +414,82 @@ def main():
                     trainfilecopy = trainfile.replace(args.workdir, args.classifierdir)
                     shutil.copyfile(trainfile, trainfilecopy)
                     trainfile = trainfilecopy
-                classifier = timbl.TimblClassifier(trainfile.replace('.train',''), timbloptions)
+                classifier = getclassifier(args, trainfile.replace('.train',''), timbloptions)
                 classifier.train()
                 classifier.save()
                 if args.classifierdir:
                     #remove copy
                     os.unlink(trainfile)
-                if not os.path.exists(trainfile.replace(".train",".ibase")):
-                    raise Exception("Resulting instance base " + trainfile.replace(".train",".ibase") + " not found!")
+                if not os.path.exists(trainfile.replace(".train",ibaseextension(args))):
+                    raise Exception("Resulting instance base " + trainfile.replace(".train",ibaseextension(args)) + " not found!")
 
         with open(args.classifierdir + '/trained','w',encoding='utf-8') as f:
             f.write(str(trained)+"\n")
+        trainspan.add(trained)
+        trainspan.stop()
+        metrics.count('trained', trained)
 
     else:
         #TEST
         if not args.inputfile:
-            print("Specify an input file (-f)",file=sys.stderr)
+            log.error("Specify an input file (-f)")
             sys.exit(2)
 
 
         if not args.mosesinclusive and not args.mosesexclusive:
-            print("Writing intermediate test data to " + decodedir + "/test.txt",file=sys.stderr)
+            log.info("Writing intermediate test data to " + decodedir + "/test.txt")
             #write intermediate test data (consisting only of indices AND unknown words) and
             f = open(decodedir + "/test.txt",'w',encoding='utf-8')
+            debug = debugging() #checked once, debug messages are not even formatted otherwise
+            progress = Progress("sentences written to test data")
+            oov = 0
             for sentencenum, line in enumerate(classifierconf['featureconf'][0].corpus.sentences()):
                 sentenceindex = sentencenum + 1
-                print("@" + str(sentenceindex),file=sys.stderr)
                 tokens = [] #actual string representations
                 for tokenindex,pattern in enumerate(line): #will yield only unigrams
                     #is this an uncovered word that does not appear in the phrasetable? check using alignment model and keep the word untranslated if so
-                    print("DEBUG: Processing pattern " + str(sentenceindex) + ":" + str(tokenindex) + ": "+ pattern.tostring(classifierconf['featureconf'][0].classdecoder),file=sys.stderr)
+                    if debug: log.debug("Processing pattern " + str(sentenceindex) + ":" + str(tokenindex) + ": "+ pattern.tostring(classifierconf['featureconf'][0].classdecoder))
                     if not pattern in alignmodel:
-                        print("     Found OOV at @" + str(sentenceindex) + ":" + str(tokenindex) + ": " + pattern.tostring(classifierconf['featureconf'][0].classdecoder), file=sys.stderr)
+                        if debug: log.debug("     Found OOV at @" + str(sentenceindex) + ":" + str(tokenindex) + ": " + pattern.tostring(classifierconf['featureconf'][0].classdecoder))
+                        oov += 1
                         tokens.append(pattern.tostring(classifierconf['featureconf'][0].classdecoder))
                     else:
                         tokens.append(str(sentenceindex) + "_" + str(tokenindex))
                 f.write(" ".join(tokens) + "\n")
+                progress.update()
             f.close()
+            progress.done()
+            log.info("\tFound " + str(oov) + " out-of-vocabulary tokens")
 
 
 
         classifierindex = set()
         if classifierconf['monolithic']:
-            print("Loading classifier index for monolithic classifier",file=sys.stderr)
+            log.info("Loading classifier index for monolithic classifier")
+            classifierindex = loadsourcepatternindex(args.workdir)
 
-            with open(args.workdir + "/sourcepatterns.list",'r',encoding='utf-8') as f:
-                for line in f:
-                    classifierindex.add(line.strip())
-
-            print("Loading monolithic classifier " + classifierdir + "/train.train",file=sys.stderr)
+            #one classifier per shard, each source pattern is routed to its own shard (instance bases are only loaded on first use)
             timbloptions = gettimbloptions(args, classifierconf)
-            classifier = timbl.TimblClassifier(classifierdir + "/train", timbloptions)
+            shardclassifiers = [ getclassifier(args, shardprefix(classifierdir, shard, classifierconf.get('shards',1)), timbloptions) for shard in range(classifierconf.get('shards',1)) ]
+            log.info("Loading monolithic classifier " + classifierdir + "/train.train" if len(shardclassifiers) == 1 else "Loading monolithic classifier in " + str(len(shardclassifiers)) + " shards from " + classifierdir)
+            classifier = shardclassifiers[0]
         else:
             classifier = None
 
+        keywordstore = None
+        if classifierconf.get('keywords'):
+            log.info("Loading keyword store " + args.workdir + "/" + KEYWORDSTORE)
+            keywordstore = KeywordStore(args.workdir + "/" + KEYWORDSTORE)
+
+        experts = colibrimt.oracle.loadindex(classifierdir + "/" + colibrimt.oracle.INDEXFILE) #None if the expert oracle was not used
+        if experts is not None:
+            log.info("Expert oracle index loaded, " + str(len(experts)) + " experts will be queried")
+
         if args.reorderingtable:
-            print("Creating intermediate phrase-table and reordering-table",file=sys.stderr)
+            log.info("Creating intermediate phrase-table and reordering-table")
             freordering = open(decodedir + "/reordering-table", 'w',encoding='utf-8')
         else:
-            print("Creating intermediate phrase-table",file=sys.stderr)
+            log.info("Creating intermediate phrase-table")
             freordering = None
 
         if args.mosesinclusive or args.mosesexclusive:
@@ -366,7 +507,7 @@ def main():
             if os.path.exists(decodedir + "/moses.ini"):
                 os.unlink(decodedir+"/moses.ini")
 
-            print("Writing " + decodedir + "/moses.ini",file=sys.stderr)
+            log.info("Writing " + decodedir + "/moses.ini")
 
 
             if args.reordering:
@@ -409,7 +550,7 @@ Distortion0= {dweight}
 """.format(phrasetable=decodedir + "/phrase-table", lm=args.lm, lmorder=args.lmorder, lmweight = args.lmweight, dweight = args.dweight, tweights=tweights, lentweights=lentweights, wweight=args.wweight, pweight = args.pweight, reorderingfeature=reorderingfeature, reorderingweight=reorderingweight))
             f.close()
 
-            print("Starting Moses Server",file=sys.stderr)
+            log.info("Starting Moses Server")
             if args.mosesdir:
                 cmd = args.mosesdir + '/bin/mosesserver'
             else:
@@ -420,7 +561,7 @@ Distortion0= {dweight}
                 elif args.mosesexclusive:
                     cmd += " -xml-input exclusive" #only used for passing verbatim L2 (tested whether it makes a difference with inclusive baseline on en-es data, it doesn't)
             cmd += ' -f ' + decodedir + '/moses.ini'
-            print("Calling mosesserver: " + cmd,file=sys.stderr)
+            log.info("Calling mosesserver: " + cmd)
 
             p = subprocess.Popen(cmd,shell=True)
             mosesserverpid = p.pid
@@ -432,21 +573,91 @@ Distortion0= {dweight}
                     s.connect( ("localhost", args.mosesport) )
                     break
                 except Exception as e:
-                    print("Waiting for Moses server....", e, file=sys.stderr)
+                    log.info("Waiting for Moses server.... " + str(e))
 
-            print("Connecting to Moses Server",file=sys.stderr)
+            log.info("Connecting to Moses Server")
             mosesclient = xmlrpc.client.ServerProxy("http://localhost:" + str(args.mosesport) + "/RPC2")
 
         else: #No XML method
 
             #create intermediate phrasetable, with indices covering the entire test corpus instead of source text and calling classifier with context information to obtain adjusted translation with distribution
             ftable = open(decodedir + "/phrase-table", 'w',encoding='utf-8')
+            tablerows = tablebytes = reorderingrows = reorderingbytes = 0
+
+            def formatrow(sourcepattern_s, targetpattern_s, scorevector):
+                """Returns the phrase-table row and reordering-table row (or None), without the token span"""
+                row = " ||| " + targetpattern_s + " ||| " + " ".join([str(x) for x in scorevector]) + "\n"
+                if not freordering:
+                    return row, None
+                reordering_scores = None
+                try:
+                    for t, sv in rtable[sourcepattern_s]:
+                        if t == targetpattern_s:
+                            reordering_scores = sv
+                except KeyError:
+                    if args.ignoreerrors:
+                        log.error("******* ERROR ********* Source pattern not found in reordering table: " + sourcepattern_s)
+                        return row, None
+                    else:
+                        raise Exception("Source pattern not found in reordering table: " + sourcepattern_s)
+                if reordering_scores:
+                    return row, " ||| " + targetpattern_s + " ||| " + " ".join([str(x) for x in reordering_scores]) + "\n"
+                elif args.ignoreerrors:
+                    log.error("******* ERROR ****** Target pattern not found in reordering table: " + targetpattern_s + " (for source " + sourcepattern_s + ")")
+                    return row, None
+                else:
+                    raise Exception("Target pattern not found in reordering table: " + targetpattern_s + " (for source " + sourcepattern_s + ")")
+
+            def classifiedrows(sourcepattern, sourcepattern_s, distribution):
+                rows = []
+                for targetpattern_s, score in distribution.items():
+                    targetpattern = targetencoder.buildpattern(targetpattern_s)
+                    if (sourcepattern, targetpattern) in alignmodel:
+                        scorevector = [ x for x in alignmodel[(sourcepattern,targetpattern)] if isinstance(x,int) or isinstance(x,float) ] #make a copy
+                    else:
+                        continue
+
+                    if args.scorehandling == 'append':
+                        scorevector.append(score)
+                    elif args.scorehandling == 'replace':
+                        scorevector[2] = score
+                    else:
+                        raise NotImplementedError #TODO: implemented weighed!
+                    rows.append(formatrow(sourcepattern_s, targetpattern_s, scorevector))
+                return rows
+
+            def fallbackrows(sourcepattern, sourcepattern_s):
+                rows = []
+                for targetpattern in alignmodel.targetpatterns(sourcepattern):
+                    scorevector = [ x for x in alignmodel[(sourcepattern,targetpattern)] if isinstance(x,int) or isinstance(x,float) ] #make a copy
+
+                    if args.scorehandling == 'append':
+                        scorevector.append(scorevector[2])
+                    elif args.scorehandling == 'replace':
+                        pass #nothing to do, scorevector is okay as it is
+                    elif args.scorehandling == 'weighed':
+                        raise NotImplementedError #TODO: implemented weighed!
+                    rows.append(formatrow(sourcepattern_s, targetpattern.tostring(targetdecoder), scorevector))
+                return rows
+
             prevpattern = None
             sourcepatterncount = len(testmodel)
+            tablespan = metrics.span('phrasetable', profile=True).start()
+            debug = debugging() #checked once, debug messages are not even formatted otherwise
+            progress = Progress(lambda count: "source patterns processed, " + str(tablespan.items) + " occurrences", sourcepatterncount)
             for i, sourcepattern in enumerate(testmodel):
                 sourcepattern_s = sourcepattern.tostring(classifierconf['featureconf'][0].classdecoder)
+                #formatted rows (everything after the token span) are built once per source pattern and reused for all occurrences
+                statisticalrows = None
+                classifierrows = {}
+                classified = None #with the numpy backend, all occurrences of the pattern are classified in one batch
+                occurrences = list(testmodel[sourcepattern])
+                keywords = keywordstore.keywords(sourcepattern_s) if keywordstore is not None else ()
+                featurevectors = [ extractcontextfeatures(classifierconf, sourcepattern, sentenceindex, tokenindex, keywords) for sentenceindex, tokenindex in occurrences ] #testcorpus is passed as part of classifierconf['featureconf']
                 #iterate over all occurrences, each will be encoded separately
-                for sentenceindex, tokenindex in testmodel[sourcepattern]:
+                if classifierconf['monolithic'] and len(shardclassifiers) > 1:
+                    classifier = shardclassifiers[shardof(sourcepattern_s, len(shardclassifiers))]
+                for occurrence, (sentenceindex, tokenindex) in enumerate(occurrences):
                     #compute token span
                     tokenspan = []
                     for t in range(tokenindex, tokenindex + len(sourcepattern)):
@@ -454,29 +665,31 @@ Distortion0= {dweight}
                     tokenspan = " ".join(tokenspan)
 
                     #get context configuration
-                    featurevector = extractcontextfeatures(classifierconf, sourcepattern, sentenceindex, tokenindex) #testcorpus is passed as part of classifierconf['featureconf']
+                    featurevector = featurevectors[occurrence]
                     if not featurevector:
                         raise Exception("No features returned")
                     if any( [ not x for x in featurevector ] ):
-                        print("ERROR: Empty feature in  " + str(sentenceindex) + ":" + str(tokenindex) + " " + sourcepattern_s + " -- Features: " + str(repr(featurevector)),file=sys.stderr)
+                        log.error("ERROR: Empty feature in  " + str(sentenceindex) + ":" + str(tokenindex) + " " + sourcepattern_s + " -- Features: " + str(repr(featurevector)))
                         raise Exception("Empty feature found in featurevector")
 
-                    translationcount = 0
                     if not args.ignoreclassifier and not classifierconf['monolithic']:
 
                         #load classifier
                         if not prevpattern or sourcepattern_s != prevpattern:
                             classifierprefix = classifierdir + "/" + quote_plus(sourcepattern_s)
                             trainfile = args.workdir + "/" + quote_plus(sourcepattern_s) + ".train"
-                            ibasefile = classifierprefix + ".ibase"
-                            if os.path.exists(ibasefile):
-                                print("Loading classifier " + classifierprefix + " for " + sourcepattern_s,file=sys.stderr)
+                            ibasefile = classifierprefix + ibaseextension(args)
+                            if experts is not None and quote_plus(sourcepattern_s) not in experts:
+                                #expert judged not worth querying by the oracle
+                                classifier = None
+                            elif os.path.exists(ibasefile):
+                                log.debug("Loading classifier " + classifierprefix + " for " + sourcepattern_s)
                                 timbloptions = gettimbloptions(args, classifierconf)
-                                classifier = timbl.TimblClassifier(classifierprefix, timbloptions)
+                                classifier = getclassifier(args, classifierprefix, timbloptions)
                             elif os.path.exists(trainfile):
-                                print("ERROR: Classifier for " + sourcepattern_s + " built but not trained!!!! " + trainfile + " exists but " + ibasefile + " misses",file=sys.stderr)
-                                print("Classifier dir: ", classifierdir,file=sys.stderr)
-                                print("Workdir (training data dir): ", args.workdir,file=sys.stderr)
+                                log.error("ERROR: Classifier for " + sourcepattern_s + " built but not trained!!!! " + trainfile + " exists but " + ibasefile + " misses")
+                                log.error("Classifier dir: " + str(classifierdir))
+                                log.error("Workdir (training data dir): " + str(args.workdir))
                                 import pdb; pdb.set_trace()
                                 #raise Exception("ERROR: Classifier for " + sourcepattern_s + " built but not trained!!!!")
                             else:
@@ -485,112 +698,69 @@ Distortion0= {dweight}
                             prevpattern = sourcepattern_s
 
 
-                    print("@" + str(i+1) + "/" + str(sourcepatterncount)  + " -- Processing " + str(sentenceindex) + ":" + str(tokenindex) + " " + sourcepattern_s + " -- Features: " + str(repr(featurevector)),file=sys.stderr)
+                    if debug: log.debug("@" + str(i+1) + "/" + str(sourcepatterncount)  + " -- Processing " + str(sentenceindex) + ":" + str(tokenindex) + " " + sourcepattern_s + " -- Features: " + str(repr(featurevector)))
+                    tablespan.add()
 
+                    rows = None
                     if classifier and not args.ignoreclassifier:
                         if not classifierconf['monolithic'] or (classifierconf['monolithic'] and sourcepattern_s in classifierindex):
-                            print("\tClassifying",file=sys.stderr)
+                            if debug: log.debug("\tClassifying")
 
                             #call classifier
-                            classlabel, distribution, distance = classifier.classify(featurevector)
-
-                            #process classifier result
-                            for targetpattern_s, score in distribution.items():
-                                targetpattern = targetencoder.buildpattern(targetpattern_s)
-                                if (sourcepattern, targetpattern) in alignmodel:
-                                    scorevector = [ x for x in alignmodel[(sourcepattern,targetpattern)] if isinstance(x,int) or isinstance(x,float) ] #make a copy
-                                else:
-                                    continue
-
-                                if args.scorehandling == 'append':
-                                    scorevector.append(score)
-                                elif args.scorehandling == 'replace':
-                                    scorevector[2] = score
-                                else:
-                                    raise NotImplementedError #TODO: implemented weighed!
-
-                                translationcount += 1
-
-                                #write phrasetable entries
-                                ftable.write(tokenspan + " ||| " + targetpattern_s + " ||| " + " ".join([str(x) for x in scorevector]) + "\n")
-                                if freordering:
-                                    reordering_scores = None
-                                    try:
-                                        for t, sv in rtable[sourcepattern_s]:
-                                            if t == targetpattern_s:
-                                                reordering_scores = sv
-                                    except KeyError:
-                                        if args.ignoreerrors:
-                                            print("******* ERROR ********* Source pattern notfound in reordering table: " + sourcepattern_s,file=sys.stderr)
-                                            continue
-                                        else:
-                                            raise Exception("Source pattern notfound in reordering table: " + sourcepattern_s)
-
-                                    if reordering_scores:
-                                        freordering.write(tokenspan + " ||| " + targetpattern_s + " ||| " + " ".join([str(x) for x in reordering_scores]) + "\n")
-                                    else:
-                                        if args.ignoreerrors:
-                                            print("******** ERROR ********* Target pattern not found in reordering table: " + targetpattern_s + " (for source " + sourcepattern_s + ")",file=sys.stderr)
-                                            continue
-                                        else:
-                                            raise Exception("Target pattern not found in reordering table: " + targetpattern_s + " (for source " + sourcepattern_s + ")")
-
-                            if translationcount == 0:
-                                print("\tNo overlap between classifier translations (" + str(len(distribution)) + ") and phrase table. Falling back to statistical baseline.",file=sys.stderr)
+                            if args.backend == 'numpy':
+                                if classified is None:
+                                    classified = classifier.classifybatch(featurevectors)
+                                classlabel, distribution, distance = classified[occurrence]
+                            else:
+                                classlabel, distribution, distance = classifier.classify(featurevector)
+                            metrics.count('classified')
+
+                            #occurrences with the same distribution share their rows
+                            distributionkey = tuple(sorted(distribution.items()))
+                            if distributionkey in classifierrows:
+                                rows = classifierrows[distributionkey]
+                                metrics.count('rowtemplates_reused')
+                            else:
+                                rows = classifierrows[distributionkey] = classifiedrows(sourcepattern, sourcepattern_s, distribution)
+
+                            if not rows:
+                                log.debug("\tNo overlap between classifier translations (" + str(len(distribution)) + ") and phrase table. Falling back to statistical baseline.")
                                 statistical = True
                             else:
-                                print("\t\t" + str(translationcount) + " translation options written",file=sys.stderr)
+                                if debug: log.debug("\t\t" + str(len(rows)) + " translation options written")
                                 statistical = False
                         else:
-                            print("\tNot in classifier. Falling back to statistical baseline.",file=sys.stderr)
+                            log.debug("\tNot in classifier. Falling back to statistical baseline.")
                             statistical = True
 
                     else:
                         statistical = True
 
                     if statistical:
-                        print("\tPhrasetable lookup",file=sys.stderr)
-                        #ignore classifier or no classifier present for this item
-                        for targetpattern in alignmodel.targetpatterns(sourcepattern):
-                            scorevector = [ x for x in alignmodel[(sourcepattern,targetpattern)] if isinstance(x,int) or isinstance(x,float) ] #make a copy
-
-                            if args.scorehandling == 'append':
-                                scorevector.append(scorevector[2])
-                            elif args.scorehandling == 'replace':
-                                pass #nothing to do, scorevector is okay as it is
-                            elif args.scorehandling == 'weighed':
-                                raise NotImplementedError #TODO: implemented weighed!
-
-                            translationcount += 1
-
-                            #write phrasetable entries
-                            targetpattern_s = targetpattern.tostring(targetdecoder)
-                            ftable.write(tokenspan + " ||| " + targetpattern_s + " ||| " + " ".join([ str(x) for x in scorevector]) + "\n")
-                            if freordering:
-                                reordering_scores = None
-                                try:
-                                    for t, sv in rtable[sourcepattern_s]:
-                                        if t == targetpattern_s:
-                                            reordering_scores = sv
-                                except KeyError:
-                                    if args.ignoreerrors:
-                                        print("******** ERROR ******* Source pattern not found in reordering table: " + sourcepattern_s,file=sys.stderr)
-                                        continue
-                                    else:
-                                        raise Exception("Source pattern not found in reordering table: " + sourcepattern_s)
-
-                                if reordering_scores:
-                                    freordering.write(tokenspan + " ||| " + targetpattern_s + " ||| " + " ".join([str(x) for x in reordering_scores]) + "\n")
-                                else:
-                                    if args.ignoreerrors:
-                                            print("******* ERROR ****** Target pattern not found in reordering table: " + targetpattern_s + " (for source " + sourcepattern_s + ")",file=sys.stderr)
-                                            continue
-                                    else:
-                                        raise Exception("Target pattern not found in reordering table: " + targetpattern_s + " (for source " + sourcepattern_s + ")")
-
-                        print("\t\t" + str(translationcount) + " translation options written",file=sys.stderr)
-
-
+                        if debug: log.debug("\tPhrasetable lookup")
+                        metrics.count('statistical')
+                        #ignore classifier or no classifier present for this item, the rows are the same for every occurrence
+                        if statisticalrows is None:
+                            statisticalrows = fallbackrows(sourcepattern, sourcepattern_s)
+                        else:
+                            metrics.count('rowtemplates_reused')
+                        rows = statisticalrows
+                        if debug: log.debug("\t\t" + str(len(rows)) + " translation options written")
+
+                    #write phrasetable (and reordering table) entries
+                    translationcount = len(rows)
+                    buffer = "".join([ tokenspan + row for row, _ in rows ])
+                    ftable.write(buffer)
+                    tablerows += translationcount
+                    tablebytes += len(buffer)
+                    if freordering:
+                        buffer = "".join([ tokenspan + reorderingrow for _, reorderingrow in rows if reorderingrow ])
+                        freordering.write(buffer)
+                        reorderingrows += sum( 1 for _, reorderingrow in rows if reorderingrow )
+                        reorderingbytes += len(buffer)
+                    metrics.count('translationoptions', translationcount)
+
+                progress.update()
                 prevpattern = None
 
 
@@ -599,6 +769,15 @@ Distortion0= {dweight}
             ftable.close()
             if freordering:
                 freordering.close()
+            tablespan.stop()
+            progress.done()
+            metrics.count('phrasetable_rows', tablerows)
+            metrics.count('phrasetable_bytes', tablebytes)
+            log.info("Intermediate phrase-table: " + str(tablerows) + " rows, " + str(tablebytes) + " bytes")
+            if freordering:
+                metrics.count('reorderingtable_rows', reorderingrows)
+                metrics.count('reorderingtable_bytes', reorderingbytes)
+                log.info("Intermediate reordering-table: " + str(reorderingrows) + " rows, " + str(reorderingbytes) + " bytes")
 
             if not args.tweight:
                 if args.scorehandling == "append":
@@ -611,7 +790,7 @@ Distortion0= {dweight}
                 lentweights = len(args.tweight)
 
 
-            print("Writing " + decodedir + "/moses.ini",file=sys.stderr)
+            log.info("Writing " + decodedir + "/moses.ini")
 
             if args.reordering:
                 reorderingfeature = "LexicalReordering name=LexicalReordering0 num-features=6 type=" + args.reordering + " input-factor=0 output-factor=0 path=" + decodedir + "/reordering-table"
@@ -660,6 +839,7 @@ Distortion0= {dweight}
             f.close()
 
             if not args.skipdecoder:
+                decodespan = metrics.span('decode').start()
                 if args.mert:
                     if args.ref[0] == '/':
                         ref = args.ref
@@ -668,29 +848,31 @@ Distortion0= {dweight}
 
                     for mertrun in range(1,args.mert+1):
                         if os.path.exists(decodedir+"/mert-work-" + str(mertrun) +"/moses.ini"):
-                            print("Mert run #" + str(mertrun) + " already ran, skipping...",file=sys.stderr)
+                            log.info("Mert run #" + str(mertrun) + " already ran, skipping...")
                         else:
                             #invoke mert
                             cmd = args.mosesdir + "/scripts/training/mert-moses.pl --working-dir=" + decodedir + "/mert-work-" + str(mertrun) + " --mertdir=" + args.mosesdir + '/mert/' + ' --decoder-flags="-threads ' + str(args.threads) + '" ' + decodedir + "/test.txt " + ref + " `which moses` " + decodedir + "/moses.ini --threads=" + str(args.threads)
-                            print("Contextmoses calling mert #" + str(mertrun) + ": " + cmd,file=sys.stderr)
+                            log.info("Contextmoses calling mert #" + str(mertrun) + ": " + cmd)
                             r = subprocess.call(cmd, shell=True)
                             if r != 0:
-                                print("Contextmoses called mert #" + str(mertrun) + " but failed!", file=sys.stderr)
+                                log.error("Contextmoses called mert #" + str(mertrun) + " but failed!")
                                 sys.exit(1)
-                            print("DONE: Contextmoses calling mert #" + str(mertrun)+": " + cmd,file=sys.stderr)
+                            log.info("DONE: Contextmoses calling mert #" + str(mertrun)+": " + cmd)
                 else:
                     #invoke moses
                     cmd = EXEC_MOSES + " -threads " + str(args.threads) + " -f " + decodedir + "/moses.ini < " + decodedir + "/test.txt > " + decodedir + "/output.txt"
-                    print("Contextmoses calling moses: " + cmd,file=sys.stderr)
+                    log.info("Contextmoses calling moses: " + cmd)
                     r = subprocess.call(cmd, shell=True)
                     if r != 0:
-                        print("Contextmoses called moses but failed!", file=sys.stderr)
+                        log.error("Contextmoses called moses but failed!")
                         sys.exit(1)
-                    print("DONE: Contextmoses calling moses: " + cmd,file=sys.stderr)
+                    log.info("DONE: Contextmoses calling moses: " + cmd)
+                decodespan.stop()
 
             else:
-                print("Contextmoses skipping decoder",file=sys.stderr)
+                log.info("Contextmoses skipping decoder")
 
+    metrics.close()
 
 if __name__ == '__main__':
     main()
@@ -7,6 +7,12 @@ import sys
 import os
 import subprocess
 import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+import numpy
+from colibrimt.instrumentation import metrics, addmetricsarguments, setupmetrics
+import colibrimt.cache
 
 
 def bold(s):
@@ -92,26 +98,96 @@ def execfooter(name, r, *outputfiles, **kwargs):
             return False
     return True
 
+def cachekey(name, cmd, outputfiles, kwargs):
+    """If the input files of a command are passed (inputs=[...], optionally params=...), the command runs through the artifact cache: returns its cache key, or None if the cache is not used (no inputs, or COLIBRIMT_NOCACHE is set)"""
+    if not kwargs.get('inputs') or not outputfiles or os.environ.get('COLIBRIMT_NOCACHE'):
+        return None
+    return colibrimt.cache.stagekey(name, kwargs['inputs'], {'command': cmd, 'params': kwargs.get('params')})
+
+def fromcache(name, key, outputfiles):
+    """Skip or restore the outputs of a cached command, returns True if nothing needs to be done"""
+    if colibrimt.cache.uptodate(key, outputfiles):
+        log("Skipping " + name + " (up to date)", yellow, True)
+        return True
+    if colibrimt.cache.ArtifactCache().restore(key, outputfiles):
+        log("Restored output of " + name + " from cache", yellow, True)
+        return True
+    return False
+
+def uncachedoutputs(outputfiles, kwargs):
+    """The outputs whose existence lets execheader() skip a command that does not go through the cache. A command with inputs only skips through the cache (existing outputs may be stale), so when caching is disabled it always runs"""
+    if kwargs.get('inputs'):
+        return ()
+    return outputfiles
+
 def runcmd(cmd, name, *outputfiles, **kwargs):
-    if not execheader(name,*outputfiles, cmd=cmd): return True
+    key = cachekey(name, cmd, outputfiles, kwargs)
+    if key:
+        if fromcache(name, key, outputfiles): return True
+        execheader(name, cmd=cmd)
+    elif not execheader(name,*uncachedoutputs(outputfiles, kwargs), cmd=cmd): return True
     r = subprocess.call(cmd, shell=True)
-    return execfooter(name, r, *outputfiles,**kwargs)
+    r = execfooter(name, r, *outputfiles,**kwargs)
+    if key and r:
+        colibrimt.cache.ArtifactCache().store(key, outputfiles, name)
+    return r
 
 def main():
     parser = argparse.ArgumentParser(description="Evaluation")
-    parser.add_argument('--matrexdir',type=str, help="Path to Matrex evaluation scripts",action='store',default="", required=True)
+    parser.add_argument('--matrexdir',type=str, help="Path to Matrex evaluation scripts",action='store',default="", required=False)
     parser.add_argument('--ref',type=str,help='Reference file', action='store',required=True)
-    parser.add_argument('--out',type=str,help='Output file', action='store',required=True)
-    parser.add_argument('--input',type=str,help='Input file', action='store',required=True)
+    parser.add_argument('--out',type=str,help='Output file, may be specified multiple times to compare systems using paired bootstrap resampling (--bootstrap), the first one is the baseline', action='append',required=True)
+    parser.add_argument('--input',type=str,help='Input file', action='store',required=False)
+    parser.add_argument('--bootstrap',type=int,help='Number of resamples for paired bootstrap significance testing of BLEU and TER (requires two or more --out)', action='store',default=0)
+    parser.add_argument('--confidence',type=float,help='Confidence level for the bootstrap confidence intervals', action='store',default=0.95)
+    parser.add_argument('--seed',type=int,help='Random seed for bootstrap resampling', action='store',default=1)
+    parser.add_argument('--workers',type=int,help='Maximum number of evaluation scripts to run concurrently (defaults to one per metric)', action='store',default=0)
     parser.add_argument('--debug','-d', help="Debug", action='store_true', default=False)
     #parser.add_argument('--workdir','-w',type=str,help='Work directory', action='store',default=".")
+    addmetricsarguments(parser)
     args = parser.parse_args()
-
-    matrexsrcfile, matrextgtfile, matrexoutfile = initevaluate(args.input, args.ref, args.out,  args.matrexdir)
-
-    outprefix = '.'.join(args.out.split('.')[:-1])
-
-    mtscore(args.matrexdir, matrexsrcfile, matrextgtfile, matrexoutfile, outprefix)
+    setupmetrics(args, 'colibri-evaluate')
+
+    if not args.matrexdir and not args.bootstrap:
+        print("Specify --matrexdir and/or --bootstrap",file=sys.stderr)
+        sys.exit(2)
+    if args.matrexdir and not args.input:
+        print("--matrexdir requires --input",file=sys.stderr)
+        sys.exit(2)
+    if args.bootstrap and len(args.out) < 2:
+        print("--bootstrap requires at least two --out files",file=sys.stderr)
+        sys.exit(2)
+
+    if args.matrexdir:
+        for out in args.out:
+            matrexsrcfile, matrextgtfile, matrexoutfile = initevaluate(args.input, args.ref, out,  args.matrexdir)
+
+            outprefix = '.'.join(out.split('.')[:-1])
+
+            mtscore(args.matrexdir, matrexsrcfile, matrextgtfile, matrexoutfile, outprefix, args.workers)
+
+    if args.bootstrap:
+        log("Computing sentence-level statistics", white, True)
+        refs = readsentences(args.ref)
+        baseline = args.out[0]
+        basestats = sentencestats(readsentences(baseline), refs)
+        for out in args.out[1:]:
+            log("Paired bootstrap resampling (" + str(args.bootstrap) + " samples): " + baseline + " vs " + out + " " + timestamp(), white, True)
+            with metrics.span('bootstrap', profile=True) as span:
+                results = pairedbootstrap(basestats, sentencestats(readsentences(out), refs), args.bootstrap, args.confidence, args.seed)
+                span.add(args.bootstrap)
+            outprefix = '.'.join(out.split('.')[:-1])
+            with open(outprefix + '.bootstrap.score','w',encoding='utf-8') as f:
+                s = "METRIC BASELINE SYSTEM DELTA DELTA_LOW DELTA_HIGH SYSTEM_LOW SYSTEM_HIGH P"
+                f.write(s + "\n")
+                log(s)
+                for metric in ('BLEU','TER'):
+                    r = results[metric]
+                    s = metric + " " + " ".join([ str(round(x,4)) for x in (r['baseline'], r['system'], r['delta'], r['delta_interval'][0], r['delta_interval'][1], r['system_interval'][0], r['system_interval'][1], r['p']) ])
+                    f.write(s + "\n")
+                    log(s)
+
+    metrics.close()
 
 
 def initevaluate(inp, ref, out, matrexdir):
@@ -163,7 +239,76 @@ def initevaluate(inp, ref, out, matrexdir):
     return matrexsrcfile, matrextgtfile, matrexoutfile
 
 
-def mtscore(matrexdir, sourcexml, refxml, targetxml, outprefix):
+def runjob(cmd, name, *outputfiles, **kwargs):
+    """Like runcmd() but meant to run in a worker thread: the header is logged immediately, the captured stderr and the footer are logged once the command finished. Returns (success, stderr output, duration in seconds)"""
+    key = cachekey(name, cmd, outputfiles, kwargs)
+    if key:
+        if fromcache(name, key, outputfiles): return True, "", 0.0
+        execheader(name, cmd=cmd)
+    elif not execheader(name,*uncachedoutputs(outputfiles, kwargs), cmd=cmd): return True, "", 0.0
+    span = metrics.span(name).start()
+    begintime = time.time()
+    p = subprocess.Popen(cmd, shell=True, stderr=subprocess.PIPE)
+    _, err = p.communicate()
+    duration = time.time() - begintime
+    span.stop()
+    err = str(err,'utf-8',errors='replace')
+    if err:
+        log("Output from " + name + ":\n" + err.rstrip())
+    r = execfooter(name, p.returncode, *outputfiles,**kwargs)
+    if key and r:
+        colibrimt.cache.ArtifactCache().store(key, outputfiles, name)
+    log(name + " took " + str(round(duration,2)) + "s")
+    return r, err, duration
+
+
+def readscore(scorefile, parser, name):
+    """Parse a score file with the given line parser (returns a value or None for each line). Returns (value, ok): value is the last value found or None if no line matched, ok is False only if the file could not be read"""
+    value = None
+    try:
+        with open(scorefile,'r',encoding='utf-8') as f:
+            for line in f:
+                v = parser(line)
+                if v is not None:
+                    value = v
+    except Exception as e:
+        log("Error reading " + os.path.basename(scorefile) + ": " + str(e),red)
+        return None, False
+    if value is not None:
+        log(name + " score: " + str(value), white)
+    return value, True
+
+def parsebleu(line):
+    if line[0:9] == "BLEUr1n4,":
+        return float(line[10:].strip())
+
+def parsewer(line):
+    if line[0:11] == "WER score =":
+        return float(line[12:19].strip())
+
+def parseper(line):
+    if line[0:11] == "PER score =":
+        return float(line[12:19].strip())
+
+def parsemeteor(line):
+    if line[0:6] == "Score:":
+        return float(line[7:].strip())
+
+def parsenist(line):
+    if line[0:12] == "NIST score =":
+        return float(line[13:21].strip())
+
+def parsemtevalbleu(line):
+    if line[21:33] == "BLEU score =":
+        return float(line[34:40].strip())
+
+def parseter(line):
+    if line[0:10] == "Total TER:":
+        return float(line[11:].strip().split(' ')[0])
+
+
+def mtscore(matrexdir, sourcexml, refxml, targetxml, outprefix, workers=None):
+    """Computes all metrics for which scripts are available, the metric scripts run concurrently on a bounded pool of workers threads (defaults to the number of metrics), parsing happens once all have finished"""
 
     per = 0
     wer = 0
@@ -181,115 +326,100 @@ def mtscore(matrexdir, sourcexml, refxml, targetxml, outprefix):
     EXEC_PERL = 'perl'
     EXEC_JAVA = 'java'
 
-    errors = False
-    if EXEC_MATREX_BLEU and os.path.exists(EXEC_MATREX_BLEU):
-        if not runcmd(EXEC_PERL + ' ' + EXEC_MATREX_BLEU + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml + ' -ci > ' + outprefix + '.bleu.score',  'Computing BLEU score'): errors = True
-        if not errors:
-            try:
-                f = open( outprefix + '.bleu.score')
-                for line in f:
-                    if line[0:9] == "BLEUr1n4,":
-                        bleu = float(line[10:].strip())
-                        print("BLEU score: ", bleu, file=sys.stderr)
-                f.close()
-            except Exception as e:
-                log("Error reading bleu.score:" + str(e),red)
-                errors = True
-    else:
-        log("Skipping BLEU (no script found ["+EXEC_MATREX_BLEU+"])",yellow)
-
-    if EXEC_MATREX_WER and os.path.exists(EXEC_MATREX_WER):
-        if not runcmd(EXEC_PERL + ' ' + EXEC_MATREX_WER + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml + '  > ' + outprefix + '.wer.score', 'Computing WER score'): errors = True
-        if not errors:
-            try:
-                f = open(outprefix + '.wer.score','r',encoding='utf-8')
-                for line in f:
-                    if line[0:11] == "WER score =":
-                        wer = float(line[12:19].strip())
-                        log("WER score: " + str(wer), white)
-                f.close()
-            except Exception as e:
-                log("Error reading wer.score:" + str(e),red)
-                errors = True
-    else:
-        log("Skipping WER (no script found ["+EXEC_MATREX_WER+"]) ",yellow)
-
-    if EXEC_MATREX_PER and os.path.exists(EXEC_MATREX_PER):
-        if not runcmd(EXEC_PERL + ' ' + EXEC_MATREX_PER + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml + '  > ' + outprefix + '.per.score',  'Computing PER score'): errors = True
-        if not errors:
-            try:
-                f = open(outprefix +'.per.score','r',encoding='utf-8')
-                for line in f:
-                    if line[0:11] == "PER score =":
-                        per = float(line[12:19].strip())
-                        log("PER score: " + str(per), white)
-                f.close()
-            except Exception as e:
-                log("Error reading per.score" + str(e),red)
-                errors = True
-    else:
-        log("Skipping PER (no script found ["+EXEC_MATREX_PER+"])",yellow)
-
-    if EXEC_MATREX_METEOR and os.path.exists(EXEC_MATREX_METEOR):
-        if not runcmd(EXEC_PERL + ' -I ' + os.path.dirname(EXEC_MATREX_METEOR) + ' ' + EXEC_MATREX_METEOR + " -s colibri -r " + refxml + ' -t ' + targetxml + ' --modules "exact"  > ' + outprefix + '.meteor.score',  'Computing METEOR score'): errors = True
-        if not errors:
-            try:
-                f = open(outprefix + '.meteor.score','r',encoding='utf-8')
-                for line in f:
-                    if line[0:6] == "Score:":
-                        meteor = float(line[7:].strip())
-                        log("METEOR score: " + str(meteor), white)
-                f.close()
-            except Exception as e:
-                log("Error reading meteor.score:" + str(e),red)
-                errors = True
-    else:
-        log("Skipping METEOR (no script found ["+EXEC_MATREX_METEOR+"])",yellow)
-
-    if EXEC_MATREX_MTEVAL and os.path.exists(EXEC_MATREX_MTEVAL):
-        if not runcmd(EXEC_PERL + ' ' + EXEC_MATREX_MTEVAL + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml +  '  > ' + outprefix + '.mteval.score',  'Computing NIST & BLEU scores'): errors = True
-        if not errors:
-            try:
-                f = open(outprefix + '.mteval.score','r',encoding='utf-8')
-                for line in f:
-                    if line[0:12] == "NIST score =":
-                        nist = float(line[13:21].strip())
-                        log("NIST score: ", nist)
-                    if line[21:33] == "BLEU score =":
-                        try:
-                            bleu2 = float(line[34:40].strip())
-                            if bleu == 0:
-                                bleu = bleu2
-                                log("BLEU score: " + str(bleu), white)
-                            elif abs(bleu - bleu2) > 0.01:
-                                log("blue score from MTEVAL scripts differs too much: " + str(bleu) + " vs " + str(bleu2) +  ", choosing highest score")
-                                if bleu2 > bleu:
-                                    bleu = bleu2
-                            else:
-                                log("BLEU score (not stored): " + str(float(line[34:40].strip())))
-                        except:
-                            raise
-                f.close()
-            except Exception as e:
-                log("Error reading mteval.score: " + str(e),red)
-                errors = True
-    else:
-        log("Skipping MTEVAL (BLEU & NIST) (no script found)", yellow)
-
-    if EXEC_MATREX_TER and os.path.exists(EXEC_MATREX_TER):
-        if not runcmd(EXEC_JAVA + ' -jar ' + EXEC_MATREX_TER + " -r " + refxml + ' -h ' + targetxml + '  > ' + outprefix + '.ter.score',  'Computing TER score'): errors = True
-        if not errors:
-            try:
-                f = open(outprefix + '.ter.score','r',encoding='utf-8')
+    #metric => (script, command, scorefile, description)
+    jobs = [
+        ('bleu', EXEC_MATREX_BLEU, EXEC_PERL + ' ' + EXEC_MATREX_BLEU + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml + ' -ci > ' + outprefix + '.bleu.score', 'Computing BLEU score'),
+        ('wer', EXEC_MATREX_WER, EXEC_PERL + ' ' + EXEC_MATREX_WER + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml + '  > ' + outprefix + '.wer.score', 'Computing WER score'),
+        ('per', EXEC_MATREX_PER, EXEC_PERL + ' ' + EXEC_MATREX_PER + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml + '  > ' + outprefix + '.per.score',  'Computing PER score'),
+        ('meteor', EXEC_MATREX_METEOR, EXEC_PERL + ' -I ' + os.path.dirname(EXEC_MATREX_METEOR) + ' ' + EXEC_MATREX_METEOR + " -s colibri -r " + refxml + ' -t ' + targetxml + ' --modules "exact"  > ' + outprefix + '.meteor.score',  'Computing METEOR score'),
+        ('mteval', EXEC_MATREX_MTEVAL, EXEC_PERL + ' ' + EXEC_MATREX_MTEVAL + " -r " + refxml + ' -t ' + targetxml + ' -s ' + sourcexml +  '  > ' + outprefix + '.mteval.score',  'Computing NIST & BLEU scores'),
+        ('ter', EXEC_MATREX_TER, EXEC_JAVA + ' -jar ' + EXEC_MATREX_TER + " -r " + refxml + ' -h ' + targetxml + '  > ' + outprefix + '.ter.score',  'Computing TER score'),
+    ]
+
+    available = []
+    for metric, script, cmd, name in jobs:
+        if script and os.path.exists(script):
+            available.append( (metric, cmd, name) )
+        elif metric == 'mteval':
+            log("Skipping MTEVAL (BLEU & NIST) (no script found)", yellow)
+        elif metric == 'ter':
+            log("Skipping TER (no script found)",yellow)
+        else:
+            log("Skipping " + metric.upper() + " (no script found ["+script+"])",yellow)
+
+    succeeded = {}
+    if available:
+        if not workers:
+            workers = len(available)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            #the score files are cached on the contents of the xml files, unchanged outputs are not scored again
+            futures = [ (metric, pool.submit(runjob, cmd, name, outprefix + '.' + metric + '.score', inputs=(sourcexml, refxml, targetxml))) for metric, cmd, name in available ]
+            for metric, future in futures:
+                try:
+                    succeeded[metric] = future.result()[0]
+                except Exception as e:
+                    log("Error running " + metric + ": " + str(e),red)
+                    succeeded[metric] = False
+
+    errors = any( not x for x in succeeded.values() )
+
+    #parse all scores now all jobs have finished
+    if succeeded.get('bleu'):
+        value, ok = readscore(outprefix + '.bleu.score', parsebleu, "BLEU")
+        if not ok:
+            errors = True
+        elif value is not None:
+            bleu = value
+
+    if succeeded.get('wer'):
+        value, ok = readscore(outprefix + '.wer.score', parsewer, "WER")
+        if not ok:
+            errors = True
+        elif value is not None:
+            wer = value
+
+    if succeeded.get('per'):
+        value, ok = readscore(outprefix + '.per.score', parseper, "PER")
+        if not ok:
+            errors = True
+        elif value is not None:
+            per = value
+
+    if succeeded.get('meteor'):
+        value, ok = readscore(outprefix + '.meteor.score', parsemeteor, "METEOR")
+        if not ok:
+            errors = True
+        elif value is not None:
+            meteor = value
+
+    if succeeded.get('mteval'):
+        value, ok = readscore(outprefix + '.mteval.score', parsenist, "NIST")
+        if not ok:
+            errors = True
+        elif value is not None:
+            nist = value
+        try:
+            with open(outprefix + '.mteval.score','r',encoding='utf-8') as f:
                 for line in f:
-                    if line[0:10] == "Total TER:":
-                        ter = float(line[11:].strip().split(' ')[0])
-                        log("TER score: ", ter,white)
-                f.close()
-            except Exception as e:
-                log("Error reading ter.score: " + str(e),red)
-    else:
-        log("Skipping TER (no script found)",yellow)
+                    bleu2 = parsemtevalbleu(line)
+                    if bleu2 is None: continue
+                    if bleu == 0:
+                        bleu = bleu2
+                        log("BLEU score: " + str(bleu), white)
+                    elif abs(bleu - bleu2) > 0.01:
+                        log("blue score from MTEVAL scripts differs too much: " + str(bleu) + " vs " + str(bleu2) +  ", choosing highest score")
+                        if bleu2 > bleu:
+                            bleu = bleu2
+                    else:
+                        log("BLEU score (not stored): " + str(bleu2))
+        except Exception as e:
+            log("Error reading mteval.score: " + str(e),red)
+            errors = True
+
+    if succeeded.get('ter'):
+        value, _ = readscore(outprefix + '.ter.score', parseter, "TER")
+        if value is not None:
+            ter = value
 
 
     log("SCORE SUMMARY\n===================\n")
@@ -305,5 +435,98 @@ def mtscore(matrexdir, sourcexml, refxml, targetxml, outprefix):
 
     return not errors
 
+
+def readsentences(filename):
+    with open(filename,'r',encoding='utf-8') as f:
+        return [ line.strip().split() for line in f ]
+
+def ngramcounts(tokens, n):
+    return Counter( tuple(tokens[i:i+n]) for i in range(0, len(tokens) - n + 1) )
+
+def editdistance(hyp, ref):
+    """Word-level Levenshtein distance"""
+    prev = list(range(0, len(ref)+1))
+    for i, h in enumerate(hyp):
+        cur = [i+1]
+        for j, r in enumerate(ref):
+            cur.append(min(prev[j+1] + 1, cur[j] + 1, prev[j] + (h != r)))
+        prev = cur
+    return prev[-1]
+
+BLEUORDER = 4
+#column layout of the sentence statistics matrix
+BLEU_MATCHES = 0 #BLEUORDER columns: clipped n-gram matches for n=1..BLEUORDER
+BLEU_TOTALS = BLEUORDER #BLEUORDER columns: hypothesis n-grams for n=1..BLEUORDER
+HYPLENGTH = 2*BLEUORDER
+REFLENGTH = 2*BLEUORDER+1
+EDITS = 2*BLEUORDER+2
+STATCOLUMNS = 2*BLEUORDER+3
+
+def sentencestats(hyps, refs):
+    """Computes sufficient statistics for BLEU and TER for each sentence, returns a (sentences x STATCOLUMNS) matrix. TER is computed without block shifts (i.e. word edit distance normalised by reference length)."""
+    if len(hyps) != len(refs):
+        raise Exception("Number of output sentences (" + str(len(hyps)) + ") does not match number of reference sentences (" + str(len(refs)) + ")")
+    stats = numpy.zeros((len(hyps), STATCOLUMNS), dtype=numpy.float64)
+    for i, (hyp, ref) in enumerate(zip(hyps, refs)):
+        for n in range(1, BLEUORDER+1):
+            hypcounts = ngramcounts(hyp, n)
+            refcounts = ngramcounts(ref, n)
+            stats[i,BLEU_MATCHES+n-1] = sum( min(count, refcounts[ngram]) for ngram, count in hypcounts.items() )
+            stats[i,BLEU_TOTALS+n-1] = max(len(hyp) - n + 1, 0)
+        stats[i,HYPLENGTH] = len(hyp)
+        stats[i,REFLENGTH] = len(ref)
+        stats[i,EDITS] = editdistance(hyp, ref)
+    return stats
+
+def bleu(totals):
+    """Computes corpus BLEU from summed sentence statistics, totals may be a vector or a (samples x STATCOLUMNS) matrix"""
+    totals = numpy.atleast_2d(totals)
+    matches = totals[:,BLEU_MATCHES:BLEU_MATCHES+BLEUORDER]
+    ngrams = totals[:,BLEU_TOTALS:BLEU_TOTALS+BLEUORDER]
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        logprecision = numpy.where((matches > 0) & (ngrams > 0), numpy.log(matches) - numpy.log(numpy.maximum(ngrams,1)), -numpy.inf).mean(axis=1)
+        brevity = numpy.minimum(0.0, 1.0 - totals[:,REFLENGTH] / totals[:,HYPLENGTH])
+    return numpy.nan_to_num(numpy.exp(logprecision + brevity), nan=0.0)
+
+def ter(totals):
+    """Computes corpus TER from summed sentence statistics, totals may be a vector or a (samples x STATCOLUMNS) matrix"""
+    totals = numpy.atleast_2d(totals)
+    return totals[:,EDITS] / numpy.maximum(totals[:,REFLENGTH], 1)
+
+def pairedbootstrap(basestats, systemstats, samples=1000, confidence=0.95, seed=1, blocksize=100):
+    """Paired bootstrap resampling (Koehn, 2004) over sentence statistics of a baseline and a system. Each resample is drawn as a vector of multinomial sentence counts, so the summed statistics of a block of resamples come from a single matrix product. Returns a dictionary per metric with scores, confidence intervals and the p-value of the system not improving over the baseline."""
+    if basestats.shape != systemstats.shape:
+        raise Exception("Baseline and system statistics differ in shape: " + str(basestats.shape) + " vs " + str(systemstats.shape))
+    n = basestats.shape[0]
+    random = numpy.random.RandomState(seed)
+    basetotals = []
+    systemtotals = []
+    for begin in range(0, samples, blocksize):
+        weights = random.multinomial(n, numpy.full(n, 1.0/n), size=min(blocksize, samples - begin)).astype(numpy.float64)
+        basetotals.append(weights.dot(basestats))
+        systemtotals.append(weights.dot(systemstats))
+    basetotals = numpy.vstack(basetotals)
+    systemtotals = numpy.vstack(systemtotals)
+
+    alpha = (1.0 - confidence) / 2
+    results = {}
+    for metric, f, higherisbetter in (('BLEU', bleu, True), ('TER', ter, False)):
+        basescores = f(basetotals)
+        systemscores = f(systemtotals)
+        delta = systemscores - basescores
+        if higherisbetter:
+            p = numpy.mean(delta <= 0)
+        else:
+            p = numpy.mean(delta >= 0)
+        results[metric] = {
+            'baseline': float(f(basestats.sum(axis=0))[0]),
+            'system': float(f(systemstats.sum(axis=0))[0]),
+            'delta': float(f(systemstats.sum(axis=0))[0] - f(basestats.sum(axis=0))[0]),
+            'delta_interval': tuple( float(x) for x in numpy.quantile(delta, [alpha, 1.0-alpha]) ),
+            'system_interval': tuple( float(x) for x in numpy.quantile(systemscores, [alpha, 1.0-alpha]) ),
+            'p': float(p),
+        }
+    return results
+
 if __name__ == '__main__':
     main()
@@ -8,15 +8,19 @@ import numpy
 import argparse
 
 from copy import copy
-from colibrimt.alignmentmodel import FeaturedAlignmentModel
+from colibrimt.alignmentmodel import AlignmentModel
+from colibrimt.checkpoint import Checkpoint, INTERVAL, filekey
+from colibrimt.instrumentation import metrics, addmetricsarguments, setupmetrics
+from colibrimt.logger import log, setlevel, debugging, Progress, addloggingarguments, setuplogging
 
 
-def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", constrainsourcemodel = None, constraintargetmodel = None, constrainskipgrams=False, scorefilter=None,quiet=False,debug=False):
+def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", constrainsourcemodel = None, constraintargetmodel = None, constrainskipgrams=False, scorefilter=None,quiet=False,debug=False, checkpoint=None, decoders=None, resumed=None):
+    """Finds skipgram pairs and adds them to the alignment model. With a checkpoint (and decoders, a (source, target) tuple of class decoders), progress is journaled: the skipgram pairs found and every source pattern completed. Resumed is a tuple of (skipgram pairs found, set of completed source patterns) from an earlier run, the pairs are added again and the completed source patterns are not processed again"""
     if constrainskipgrams: #strict constraints
         sourcemodel = constrainsourcemodel
         targetmodel = constraintargetmodel
     else:
-        if not quiet: print("Writing all source patterns to temporary file",file=sys.stderr)
+        if not quiet: log.info("Writing all source patterns to temporary file")
         sourcepatternfile = tmpdir + "/sourcepatterns.colibri.dat"
         with open(sourcepatternfile,'wb') as f:
             for sourcepattern in alignmodel.sourcepatterns():
@@ -24,7 +28,7 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
                     f.write(bytes(sourcepattern) + b'\0')
 
 
-        if not quiet: print("Writing all target patterns to temporary file",file=sys.stderr)
+        if not quiet: log.info("Writing all target patterns to temporary file")
         targetpatternfile = tmpdir + "/targetpatterns.colibri.dat"
         with open(targetpatternfile,'wb') as f:
             for targetpattern in alignmodel.targetpatterns():
@@ -42,38 +46,60 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
         #we first build skipgrams from the patterns found in the phrase-table, for both sides independently,
         #using indexed pattern models
 
-        if not quiet: print("Building source pattern model",file=sys.stderr)
-        sourcemodel = colibricore.IndexedPatternModel()
-        sourcemodel.train(sourcepatternfile,options, constrainsourcemodel)
+        if not quiet: log.info("Building source pattern model")
+        with metrics.span('buildsourcemodel'):
+            sourcemodel = colibricore.IndexedPatternModel()
+            sourcemodel.train(sourcepatternfile,options, constrainsourcemodel)
 
-        if not quiet: print("Building target pattern model",file=sys.stderr)
-        targetmodel = colibricore.IndexedPatternModel()
-        targetmodel.train(targetpatternfile,options, constraintargetmodel)
+        if not quiet: log.info("Building target pattern model")
+        with metrics.span('buildtargetmodel'):
+            targetmodel = colibricore.IndexedPatternModel()
+            targetmodel.train(targetpatternfile,options, constraintargetmodel)
 
     #then for each pair in the phrasetable, we see if we can find abstracted pairs
     found = 0
 
     skipped = 0
 
-    if not quiet: print("Computing total count",file=sys.stderr)
+    if not quiet: log.info("Computing total count")
     total = alignmodel.itemcount()
 
     addlist = []
     num = 0
 
-    if not quiet: print("Finding abstracted pairs",file=sys.stderr)
-    for sourcepattern, targetpattern, features in alignmodel.items():
+    done = set()
+    if resumed:
+        pairs, done = resumed
+        for sourcetemplate, targettemplate, features in pairs:
+            alignmodel.add(sourcetemplate, targettemplate, features)
+        found = len(pairs)
+        if not quiet: log.info("Resumed " + str(found) + " skipgram pairs, " + str(len(done)) + " source patterns already processed")
+    prevsource = None
+
+    if not quiet: log.info("Finding abstracted pairs")
+    progress = Progress(lambda count: "found " + str(found) + " skipgram pairs thus-far, skipped " + str(skipped), total)
+    span = metrics.span('findskipgrams', profile=True).start()
+    for sourcepattern, targetpattern, features in alignmodel.triples():
+        if checkpoint and sourcepattern != prevsource:
+            #all pairs of the previous source pattern have been processed (triples are grouped by source pattern)
+            if prevsource is not None:
+                checkpoint.log( ('source', prevsource.tostring(decoders[0])) )
+                if checkpoint.due():
+                    checkpoint.save({'found': found, 'skipped': skipped})
+            prevsource = sourcepattern
+        if sourcepattern in done:
+            continue
         if not isinstance(features, list) and not isinstance(features, tuple):
-            print("WARNING: Expected feature vector, got " + str(type(features)),file=sys.stderr)
+            log.warning("WARNING: Expected feature vector, got " + str(type(features)))
             continue
         if not isinstance(features[-1], list) and not isinstance(features[-1], tuple):
-            print("WARNING: Word alignments missing for a pair, skipping....",file=sys.stderr)
+            log.warning("WARNING: Word alignments missing for a pair, skipping....")
             continue
         if sourcepattern.isskipgram() or targetpattern.isskipgram():
             continue
 
         num += 1
-        if not quiet and num % 100 == 0: print("@"+str(num)+"/"+str(total)+" = " + str(round((num/total) * 100,2)) + '%' + ",  found " + str(found) + " skipgram pairs thus-far, skipped " + str(skipped),file=sys.stderr)
+        if not quiet: progress.update()
 
 
         #is this pair strong enough to use? Assuming moses-style score-vector
@@ -84,7 +110,7 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
 
         if sourcepattern in sourcemodel and targetpattern in targetmodel:
             #find abstractions
-            if debug: print("\tFinding abstractions for sourcepattern ", sourcepattern.tostring(debug[0]) + " with targetpattern " + targetpattern.tostring(debug[1]),file=sys.stderr)
+            if debug: log.debug("\tFinding abstractions for sourcepattern " + str(sourcepattern.tostring(debug[0]) + " with targetpattern " + targetpattern.tostring(debug[1])))
             sourcetemplates = []
             targettemplates = []
 
@@ -93,14 +119,14 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
                     if constrainskipgrams and template not in sourcemodel:
                         continue
                     sourcetemplates.append(template)
-                    if debug: print("\t\tAdded source template ", template.tostring(debug[0]),file=sys.stderr)
+                    if debug: log.debug("\t\tAdded source template " + str(template.tostring(debug[0])))
 
             for template, count in targetmodel.gettemplates(targetpattern):
                 if template.isskipgram() and template in targetmodel:
                     if constrainskipgrams and template not in targetmodel:
                         continue
                     targettemplates.append(template)
-                    if debug: print("\t\tAdded source template ", template.tostring(debug[1]),file=sys.stderr)
+                    if debug: log.debug("\t\tAdded target template " + str(template.tostring(debug[1])))
 
             #these will act as a memory buffer, saving time
             sourceinstances = {}
@@ -112,7 +138,7 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
                         #we now have two skipgrams, to be proper alignments their gaps must only align with gaps:
 
 
-                        if debug: print("\t\tProcessing skipgram pair ", sourcetemplate.tostring(debug[0]) + " -- " + targettemplate.tostring(debug[1]),file=sys.stderr)
+                        if debug: log.debug("\t\tProcessing skipgram pair " + str(sourcetemplate.tostring(debug[0]) + " -- " + targettemplate.tostring(debug[1])))
 
                         validalignment=False
                         for sourceindex, targetindex in features[-1]:
@@ -120,13 +146,15 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
                             if not validalignment: break
                         if not validalignment: continue
 
-                        if debug: print("\t\tAlignment valid! Adding!",file=sys.stderr)
+                        if debug: log.debug("\t\tAlignment valid! Adding!")
 
                         #if we made it here we have a proper pair!
 
 
                         alignmodel.add(sourcetemplate,targettemplate, [1.0,0.0,1.0,0.0,features[-2],copy(features[-1])]  ) #lexical probability disabled (0),
                         found += 1
+                        if checkpoint:
+                            checkpoint.log( ('pair', sourcetemplate.tostring(decoders[0]), targettemplate.tostring(decoders[1]), [1.0,0.0,1.0,0.0,features[-2],copy(features[-1])]) )
 
                         #Now we have to compute a new score vector based on the score vectors of the possible instantiations
                         #find all instantiations
@@ -159,18 +187,26 @@ def extractskipgrams(alignmodel, maxlength= 8, minskiptypes=2, tmpdir="./", cons
         else:
             skipped += 1
 
+    span.add(num)
+    span.stop()
+    if not quiet: progress.done()
+    metrics.count('pairs', num)
+    metrics.count('skipgrampairs', found)
+    metrics.count('skipped', skipped)
+
     if not constrainskipgrams:
-        print("Unloading models",file=sys.stderr)
+        log.info("Unloading models")
         del sourcemodel
         del targetmodel
 
 
     #now we are going to renormalise the scores (leave lexical weights intact as is)
-    print("Renormalising alignment model",file=sys.stderr)
-    alignmodel.normalize('s-t-')
+    log.info("Renormalising alignment model")
+    with metrics.span('normalize'):
+        alignmodel.normalize('s-t-')
 
 
-    print("Cleanup",file=sys.stderr)
+    log.info("Cleanup")
     if not constrainskipgrams:
         os.unlink(sourcepatternfile)
         os.unlink(targetpatternfile)
@@ -191,12 +227,25 @@ def main():
     parser.add_argument('-M','--constraintargetmodel',type=str,help="Target patternmodel, used to constrain possible patterns", action='store',required=False)
     parser.add_argument('-p','--pts',type=float,help="Minimum probability p(t|s) for skipgram consideration (set to a high number)",default=0.75, action='store',required=False)
     parser.add_argument('-P','--pst',type=float,help="Minimum probability p(s|t) for skipgram consideration (set to a high number)", default=0.75,action='store',required=False)
-    parser.add_argument('-D','--debug',help="Enable debug mode", action='store_true',required=False)
+    parser.add_argument('-D','--debug',help="Enable debug mode (implies -v)", action='store_true',required=False)
+    parser.add_argument('--topk',type=int,help="When loading a phrase table, keep only the k best translation options per source phrase (by p(t|s)), 0 = keep all", action='store',default=0,required=False)
+    parser.add_argument('--significance',type=float,help="When loading a phrase table, prune translation options whose significance (negative log p-value of Fisher's exact test on the phrase-table counts) is below this threshold, requires --corpussize", action='store',default=0.0,required=False)
+    parser.add_argument('--corpussize',type=int,help="Number of sentence pairs in the training corpus (for --significance)", action='store',default=0,required=False)
+    parser.add_argument('--compact',type=str,help="Compact score storage to reduce memory usage: float16 or uint8 (8-bit quantised)", action='store',choices=('float16','uint8'),required=False)
+    parser.add_argument('--nonative',help="Do not use the native phrase-table loader (colibri-mosesphrasetable2alignmodel) even if it is installed", action='store_true',required=False)
+    parser.add_argument('--checkpoint',type=str,help="Checkpoint file, progress is saved here periodically so an interrupted job can be resumed with --resume (default: output file + .checkpoint)", action='store',default="",required=False)
+    parser.add_argument('--checkpointinterval',type=int,help="Seconds between checkpoints, 0 disables checkpointing", action='store',default=0,required=False)
+    parser.add_argument('--resume',help="Resume from the checkpoint of an earlier, interrupted, run with the same input and parameters, checkpoints continue to be saved (every " + str(INTERVAL) + " seconds unless --checkpointinterval is set)", action='store_true',required=False)
+    addmetricsarguments(parser)
+    addloggingarguments(parser)
     args = parser.parse_args()
+    setuplogging(args)
+    if args.debug: setlevel(1)
+    setupmetrics(args, 'colibri-extractskipgrams')
     #args.storeconst, args.dataset, args.num, args.bar
 
     if args.constrainsourcemodel:
-        print("Loading source model for constraints",file=sys.stderr)
+        log.info("Loading source model for constraints")
         if args.constrainskipgrams:
             constrainsourcemodel = colibricore.IndexedPatternModel(args.constrainsourcemodel)
         else:
@@ -205,7 +254,7 @@ def main():
         constrainsourcemodel = None
 
     if args.constraintargetmodel:
-        print("Loading target model for constraints",file=sys.stderr)
+        log.info("Loading target model for constraints")
         if args.constrainskipgrams:
             constraintargetmodel = colibricore.IndexedPatternModel(args.constraintargetmodel)
         else:
@@ -214,25 +263,17 @@ def main():
         constraintargetmodel = None
 
 
-    alignmodel = FeaturedAlignmentModel()
+    alignmodel = AlignmentModel(compact=args.compact)
     if os.path.exists(args.inputfile + '.colibri.alignmodel-keys'):
-        print("Loading colibri alignment model",file=sys.stderr)
-        alignmodel.load(args.inputfile)
+        log.info("Loading colibri alignment model")
+        with metrics.span('loadalignmodel'):
+            alignmodel.load(args.inputfile)
     else:
-        print("Loading class encoders",file=sys.stderr)
+        log.info("Loading class encoders")
         sourceencoder = colibricore.ClassEncoder(args.sourceclassfile)
         targetencoder = colibricore.ClassEncoder(args.targetclassfile)
-        print("Loading moses phrase table",file=sys.stderr)
-        alignmodel.loadmosesphrasetable(args.inputfile, sourceencoder, targetencoder)
-
-    if args.debug:
-        debug = (colibricore.ClassDecoder(args.sourceclassfile), colibricore.ClassDecoder(args.targetclassfile))
-    else:
-        debug = False
-
-
-    scorefilter = lambda features:  features[0] >= args.pst and features[2] >= args.pts
-    extractskipgrams(alignmodel, args.maxlength, args.minskiptypes, args.tmpdir, constrainsourcemodel, constraintargetmodel,args.constrainskipgrams,scorefilter,False, debug)
+        log.info("Loading moses phrase table")
+        alignmodel.loadmosesphrasetable(args.inputfile, sourceencoder, targetencoder, native=False if args.nonative else None, topk=args.topk, significance=args.significance, corpussize=args.corpussize)
 
     if args.outputfile:
         outfile = args.outputfile
@@ -242,8 +283,39 @@ def main():
         if outfile[-4:] == '.bz2': outfile = outfile[:-4]
         if outfile[-11:] == '.phrasetable': outfile = outfile[:-11]
         if outfile[-12:] == '.phrase-table': outfile = outfile[:-12]
-    print("Saving alignment model to " + outfile,file=sys.stderr)
-    alignmodel.save(outfile) #extensions will be added automatically
+
+    if args.resume and args.checkpointinterval <= 0:
+        args.checkpointinterval = INTERVAL
+    decoders = None
+    if debugging() or args.checkpointinterval > 0:
+        decoders = (colibricore.ClassDecoder(args.sourceclassfile), colibricore.ClassDecoder(args.targetclassfile))
+    debug = decoders if debugging() else False
+
+    checkpoint = resumed = None
+    if args.checkpointinterval > 0:
+        key = (filekey(args.inputfile), args.maxlength, args.minskiptypes, args.pts, args.pst, filekey(args.constrainsourcemodel), filekey(args.constraintargetmodel), args.constrainskipgrams, args.topk, args.significance)
+        checkpoint = Checkpoint(args.checkpoint if args.checkpoint else outfile + ".checkpoint", key, args.checkpointinterval)
+        if args.resume:
+            resumed = checkpoint.resume()
+            if resumed:
+                sourceencoder = colibricore.ClassEncoder(args.sourceclassfile)
+                targetencoder = colibricore.ClassEncoder(args.targetclassfile)
+                pairs = [ (sourceencoder.buildpattern(entry[1]), targetencoder.buildpattern(entry[2]), entry[3]) for entry in resumed[1] if entry[0] == 'pair' ]
+                done = set( sourceencoder.buildpattern(entry[1]) for entry in resumed[1] if entry[0] == 'source' )
+                resumed = (pairs, done)
+            else:
+                log.info("No checkpoint found, starting from scratch")
+        checkpoint.start(resumed is not None)
+
+    scorefilter = lambda features:  features[0] >= args.pst and features[2] >= args.pts
+    extractskipgrams(alignmodel, args.maxlength, args.minskiptypes, args.tmpdir, constrainsourcemodel, constraintargetmodel,args.constrainskipgrams,scorefilter,False, debug, checkpoint, decoders if checkpoint else None, resumed)
+
+    log.info("Saving alignment model to " + outfile)
+    with metrics.span('save'):
+        alignmodel.save(outfile) #extensions will be added automatically
+    if checkpoint:
+        checkpoint.remove()
+    metrics.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import bz2
+import gzip
+import hashlib
+import argparse
+import colibricore #pylint: disable=import-error
+from colibrimt.alignmentmodel import AlignmentModel
+from colibrimt.cache import filedigest
+from colibrimt.native import classfile
+from colibrimt.instrumentation import metrics, addmetricsarguments, setupmetrics
+from colibrimt.logger import log, Progress, addloggingarguments, setuplogging
+
+#Filtering of phrase tables and alignment models given the test input (like filter-model-given-input in Moses): only
+#entries whose source side occurs in the test (and development) data, as n-gram or as skipgram template, are kept.
+
+
+def buildfilter(corpusfiles, maxlength=8, skipgrams=True):
+    """Builds a pattern model of all n-grams (and, if skipgrams is set, all skipgram templates) up to maxlength in the given encoded corpora, to be used as a filter or constraint model"""
+    options = colibricore.PatternModelOptions(mintokens=1, maxlength=maxlength, doskipgrams_exhaustive=skipgrams)
+    model = colibricore.UnindexedPatternModel()
+    for corpusfile in corpusfiles:
+        log.info("Building filter on " + corpusfile + " (maxlength=" + str(maxlength) + ", skipgrams=" + str(skipgrams) + ")")
+        model.train(corpusfile, options)
+    log.info("\tFilter has " + str(len(model)) + " source patterns")
+    return model
+
+
+def encodecorpus(textfile, sourceencoder, outputfile):
+    """Encode a plain text corpus for use with buildfilter(), words unknown to the encoder are encoded as unknown"""
+    sourceencoder.encodefile(textfile, outputfile)
+    return outputfile
+
+
+def openfile(filename, mode='r'):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode + 't', encoding='utf-8')
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, mode + 't', encoding='utf-8')
+    else:
+        return open(filename, mode, encoding='utf-8')
+
+
+def filterphrasetable(filename, outputfile, sourceencoder, filtermodel, delimiter="|||"):
+    """Streams a Moses phrase table and writes only the entries whose source phrase is in the filter model. Lines for the same source phrase are consecutive, so each source phrase is encoded only once. Returns (lines read, lines kept)"""
+    kept = 0
+    read = 0
+    prevsource = None
+    keep = False
+    progress = Progress(lambda count: "lines filtered, " + str(kept) + " kept")
+    with metrics.span('filterphrasetable', profile=True) as span:
+        with openfile(filename) as f, openfile(outputfile,'w') as out:
+            for line in f:
+                read += 1
+                progress.update()
+                end = line.find(delimiter)
+                if end == -1:
+                    log.warning("Invalid line " + str(read) + ", skipping: " + line.strip())
+                    continue
+                source = line[:end].strip()
+                if source != prevsource:
+                    prevsource = source
+                    try:
+                        keep = sourceencoder.buildpattern(source) in filtermodel
+                    except Exception: #unknown words or invalid patterns can not occur in the test data
+                        keep = False
+                if keep:
+                    out.write(line)
+                    kept += 1
+            span.add(read)
+    progress.done()
+    metrics.count('filter_read', read)
+    metrics.count('filter_kept', kept)
+    log.info("Filtered phrase table " + filename + ": kept " + str(kept) + " of " + str(read) + " entries")
+    return read, kept
+
+
+def filteralignmodel(alignmodel, filtermodel):
+    """Returns a new alignment model with only the entries whose source pattern is in the filter model. The input may be an AlignmentModel or a filename.
+
+    Unlike filterphrasetable(), this does not stream: a binary alignment model can only be loaded as a whole, so the full input model is held in memory while filtering (only once, the result is cached by loadfiltered()). Filter the Moses phrase table instead if the full model does not fit in memory."""
+    if isinstance(alignmodel, str):
+        alignmodel = AlignmentModel(alignmodel)
+    filtered = AlignmentModel()
+    read = kept = 0
+    with metrics.span('filteralignmodel') as span:
+        for sourcepattern in alignmodel.sourcepatterns():
+            read += 1
+            if sourcepattern in filtermodel:
+                kept += 1
+                for targetpattern in alignmodel.targetpatterns(sourcepattern):
+                    filtered.add(sourcepattern, targetpattern, alignmodel[(sourcepattern, targetpattern)])
+        span.add(read)
+    metrics.count('filter_read', read)
+    metrics.count('filter_kept', kept)
+    log.info("Filtered alignment model: kept " + str(kept) + " of " + str(read) + " source patterns")
+    return filtered
+
+
+def filterkey(inputfile, corpusfiles, maxlength, skipgrams, classfiles=()):
+    """Cache key for a filtered model: digest of the test corpora and the class files (which determine the encoding of the test corpora and of a phrase table), and the identity (name, size, modification time) of the input model"""
+    h = hashlib.sha1()
+    st = os.stat(inputfile)
+    h.update((os.path.abspath(inputfile) + "\t" + str(st.st_size) + "\t" + str(st.st_mtime_ns) + "\t" + str(maxlength) + "\t" + str(skipgrams)).encode('utf-8'))
+    for filename in classfiles:
+        h.update(("\t" + filedigest(filename)).encode('utf-8'))
+    for corpusfile in corpusfiles:
+        with open(corpusfile,'rb') as f:
+            for block in iter(lambda: f.read(1024*1024), b""):
+                h.update(block)
+    return h.hexdigest()[:16]
+
+
+def loadfiltered(inputfile, corpusfiles, sourceencoder=None, targetencoder=None, maxlength=8, skipgrams=True, cachedir="."):
+    """Returns an AlignmentModel with only the entries relevant to the given encoded test corpora. The input is a colibri alignment model or a Moses phrase table (the latter requires source and target encoders). The filtered model is cached in cachedir per test set, so subsequent runs load only the relevant slice"""
+    classfiles = [ filename for filename in (classfile(sourceencoder), classfile(targetencoder)) if filename ] #classfile() returns None for a missing encoder
+    cachefile = os.path.join(cachedir, "filtered-" + filterkey(inputfile, corpusfiles, maxlength, skipgrams, classfiles) + ".colibri.alignmodel")
+    if os.path.exists(cachefile):
+        log.info("Loading filtered model from cache: " + cachefile)
+        metrics.count('filter_cachehits')
+        return AlignmentModel(cachefile)
+
+    filtermodel = buildfilter(corpusfiles, maxlength, skipgrams)
+    if os.path.exists(inputfile) and not isphrasetable(inputfile):
+        alignmodel = filteralignmodel(inputfile, filtermodel)
+    else:
+        if sourceencoder is None or targetencoder is None:
+            raise Exception("Source and target class encoders are required to filter a phrase table")
+        filteredtable = cachefile.replace(".colibri.alignmodel", ".phrasetable.gz")
+        filterphrasetable(inputfile, filteredtable, sourceencoder, filtermodel)
+        alignmodel = AlignmentModel()
+        alignmodel.loadmosesphrasetable(filteredtable, sourceencoder, targetencoder)
+        os.unlink(filteredtable)
+    alignmodel.save(cachefile)
+    return alignmodel
+
+
+def isphrasetable(filename):
+    """Is this a Moses phrase table (rather than a binary colibri alignment model)?"""
+    if filename.endswith('.gz') or filename.endswith('.bz2'):
+        return True
+    with open(filename,'rb') as f:
+        head = f.read(4096)
+    return b"|||" in head
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter a Moses phrase table or colibri alignment model given the test input: only entries whose source side occurs in the test data (as n-gram or skipgram) are kept", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i','--inputfile',type=str,help="Input phrase table or alignment model", action='store',required=True)
+    parser.add_argument('-o','--outputfile',type=str,help="Output file: a phrase table if the input is a phrase table, an alignment model otherwise", action='store',required=True)
+    parser.add_argument('-S','--sourceclassfile',type=str,help="Source class file", action='store',required=True)
+    parser.add_argument('-f','--testfile',type=str,help="Test corpus (plain text, tokenised, one sentence per line), may be specified multiple times (e.g. for test and development data)", action='append',required=True)
+    parser.add_argument('-l','--maxlength',type=int,help="Maximum length of the patterns in the phrase table", action='store',default=8)
+    parser.add_argument('--noskipgrams',help="Do not consider skipgram templates", action='store_true',default=False)
+    parser.add_argument('-W','--tmpdir',type=str,help="Temporary work directory", action='store',default="./")
+    addmetricsarguments(parser)
+    addloggingarguments(parser)
+    args = parser.parse_args()
+    setuplogging(args)
+    setupmetrics(args, 'colibri-filter')
+
+    log.info("Loading source encoder " + args.sourceclassfile)
+    sourceencoder = colibricore.ClassEncoder(args.sourceclassfile)
+    corpusfiles = []
+    for i, testfile in enumerate(args.testfile):
+        corpusfiles.append(encodecorpus(testfile, sourceencoder, os.path.join(args.tmpdir, "filter-" + str(i) + ".colibri.dat")))
+    filtermodel = buildfilter(corpusfiles, args.maxlength, not args.noskipgrams)
+
+    if isphrasetable(args.inputfile):
+        filterphrasetable(args.inputfile, args.outputfile, sourceencoder, filtermodel)
+    else:
+        filteralignmodel(args.inputfile, filtermodel).save(args.outputfile)
+
+    for corpusfile in corpusfiles:
+        os.unlink(corpusfile)
+    metrics.close()
+
+
+if __name__ == '__main__':
+    main()
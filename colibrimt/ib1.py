@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import numpy
+from colibrimt.logger import log
+from colibrimt.keywordstore import BITSETPREFIX
+
+#IB1 memory-based classifier in NumPy, a drop-in alternative to timbl.TimblClassifier for the symbolic training files
+#written by colibri-extractfeatures (tab-separated features, class label last, optionally followed by an exemplar weight).
+#Implements the Timbl defaults used by colibri-mt: IB1 (-a 0), overlap metric (-m O), gain ratio, information gain or no
+#feature weighting (-w gr/ig/nw), k nearest distances (-k, all instances at the k nearest distances vote, as in Timbl)
+#and majority voting (-d Z). Feature values are encoded as integers per feature, so a whole batch of instances is
+#classified at once with weighted-overlap distances against the dense instance matrix. Sparse keyword features (kw:<hex>
+#bitsets, see colibri-extractfeatures --sparsekeywords) are kept as the bitset itself and contribute the feature weight
+#times the number of keywords in which two instances differ (Hamming distance), like one overlap feature per keyword.
+
+EXTENSION = ".npibase"
+WEIGHTINGS = ('gr','ig','nw')
+BATCHSIZE = 2**24 #maximum number of instance-exemplar comparisons per block, bounds memory use
+POPCOUNT = numpy.array([ bin(i).count('1') for i in range(256) ], dtype=numpy.uint8)
+
+
+def parseoptions(timbloptions):
+    """Parse a Timbl option string, returns (k, weighting, exemplarweights). Raises ValueError for options this backend does not implement"""
+    k = 1
+    weighting = 'gr'
+    exemplarweights = False
+    options = timbloptions.split()
+    i = 0
+    while i < len(options):
+        option = options[i]
+        if option in ('-a','-k','-w','-m','-d') and len(option) == 2:
+            i += 1
+            if i == len(options):
+                raise ValueError("Missing value for Timbl option " + option)
+            value = options[i]
+        elif option[:2] in ('-a','-k','-w','-m','-d'):
+            option, value = option[:2], option[2:]
+        else:
+            value = None
+        if option == '-a' and value not in ('0','IB1'):
+            raise ValueError("Only IB1 (-a 0) is supported by the numpy backend, got -a " + value)
+        elif option == '-k':
+            k = int(value)
+        elif option == '-w':
+            weighting = {'0': 'nw', '1': 'gr', '2': 'ig'}.get(value, value)
+            if weighting not in WEIGHTINGS:
+                raise ValueError("Unsupported feature weighting for the numpy backend: -w " + value)
+        elif option == '-m' and value != 'O':
+            raise ValueError("Only the overlap metric (-m O) is supported by the numpy backend, got -m " + value)
+        elif option == '-d' and value != 'Z':
+            raise ValueError("Only majority voting (-d Z) is supported by the numpy backend, got -d " + value)
+        elif option == '-s':
+            exemplarweights = True
+        i += 1
+    return k, weighting, exemplarweights
+
+
+def popcount(a):
+    """Number of bits set in every element of an int64 array"""
+    a = numpy.ascontiguousarray(a, dtype=numpy.int64)
+    return POPCOUNT[a.view(numpy.uint8)].reshape(a.shape + (8,)).sum(axis=-1)
+
+
+def entropy(counts):
+    counts = counts[counts > 0]
+    if not len(counts):
+        return 0.0
+    p = counts / counts.sum()
+    return float(-(p * numpy.log2(p)).sum())
+
+
+def featureweights(instances, labels, exemplarweights, weighting='gr'):
+    """Information gain or gain ratio of every feature (columns of the integer-encoded instance matrix)"""
+    if weighting == 'nw' or not len(instances):
+        return numpy.ones(instances.shape[1])
+    classcount = int(labels.max()) + 1
+    classentropy = entropy(numpy.bincount(labels, weights=exemplarweights, minlength=classcount))
+    total = exemplarweights.sum()
+    weights = numpy.zeros(instances.shape[1])
+    for i in range(instances.shape[1]):
+        values = numpy.unique(instances[:,i], return_inverse=True)[1].reshape(-1) #compact codes (bitsets are not)
+        valuecount = int(values.max()) + 1
+        joint = numpy.bincount(values * classcount + labels, weights=exemplarweights, minlength=valuecount * classcount).reshape(valuecount, classcount)
+        valuetotals = joint.sum(axis=1)
+        conditional = sum( valuetotals[v] / total * entropy(joint[v]) for v in range(valuecount) if valuetotals[v] > 0 )
+        gain = classentropy - conditional
+        if weighting == 'gr':
+            splitinfo = entropy(valuetotals)
+            weights[i] = gain / splitinfo if splitinfo > 0 else 0.0
+        else:
+            weights[i] = gain
+    return weights
+
+
+class IB1Classifier:
+    def __init__(self, fileprefix, timbloptions="", normalize=True, encoding='utf-8'):
+        self.fileprefix = fileprefix
+        self.timbloptions = timbloptions
+        self.k, self.weighting, self.exemplarweights = parseoptions(timbloptions)
+        self.normalize = normalize
+        self.encoding = encoding
+        self.instances = None #(instances, features) int32 matrix of value codes (int64 if there are bitset features)
+        self.labels = None #int32 class codes
+        self.weights = None #exemplar weights
+        self.classes = []
+        self.values = [] #per feature: value => code
+        self.bitsets = [] #features that are keyword bitsets, their values are the bitsets themselves
+        self.featureweights = None
+
+    def train(self, save=False):
+        """Read the training file (fileprefix.train) and compute the feature weights"""
+        rows = []
+        labels = []
+        weights = []
+        classes = {}
+        with open(self.fileprefix + ".train",'r',encoding=self.encoding) as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2:
+                    continue
+                if self.exemplarweights:
+                    weights.append(float(fields[-1]))
+                    fields = fields[:-1]
+                else:
+                    weights.append(1.0)
+                label = fields[-1]
+                if label not in classes:
+                    classes[label] = len(classes)
+                labels.append(classes[label])
+                rows.append(fields[:-1])
+        featurecount = max( len(row) for row in rows ) if rows else 0
+        self.values = [ {} for _ in range(featurecount) ]
+        self.bitsets = [ j for j in range(featurecount) if rows and all( len(row) > j and row[j].startswith(BITSETPREFIX) for row in rows ) ]
+        self.instances = numpy.zeros((len(rows), featurecount), dtype=numpy.int64 if self.bitsets else numpy.int32)
+        for i, row in enumerate(rows):
+            for j, value in enumerate(row):
+                if j in self.bitsets:
+                    self.instances[i,j] = int(value[len(BITSETPREFIX):], 16)
+                else:
+                    self.instances[i,j] = self.values[j].setdefault(value, len(self.values[j]))
+        self.labels = numpy.array(labels, dtype=numpy.int32)
+        self.weights = numpy.array(weights, dtype=numpy.float64)
+        self.classes = sorted(classes, key=lambda label: classes[label])
+        self.featureweights = featureweights(self.instances, self.labels, self.weights, self.weighting)
+        log.debug("Trained IB1 classifier " + self.fileprefix + ": " + str(len(rows)) + " instances, " + str(featurecount) + " features, " + str(len(self.classes)) + " classes")
+        if save:
+            self.save()
+
+    def save(self):
+        """Save the instance base to fileprefix.npibase"""
+        arrays = {'instances': self.instances, 'labels': self.labels, 'weights': self.weights, 'featureweights': self.featureweights, 'classes': numpy.array(self.classes, dtype=str), 'bitsets': numpy.array(self.bitsets, dtype=numpy.int32)}
+        for j, values in enumerate(self.values):
+            arrays['values' + str(j)] = numpy.array(sorted(values, key=lambda value: values[value]), dtype=str)
+        with open(self.fileprefix + EXTENSION,'wb') as f:
+            numpy.savez(f, **arrays)
+
+    def load(self):
+        with numpy.load(self.fileprefix + EXTENSION) as arrays:
+            self.instances = arrays['instances']
+            self.labels = arrays['labels']
+            self.weights = arrays['weights']
+            self.featureweights = arrays['featureweights']
+            self.classes = [ str(label) for label in arrays['classes'] ]
+            self.values = [ { str(value): code for code, value in enumerate(arrays['values' + str(j)]) } for j in range(self.instances.shape[1]) ]
+            self.bitsets = [ int(j) for j in arrays['bitsets'] ] if 'bitsets' in arrays else []
+
+    def encode(self, featurevectors):
+        """Integer-encode a batch of feature vectors, values not seen in training get code -1 (they never match)"""
+        encoded = numpy.full((len(featurevectors), len(self.values)), -1, dtype=self.instances.dtype)
+        for i, features in enumerate(featurevectors):
+            if len(features) != len(self.values):
+                raise ValueError("Expected " + str(len(self.values)) + " features, got " + str(len(features)))
+            for j, value in enumerate(features):
+                if j in self.bitsets:
+                    if not value.startswith(BITSETPREFIX):
+                        raise ValueError("Expected a keyword bitset for feature " + str(j+1) + ", got " + value)
+                    encoded[i,j] = int(value[len(BITSETPREFIX):], 16)
+                else:
+                    encoded[i,j] = self.values[j].get(value, -1)
+        return encoded
+
+    def distances(self, encoded):
+        """Weighted overlap distances between a batch of encoded instances and all training instances, (batch, instances) matrix"""
+        distances = numpy.zeros((len(encoded), len(self.instances)))
+        for j, weight in enumerate(self.featureweights):
+            if weight and j in self.bitsets:
+                distances += weight * popcount(encoded[:,j,None] ^ self.instances[None,:,j])
+            elif weight:
+                distances += weight * (encoded[:,j,None] != self.instances[None,:,j])
+        return distances
+
+    def _ensureloaded(self):
+        if self.instances is None:
+            if os.path.exists(self.fileprefix + EXTENSION):
+                self.load()
+            else:
+                self.train()
+
+    def _votes(self, encoded, exclude=None):
+        """Class votes of the nearest neighbours of a batch of encoded instances, returns (votes, nearest distances). For leave-one-out, exclude holds for every encoded instance the index of the training instance it is, which is not counted as its own neighbour"""
+        classcount = len(self.classes)
+        votes = numpy.zeros((len(encoded), classcount))
+        classweights = numpy.zeros((len(self.instances), classcount)) #exemplar weight of every training instance in the column of its class
+        classweights[numpy.arange(len(self.instances)), self.labels] = self.weights
+        nearestdistance = numpy.zeros(len(encoded))
+        blocksize = max(1, BATCHSIZE // max(1,len(self.instances)))
+        for begin in range(0, len(encoded), blocksize):
+            distances = self.distances(encoded[begin:begin+blocksize])
+            #precision of the comparison: distances are sums of the same weights, round to avoid float noise between equal distances
+            distances = numpy.round(distances, 10)
+            if exclude is not None:
+                distances[numpy.arange(len(distances)), exclude[begin:begin+blocksize]] = numpy.inf
+            if self.k == 1:
+                mindistance = distances.min(axis=1)
+                neighbours = distances <= mindistance[:,None]
+            else:
+                mindistance = numpy.zeros(len(distances))
+                neighbours = numpy.zeros(distances.shape, dtype=bool)
+                for i, row in enumerate(distances):
+                    levels = numpy.unique(row)[:self.k]
+                    mindistance[i] = levels[0]
+                    neighbours[i] = row <= levels[-1]
+            nearestdistance[begin:begin+blocksize] = mindistance
+            votes[begin:begin+blocksize] = neighbours @ classweights
+        return votes, nearestdistance
+
+    def classifybatch(self, featurevectors):
+        """Classify a batch of feature vectors, returns a list of (classlabel, distribution, distance) triples"""
+        self._ensureloaded()
+        if not len(featurevectors):
+            return []
+        votes, nearestdistance = self._votes(self.encode(featurevectors))
+        results = []
+        for i in range(len(votes)):
+            best = int(numpy.argmax(votes[i])) #ties go to the class seen first in training
+            total = votes[i].sum() if self.normalize else 1.0
+            distribution = { self.classes[c]: float(votes[i,c] / total) for c in numpy.nonzero(votes[i])[0] }
+            results.append( (self.classes[best], distribution, float(nearestdistance[i])) )
+        return results
+
+    def leaveoneout(self, maxinstances=0, seed=1):
+        """Classify every training instance with all other instances as instance base, returns the predicted class labels. This takes time quadratic in the number of instances, with maxinstances > 0 only a random sample of that many instances is classified (against all others)"""
+        self._ensureloaded()
+        if len(self.instances) < 2:
+            return list(self.classes[label] for label in self.labels)
+        if maxinstances and len(self.instances) > maxinstances:
+            sample = numpy.sort(numpy.random.RandomState(seed).choice(len(self.instances), maxinstances, replace=False))
+        else:
+            sample = numpy.arange(len(self.instances))
+        votes, _ = self._votes(self.instances[sample], exclude=sample)
+        return [ self.classes[int(best)] for best in numpy.argmax(votes, axis=1) ]
+
+    def classify(self, features):
+        """Classify a single feature vector, returns (classlabel, distribution, distance) like timbl.TimblClassifier.classify()"""
+        return self.classifybatch([features])[0]
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import sys
+import time
+import threading
+import json
+import atexit
+import resource
+import datetime
+from collections import OrderedDict, defaultdict
+
+
+def peakrss():
+    """Peak resident set size of this process so far, in kilobytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Span:
+    """A named timed region, returned by Metrics.span(). Use as a context manager or call start() and stop() explicitly. Items processed within the span can be reported with add(), and are used to compute throughput"""
+
+    def __init__(self, metrics, name, profile=False):
+        self.metrics = metrics
+        self.name = name
+        self.profile = profile
+        self.items = 0
+        self.begintime = None
+        self.duration = 0.0
+
+    def add(self, n=1):
+        self.items += n
+
+    def start(self):
+        self.begintime = time.perf_counter()
+        if self.profile:
+            self.metrics.profileon()
+        return self
+
+    def stop(self):
+        if self.profile:
+            self.metrics.profileoff()
+        self.duration = time.perf_counter() - self.begintime
+        self.metrics.record(self)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class Metrics:
+    """Collects named timed spans, counters and peak memory usage for a tool, and exports them as JSON or in the Prometheus text format.
+
+    Spans with the same name are aggregated (total time, number of calls, items). Hot loops can be wrapped in a span with profile=True, they will then be covered by cProfile if profiling was enabled.
+
+    Spans and counters may be recorded from several threads (e.g. the worker threads of colibri-evaluate and colibri-pipeline), all updates go through a lock."""
+
+    def __init__(self, tool="colibrimt"):
+        self.tool = tool
+        self.begintime = time.perf_counter()
+        self.date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.spans = OrderedDict() #name => {'seconds': float, 'calls': int, 'items': int, 'peak_rss_kb': int}
+        self.counters = defaultdict(int)
+        self.outputfile = None
+        self.format = None
+        self.profiler = None
+        self.profilefile = None
+        self.profiledepth = 0 #profiled spans may be nested
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def resetlock(self):
+        """New lock in a forked child, the lock may have been held by another thread of the parent at the time of the fork"""
+        self.lock = threading.Lock()
+
+    def span(self, name, profile=False):
+        return Span(self, name, profile)
+
+    def profileon(self):
+        if self.profiler:
+            with self.lock:
+                if self.profiledepth == 0:
+                    self.profiler.enable()
+                self.profiledepth += 1
+
+    def profileoff(self):
+        if self.profiler:
+            with self.lock:
+                self.profiledepth -= 1
+                if self.profiledepth == 0:
+                    self.profiler.disable()
+
+    def record(self, span):
+        peak = peakrss()
+        with self.lock:
+            if span.name not in self.spans:
+                self.spans[span.name] = {'seconds': 0.0, 'calls': 0, 'items': 0, 'peak_rss_kb': 0}
+            data = self.spans[span.name]
+            data['seconds'] += span.duration
+            data['calls'] += 1
+            data['items'] += span.items
+            data['peak_rss_kb'] = peak
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def todict(self):
+        spans = OrderedDict()
+        with self.lock:
+            for name, data in self.spans.items():
+                spans[name] = dict(data)
+                spans[name]['throughput'] = data['items'] / data['seconds'] if data['items'] and data['seconds'] > 0 else 0.0
+            counters = dict(self.counters)
+        return OrderedDict([
+            ('tool', self.tool),
+            ('date', self.date),
+            ('seconds', time.perf_counter() - self.begintime),
+            ('peak_rss_kb', peakrss()),
+            ('spans', spans),
+            ('counters', OrderedDict(sorted(counters.items()))),
+        ])
+
+    def tojson(self):
+        return json.dumps(self.todict(), indent=4)
+
+    def toprometheus(self):
+        data = self.todict()
+        label = 'tool="' + self.tool + '"'
+        lines = []
+        lines.append("# HELP colibrimt_seconds Total wall time of the tool")
+        lines.append("# TYPE colibrimt_seconds gauge")
+        lines.append("colibrimt_seconds{" + label + "} " + repr(data['seconds']))
+        lines.append("# HELP colibrimt_peak_rss_bytes Peak resident set size")
+        lines.append("# TYPE colibrimt_peak_rss_bytes gauge")
+        lines.append("colibrimt_peak_rss_bytes{" + label + "} " + str(data['peak_rss_kb'] * 1024))
+        for metric, key, description in (('colibrimt_span_seconds','seconds','Time spent in a stage'), ('colibrimt_span_calls','calls','Number of times a stage was entered'), ('colibrimt_span_items','items','Items processed in a stage'), ('colibrimt_span_throughput','throughput','Items processed per second in a stage'), ('colibrimt_span_peak_rss_bytes','peak_rss_kb','Peak resident set size at the end of a stage')):
+            lines.append("# HELP " + metric + " " + description)
+            lines.append("# TYPE " + metric + " gauge")
+            for name, span in data['spans'].items():
+                value = span[key]
+                if key == 'peak_rss_kb': value *= 1024
+                lines.append(metric + "{" + label + ",span=\"" + name + "\"} " + repr(value))
+        lines.append("# HELP colibrimt_count Counters (items, skipped items, classifications, ...)")
+        lines.append("# TYPE colibrimt_count counter")
+        for name, value in data['counters'].items():
+            lines.append("colibrimt_count{" + label + ",counter=\"" + name + "\"} " + str(value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, format=None):
+        if not format:
+            if filename.endswith('.prom') or filename.endswith('.txt'):
+                format = 'prometheus'
+            else:
+                format = 'json'
+        with open(filename,'w',encoding='utf-8') as f:
+            if format == 'prometheus':
+                f.write(self.toprometheus())
+            else:
+                f.write(self.tojson() + "\n")
+
+    def setup(self, tool, outputfile=None, format=None, profilefile=None):
+        """Configure the collector for an entry point, output is written when close() is called or on exit"""
+        self.tool = tool
+        self.outputfile = outputfile
+        self.format = format
+        self.profilefile = profilefile
+        if profilefile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        atexit.register(self.close)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.profiler:
+            self.profiler.dump_stats(self.profilefile)
+            print("Profile of hot loops written to " + self.profilefile + " (inspect with python -m pstats)",file=sys.stderr)
+        if self.outputfile:
+            self.write(self.outputfile, self.format)
+            print("Metrics written to " + self.outputfile,file=sys.stderr)
+
+
+#shared collector, used by the library functions and configured by the entry points
+metrics = Metrics()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.resetlock)
+
+
+def addmetricsarguments(parser):
+    parser.add_argument('--metrics-out',dest='metricsout',type=str,help="Write timing, memory and counter metrics to this file (JSON, or Prometheus text format if the file ends in .prom or .txt)", action='store',default="")
+    parser.add_argument('--metrics-format',dest='metricsformat',type=str,help="Force the format of --metrics-out: json or prometheus", action='store',default="")
+    parser.add_argument('--profile',dest='profilefile',type=str,help="Profile the hot loops with cProfile and write the statistics to this file", action='store',default="")
+
+def setupmetrics(args, tool):
+    metrics.setup(tool, args.metricsout, args.metricsformat, args.profilefile)
+    return metrics
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import pickle
+from colibrimt.logger import log
+
+#Keyword store: the keywords found for every source pattern by colibri-extractfeatures -k, in a single file
+#(keywords.store in the classifier directory) rather than one small file per source pattern. Every line holds
+#sourcepattern, keyword, target pattern, count and p(t|keyword), the lines of a source pattern are contiguous and in the
+#order of the keyword list, so bit j of a keyword bitset (see featurestostring()) is the j-th keyword of the pattern.
+#A pickled index (keywords.store.index) maps each source pattern to the byte range of its lines, so a lookup is a
+#single seek and read. The index can always be rebuilt from the store itself.
+
+FILENAME = "keywords.store"
+BITSETPREFIX = "kw:" #sparse keyword feature: kw:<hex bitset>
+
+
+def bitset(keywords, tokens):
+    """Bitset of the keywords (a sequence of strings) that occur in the tokens, bit j is set if keywords[j] occurs"""
+    tokens = set(tokens)
+    bits = 0
+    for j, keyword in enumerate(keywords):
+        if keyword in tokens:
+            bits |= 1 << j
+    return bits
+
+
+class KeywordStore:
+    def __init__(self, filename, mode='r'):
+        """Mode is 'r' (read), 'w' (write a new store) or 'a' (append to an existing store, e.g. when resuming)"""
+        if mode not in ('r','w','a'):
+            raise ValueError("Invalid keyword store mode: " + str(mode))
+        self.filename = filename
+        self.mode = mode
+        self.index = {} #sourcepattern => (offset, length)
+        self.cache = {} #sourcepattern => keywords, for reading
+        if mode == 'r' and os.path.exists(filename + ".index") and os.path.getmtime(filename + ".index") >= os.path.getmtime(filename):
+            with open(filename + ".index",'rb') as f:
+                self.index = pickle.load(f)
+        elif mode in ('r','a') and os.path.exists(filename):
+            self.reindex()
+        self.file = open(filename,'rb' if mode == 'r' else mode + 'b')
+
+    def reindex(self):
+        """Rebuild the index by scanning the store"""
+        self.index = {}
+        offset = 0
+        with open(self.filename,'rb') as f:
+            for line in f:
+                sourcepattern = line.split(b"\t",1)[0].decode('utf-8')
+                if sourcepattern in self.index and self.index[sourcepattern][0] + self.index[sourcepattern][1] == offset:
+                    self.index[sourcepattern] = (self.index[sourcepattern][0], self.index[sourcepattern][1] + len(line))
+                else:
+                    #a later record of the same source pattern (written again after resuming) replaces the earlier one
+                    self.index[sourcepattern] = (offset, len(line))
+                offset += len(line)
+        log.debug("Indexed keyword store " + self.filename + ": " + str(len(self.index)) + " source patterns")
+
+    def add(self, sourcepattern, bag):
+        """Add the keywords of a source pattern, bag is a list of (keyword, targetpattern, count, p) tuples with all patterns as strings"""
+        buffer = "".join( sourcepattern + "\t" + keyword + "\t" + targetpattern + "\t" + str(c) + "\t" + str(p) + "\n" for keyword, targetpattern, c, p in bag ).encode('utf-8')
+        if buffer:
+            self.index[sourcepattern] = (self.file.tell(), len(buffer))
+            self.file.write(buffer)
+
+    def get(self, sourcepattern):
+        """Returns the list of (keyword, targetpattern, count, p) tuples of a source pattern, empty if it has no keywords"""
+        if sourcepattern not in self.index:
+            return []
+        offset, length = self.index[sourcepattern]
+        self.file.seek(offset)
+        bag = []
+        for line in self.file.read(length).decode('utf-8').split("\n"):
+            if line:
+                _, keyword, targetpattern, c, p = line.split("\t")
+                bag.append( (keyword, targetpattern, int(c), float(p)) )
+        return bag
+
+    def keywords(self, sourcepattern):
+        """Returns the keywords of a source pattern as a tuple of strings, position j corresponds to bit j of a keyword bitset"""
+        try:
+            return self.cache[sourcepattern]
+        except KeyError:
+            keywords = self.cache[sourcepattern] = tuple( x[0] for x in self.get(sourcepattern) )
+            return keywords
+
+    def __contains__(self, sourcepattern):
+        return sourcepattern in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        """Close the store, when writing the index is saved alongside"""
+        if self.file.closed:
+            return
+        self.file.close()
+        if self.mode != 'r':
+            with open(self.filename + ".index",'wb') as f:
+                pickle.dump(self.index, f)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import sys
+import math
+import gzip
+import struct
+import argparse
+import functools
+import numpy
+from collections import defaultdict
+from colibrimt.logger import log, Progress, addloggingarguments, setuplogging
+
+#Binary language model format, shared with LanguageModel in src/lm.cpp (little endian):
+#   header:   magic (8 bytes), order (uint32), reserved (uint32), number of n-grams (uint64), log probability of <unk> (float64),
+#             n-gram totals per order 0..9 (10 x uint64), probability codebook (256 x float32), backoff codebook (256 x float32)
+#   keys:     64-bit hashes of the n-grams, sorted (count x uint64): every token is hashed on its own (64-bit FNV-1a of its
+#             UTF-8 string) and the token hashes are combined in order (see ngramhash()). The decoder hashes every token
+#             once and then combines class-level hashes, rather than decoding and hashing strings for every lookup
+#   probs:    quantised log probabilities (count x uint8), index into the probability codebook
+#   backoffs: quantised backoff weights (count x uint8), index into the backoff codebook, index 0 is always 0.0 (no backoff)
+#All values are natural logarithms (converted from the log10 values in ARPA files), like in the ARPA loader.
+#Distinct n-grams with the same hash are not allowed, conversion fails if they occur.
+
+MAGIC = b"COLIBLM2"
+MAGICPREFIX = b"COLIBLM"
+MAXORDER = 9
+HEADERFORMAT = "<8sIIQd" + str(MAXORDER+1) + "Q"
+HEADERSIZE = struct.calcsize(HEADERFORMAT) + 256 * 4 * 2
+
+FNV_OFFSET = 14695981039346656037
+FNV_PRIME = 1099511628211
+
+LOG10 = math.log(10)
+
+
+MASK = 0xFFFFFFFFFFFFFFFF
+
+
+@functools.lru_cache(maxsize=2**20)
+def tokenhash(token):
+    """64-bit FNV-1a hash of a single token (memoised, a lookup hashes every token of the n-gram)"""
+    h = FNV_OFFSET
+    for byte in token.encode('utf-8'):
+        h = ((h ^ byte) * FNV_PRIME) & MASK
+    return h
+
+def combine(h, tokenhash):
+    """Fold the hash of the next token into an n-gram hash (same in LanguageModel::hash() in src/lm.cpp)"""
+    h = ((h ^ tokenhash) * FNV_PRIME) & MASK
+    return h ^ (h >> 32)
+
+def ngramhash(ngram):
+    """64-bit hash of an n-gram (string or sequence of tokens)"""
+    if isinstance(ngram, str):
+        ngram = ngram.split()
+    h = FNV_OFFSET
+    for token in ngram:
+        h = combine(h, tokenhash(token))
+    return h
+
+def tokenhashes(tokens):
+    """Vectorised tokenhash() for a list of tokens, returns a numpy uint64 array"""
+    encoded = [ token.encode('utf-8') for token in tokens ]
+    lengths = numpy.array([ len(x) for x in encoded ], dtype=numpy.int64)
+    width = int(lengths.max()) if len(encoded) else 0
+    data = numpy.zeros((len(encoded), width), dtype=numpy.uint8)
+    for i, x in enumerate(encoded):
+        data[i,:len(x)] = numpy.frombuffer(x, dtype=numpy.uint8)
+    h = numpy.full(len(encoded), FNV_OFFSET, dtype=numpy.uint64)
+    prime = numpy.uint64(FNV_PRIME)
+    with numpy.errstate(over='ignore'):
+        for column in range(width):
+            mask = lengths > column
+            h[mask] = (h[mask] ^ data[mask,column].astype(numpy.uint64)) * prime
+    return h
+
+def ngramhashes(ngrams):
+    """Vectorised ngramhash() for a list of n-gram strings, returns a numpy uint64 array"""
+    vocabulary = {}
+    ngrams = [ ngram.split() for ngram in ngrams ]
+    order = max( len(ngram) for ngram in ngrams ) if ngrams else 0
+    indices = numpy.full((len(ngrams), order), -1, dtype=numpy.int64)
+    for i, ngram in enumerate(ngrams):
+        for j, token in enumerate(ngram):
+            indices[i,j] = vocabulary.setdefault(token, len(vocabulary))
+    hashes = tokenhashes(list(vocabulary))
+    h = numpy.full(len(ngrams), FNV_OFFSET, dtype=numpy.uint64)
+    prime = numpy.uint64(FNV_PRIME)
+    shift = numpy.uint64(32)
+    with numpy.errstate(over='ignore'):
+        for column in range(order):
+            mask = indices[:,column] >= 0
+            x = (h[mask] ^ hashes[indices[mask,column]]) * prime
+            h[mask] = x ^ (x >> shift)
+    return h
+
+
+def readarpa(filename):
+    """Reads an ARPA language model, yields (n, ngram, logprob, backoff) tuples with log10 values as in the file, backoff is None if absent"""
+    if filename.endswith('.gz'):
+        f = gzip.open(filename,'rt',encoding='utf-8')
+    else:
+        f = open(filename,'r',encoding='utf-8')
+    n = 0
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        if line == "\\data\\":
+            n = 0
+        elif line.startswith("\\") and line.endswith("-grams:"):
+            n = int(line[1:-7])
+        elif line == "\\end\\":
+            break
+        elif n > 0:
+            fields = line.split("\t")
+            if len(fields) < 2:
+                fields = line.split()
+                if len(fields) < n + 1:
+                    log.warning("WARNING: Ignoring line: " + line)
+                    continue
+                fields = [fields[0], " ".join(fields[1:n+1])] + fields[n+1:]
+            backoff = float(fields[2]) if len(fields) > 2 else None
+            yield n, fields[1], float(fields[0]), backoff
+    f.close()
+
+def readarpatotals(filename):
+    """Reads the n-gram totals from the data section of an ARPA file"""
+    totals = [0] * (MAXORDER+1)
+    if filename.endswith('.gz'):
+        f = gzip.open(filename,'rt',encoding='utf-8')
+    else:
+        f = open(filename,'r',encoding='utf-8')
+    for line in f:
+        line = line.strip()
+        if line.startswith("ngram "):
+            n, v = line[6:].split("=")
+            totals[int(n)] = int(v)
+        elif line.startswith("\\1-grams:"):
+            break
+    f.close()
+    return totals
+
+
+def quantise(values, reservezero=False):
+    """Quantise values to 8 bits, returns (codebook, codes). The codebook consists of 256 quantiles of the values (or the values themselves if there are few distinct ones), every value is mapped to the nearest codebook entry. If reservezero is set, code 0 is reserved for exactly 0.0"""
+    values = numpy.asarray(values, dtype=numpy.float64)
+    size = 255 if reservezero else 256
+    if reservezero:
+        nonzero = values[values != 0]
+    else:
+        nonzero = values
+    distinct = numpy.unique(nonzero)
+    if len(distinct) <= size:
+        #few distinct values: exact
+        codebook = distinct
+    elif len(nonzero):
+        codebook = numpy.unique(numpy.quantile(nonzero, numpy.linspace(0,1,size)))
+    else:
+        codebook = numpy.zeros(0)
+    if reservezero:
+        codebook = numpy.concatenate(([0.0], codebook[codebook != 0]))
+    if len(codebook) == 0:
+        codebook = numpy.zeros(1)
+    if reservezero:
+        codes = numpy.zeros(len(values), dtype=numpy.uint8)
+        mask = values != 0
+        if len(codebook) > 1:
+            codes[mask] = nearest(codebook[1:], values[mask]) + 1
+    else:
+        codes = nearest(codebook, values).astype(numpy.uint8)
+    codebook = numpy.concatenate((codebook, numpy.zeros(256 - len(codebook))))
+    return codebook.astype(numpy.float32), codes
+
+def nearest(codebook, values):
+    """Index of the nearest entry in a sorted codebook for every value"""
+    if len(codebook) == 1:
+        return numpy.zeros(len(values), dtype=numpy.int64)
+    boundaries = (codebook[1:] + codebook[:-1]) / 2
+    return numpy.searchsorted(boundaries, values)
+
+
+def convertarpa(arpafile, outputfile, chunksize=1000000):
+    """Convert an ARPA language model to the binary memory-mapped format"""
+    keys = []
+    probs = []
+    backoffs = []
+    order = 0
+    unkprob = None
+    chunk = []
+    progress = Progress("n-grams read")
+
+    def flush():
+        keys.append(ngramhashes([ ngram for ngram, _, _ in chunk ]))
+        probs.append(numpy.array([ prob for _, prob, _ in chunk ], dtype=numpy.float64))
+        backoffs.append(numpy.array([ backoff for _, _, backoff in chunk ], dtype=numpy.float64))
+        del chunk[:]
+
+    for n, ngram, prob, backoff in readarpa(arpafile):
+        if n > MAXORDER:
+            raise ValueError("Language models of order > " + str(MAXORDER) + " are not supported")
+        order = max(order, n)
+        if ngram == "<unk>":
+            unkprob = prob * LOG10
+        chunk.append((ngram, prob * LOG10, backoff * LOG10 if backoff is not None else 0.0))
+        if len(chunk) >= chunksize:
+            flush()
+        progress.update()
+    if chunk:
+        flush()
+    progress.done()
+
+    if unkprob is None:
+        raise ValueError("Language Model has no value <unk>, make sure to generate SRILM model with -unk parameter")
+
+    keys = numpy.concatenate(keys) if keys else numpy.zeros(0, dtype=numpy.uint64)
+    probs = numpy.concatenate(probs) if probs else numpy.zeros(0)
+    backoffs = numpy.concatenate(backoffs) if backoffs else numpy.zeros(0)
+
+    log.info("Sorting " + str(len(keys)) + " n-grams")
+    sortorder = numpy.argsort(keys, kind='stable')
+    keys = keys[sortorder]
+    unique = numpy.ones(len(keys), dtype=bool)
+    unique[1:] = keys[1:] != keys[:-1]
+    if not unique.all():
+        #distinct n-grams with the same key would silently get each other's probability, refuse to convert
+        collisions = set( int(key) for key in keys[1:][~unique[1:]] )
+        colliding = defaultdict(set)
+        for _, ngram, _, _ in readarpa(arpafile):
+            key = ngramhash(ngram)
+            if key in collisions:
+                colliding[key].add(ngram)
+        colliding = [ " / ".join(sorted(ngrams)) for ngrams in colliding.values() if len(ngrams) > 1 ]
+        if colliding:
+            raise ValueError("Hash collisions between distinct n-grams, the model can not be converted: " + ", ".join(colliding[:20]))
+        log.warning("WARNING: " + str(len(keys) - unique.sum()) + " duplicate n-grams, keeping the first")
+    keys = keys[unique]
+    sortorder = sortorder[unique]
+
+    log.info("Quantising probabilities and backoff weights")
+    probcodebook, probcodes = quantise(probs[sortorder])
+    backoffcodebook, backoffcodes = quantise(backoffs[sortorder], reservezero=True)
+
+    totals = readarpatotals(arpafile)
+    with open(outputfile,'wb') as f:
+        f.write(struct.pack(HEADERFORMAT, MAGIC, order, 0, len(keys), unkprob, *totals))
+        f.write(probcodebook.astype('<f4').tobytes())
+        f.write(backoffcodebook.astype('<f4').tobytes())
+        f.write(keys.astype('<u8').tobytes())
+        f.write(probcodes.tobytes())
+        f.write(backoffcodes.tobytes())
+    log.info("Wrote " + str(len(keys)) + " n-grams to " + outputfile)
+    return len(keys)
+
+
+def isbinary(filename):
+    """Is this a language model in the binary format?"""
+    with open(filename,'rb') as f:
+        return f.read(len(MAGICPREFIX)) == MAGICPREFIX
+
+
+class BinaryLanguageModel:
+    """Memory-mapped language model in the binary format (see convertarpa()). The file is not read into memory, so several processes share the page cache. Scores are natural log probabilities, as in LanguageModel in src/lm.cpp"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+        header = struct.unpack(HEADERFORMAT, self.data[:struct.calcsize(HEADERFORMAT)].tobytes())
+        if header[0] != MAGIC:
+            if header[0].startswith(MAGICPREFIX):
+                raise ValueError("Binary language model " + filename + " was converted by an older version (" + header[0].decode('ascii') + "), convert the ARPA file again")
+            raise ValueError("Not a binary language model: " + filename)
+        self.order = header[1]
+        self.count = header[3]
+        self.unkprob = header[4]
+        self.total = dict(enumerate(header[5:]))
+        offset = struct.calcsize(HEADERFORMAT)
+        self.probcodebook = numpy.frombuffer(self.data, dtype='<f4', count=256, offset=offset).astype(numpy.float64)
+        offset += 256 * 4
+        self.backoffcodebook = numpy.frombuffer(self.data, dtype='<f4', count=256, offset=offset).astype(numpy.float64)
+        offset += 256 * 4
+        self.keys = numpy.frombuffer(self.data, dtype='<u8', count=self.count, offset=offset)
+        offset += self.count * 8
+        self.probs = numpy.frombuffer(self.data, dtype=numpy.uint8, count=self.count, offset=offset)
+        offset += self.count
+        self.backoffs = numpy.frombuffer(self.data, dtype=numpy.uint8, count=self.count, offset=offset)
+
+    def __len__(self):
+        return self.count
+
+    def find(self, ngram):
+        """Returns the index of the n-gram (string or sequence of tokens), or None if it is not in the model"""
+        key = ngramhash(ngram)
+        i = numpy.searchsorted(self.keys, numpy.uint64(key))
+        if i < self.count and int(self.keys[i]) == key:
+            return i
+        return None
+
+    def __contains__(self, ngram):
+        return self.find(ngram) is not None
+
+    def logprob(self, ngram):
+        """Log probability of the n-gram as listed in the model (no backoff), or None"""
+        i = self.find(ngram)
+        if i is None:
+            return None
+        return float(self.probcodebook[self.probs[i]])
+
+    def backoff(self, ngram):
+        """Backoff weight of the n-gram, 0.0 if absent"""
+        i = self.find(ngram)
+        if i is None:
+            return 0.0
+        return float(self.backoffcodebook[self.backoffs[i]])
+
+    def scoreword(self, word, history=()):
+        """Log probability of a word given a history (sequence of tokens), with backoff"""
+        history = tuple(history)
+        p = self.logprob(history + (word,))
+        if p is not None:
+            return p
+        if not history:
+            return self.unkprob
+        return self.backoff(history) + self.scoreword(word, history[1:])
+
+    def score(self, ngram, history=()):
+        """Log probability of a sequence of tokens, optionally preceded by a history"""
+        context = list(history)[-(self.order-1):] if self.order > 1 else []
+        result = 0.0
+        for word in ngram:
+            result += self.scoreword(word, context)
+            context.append(word)
+            if len(context) > self.order - 1:
+                del context[0]
+        return result
+
+    def scoresentence(self, sentence):
+        """Log probability of a sentence (string or sequence of tokens), including the sentence boundary markers"""
+        if isinstance(sentence, str):
+            sentence = sentence.split()
+        return self.score(list(sentence) + ["</s>"], ["<s>"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert an ARPA language model to the binary memory-mapped format used by the colibri decoder, or score sentences with a converted model", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i','--inputfile',type=str,help="Input language model (ARPA, or binary with -s)", action='store',required=True)
+    parser.add_argument('-o','--outputfile',type=str,help="Output file for the binary language model", action='store',default="")
+    parser.add_argument('-s','--score',help="Score sentences from standard input (one per line) with the binary language model in -i, outputs natural log probabilities", action='store_true',default=False)
+    addloggingarguments(parser)
+    args = parser.parse_args()
+    setuplogging(args)
+
+    if args.score:
+        lm = BinaryLanguageModel(args.inputfile)
+        for line in sys.stdin:
+            print(lm.scoresentence(line.strip()))
+    elif args.outputfile:
+        convertarpa(args.inputfile, args.outputfile)
+    else:
+        log.error("Specify an output file (-o) or --score")
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
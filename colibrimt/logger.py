@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import sys
+import time
+import logging
+
+#shared logger for the whole package, messages go to stderr
+log = logging.getLogger('colibrimt')
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+
+def setlevel(verbosity=0):
+    """Set the log level from a verbosity: 0 = info (default), 1 or more = debug, -1 = warnings and errors only, -2 or less = errors only"""
+    if verbosity >= 1:
+        level = DEBUG
+    elif verbosity == 0:
+        level = INFO
+    elif verbosity == -1:
+        level = WARNING
+    else:
+        level = ERROR
+    if not log.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(level)
+    return level
+
+def debugging():
+    """Is debug output enabled? Hot loops should check this (once, outside the loop) before formatting debug messages"""
+    return log.isEnabledFor(DEBUG)
+
+
+class Progress:
+    """Rate-limited progress reporting: call update() for every item processed, a message is logged at most once every interval seconds (and once at the end when done() is called), rather than once per item.
+
+    The message is produced by a callback that is only invoked when a message is actually logged; it receives the number of items processed so far."""
+
+    def __init__(self, message, total=None, interval=10.0, level=INFO):
+        self.message = message #string or callable (count) => string
+        self.total = total
+        self.interval = interval
+        self.level = level
+        self.count = 0
+        self.begintime = self.lasttime = time.time()
+
+    def update(self, n=1):
+        self.count += n
+        now = time.time()
+        if now - self.lasttime >= self.interval:
+            self.lasttime = now
+            self.report(now)
+
+    def report(self, now=None):
+        if not log.isEnabledFor(self.level):
+            return
+        if now is None: now = time.time()
+        s = "@" + str(self.count)
+        if self.total:
+            s += "/" + str(self.total) + " " + str(round((self.count / self.total) * 100,2)) + "%"
+        duration = now - self.begintime
+        if duration > 0:
+            s += " (" + str(round(self.count / duration,1)) + "/s)"
+        if callable(self.message):
+            s += " -- " + self.message(self.count)
+        else:
+            s += " -- " + self.message
+        log.log(self.level, s)
+
+    def done(self):
+        self.report()
+
+
+def addloggingarguments(parser):
+    parser.add_argument('-v','--verbose',dest='verbose',help="Be more verbose, output debug information (slow on large data)", action='count',default=0)
+    parser.add_argument('-q','--quiet',dest='quiet',help="Be quieter: once for warnings and errors only, twice for errors only", action='count',default=0)
+
+def setuplogging(args):
+    return setlevel(args.verbose - args.quiet)
+
+
+setlevel(0) #default: info messages on stderr, entry points adjust the level with setuplogging()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+#Python binding to the native tools in src/: they are invoked as subprocesses and results are handed back through colibri's binary model files
+
+import os
+import re
+import shutil
+import tempfile
+import subprocess
+from colibrimt.logger import log
+
+EXEC_MOSESPHRASETABLE2ALIGNMODEL = os.environ.get('COLIBRIMT_MOSESPHRASETABLE2ALIGNMODEL', "colibri-mosesphrasetable2alignmodel")
+
+
+def available():
+    """Is the native phrase-table converter installed (in the PATH)?"""
+    return shutil.which(EXEC_MOSESPHRASETABLE2ALIGNMODEL) is not None
+
+
+def classfile(encoder):
+    """Returns the class file the encoder was loaded from, or None if it is unknown"""
+    try:
+        return encoder.filename()
+    except AttributeError:
+        return None
+
+
+def supported(filename, sourceencoder, targetencoder, reverse=False, delimiter="|||", score_column=3, scorefilter=None, divfrombestindex=2):
+    """Can the native converter load this phrase table with these options? The native loader does not support custom score filters (only the pts/pst/joined thresholds), reversed tables, custom delimiters or score columns, nor bzip2 compression. The class encoders must have been loaded from file."""
+    if reverse or delimiter != "|||" or score_column != 3 or divfrombestindex != 2 or scorefilter is not None:
+        return False
+    if filename.endswith('.bz2'):
+        return False
+    if not classfile(sourceencoder) or not classfile(targetencoder):
+        return False
+    return True
+
+
+def mosesphrasetable2alignmodel(filename, outputfile, sourceclassfile, targetclassfile, constrainsourcemodel=None, constraintargetmodel=None, max_sourcen=0, pts=0.0, pst=0.0, joinedthreshold=0.0, divergencefrombestthreshold=0.0, constrainthreshold=0, quiet=False):
+    """Convert a Moses phrase table to a binary alignment model using the native converter. The constraint models are filenames of pattern models. If quiet is set, only warnings and errors of the converter are logged. Returns a dictionary with the counts reported by the converter (lines, added, skipped, constrained)"""
+    cmd = [EXEC_MOSESPHRASETABLE2ALIGNMODEL, '-i', filename, '-o', outputfile, '-S', sourceclassfile, '-T', targetclassfile]
+    if constrainsourcemodel: cmd += ['-m', constrainsourcemodel]
+    if constraintargetmodel: cmd += ['-M', constraintargetmodel]
+    if max_sourcen: cmd += ['-l', str(max_sourcen)]
+    if constrainthreshold: cmd += ['-t', str(constrainthreshold)]
+    if pts: cmd += ['-p', str(pts)]
+    if pst: cmd += ['-P', str(pst)]
+    if joinedthreshold: cmd += ['-j', str(joinedthreshold)]
+    if divergencefrombestthreshold: cmd += ['-d', str(divergencefrombestthreshold)]
+
+    if not quiet:
+        log.info("Calling native phrase-table converter: " + " ".join(cmd))
+    p = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+    stats = {'lines': 0, 'added': 0, 'skipped': 0, 'constrained': 0}
+    for line in p.stderr:
+        line = str(line,'utf-8',errors='replace').strip()
+        if not line: continue
+        m = re.search(r"Read (\d+) lines", line) #preceded by progress dots on the same line
+        if m:
+            stats['lines'] = int(m.group(1))
+        m = re.search(r"Added: (\d+) -- skipped due to threshold: (\d+) -- skipped by constraint: (\d+)", line)
+        if m:
+            stats['added'], stats['skipped'], stats['constrained'] = [ int(x) for x in m.groups() ]
+        if 'WARNING' in line or 'ERROR' in line:
+            log.warning(line)
+        elif not quiet:
+            log.debug(line)
+    p.wait()
+    if p.returncode != 0:
+        raise Exception("Native phrase-table converter failed with exit code " + str(p.returncode) + ": " + " ".join(cmd))
+    return stats
+
+
+def loadmosesphrasetable(model, filename, sourceencoder, targetencoder, constrainsourcemodel=None, constraintargetmodel=None, max_sourcen=0, pts=0.0, pst=0.0, joinedthreshold=0.0, divergencefrombestthreshold=0.0, tmpdir=None, quiet=False):
+    """Load a Moses phrase table into the given alignment model using the native converter. In-memory constraint models are written to temporary files first. Returns the counts reported by the converter"""
+    tmpdir = tempfile.mkdtemp(prefix="colibrimt-native-", dir=tmpdir)
+    try:
+        if constrainsourcemodel is not None and not isinstance(constrainsourcemodel, str):
+            constrainsourcemodel.write(tmpdir + "/constrainsource.colibri.patternmodel")
+            constrainsourcemodel = tmpdir + "/constrainsource.colibri.patternmodel"
+        if constraintargetmodel is not None and not isinstance(constraintargetmodel, str):
+            constraintargetmodel.write(tmpdir + "/constraintarget.colibri.patternmodel")
+            constraintargetmodel = tmpdir + "/constraintarget.colibri.patternmodel"
+        outputfile = tmpdir + "/phrasetable.colibri.alignmodel"
+        stats = mosesphrasetable2alignmodel(filename, outputfile, classfile(sourceencoder), classfile(targetencoder), constrainsourcemodel, constraintargetmodel, max_sourcen, pts, pst, joinedthreshold, divergencefrombestthreshold, quiet=quiet)
+        model.load(outputfile)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return stats
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import numpy
+from colibrimt.ib1 import IB1Classifier, parseoptions, entropy
+from colibrimt.logger import log, Progress
+
+#Expert oracle: analyses the training data of every classifier expert before training and decides which experts are
+#worth training and querying. An expert is not worth it if, in leave-one-out classification, it never deviates from the
+#phrase-table argmax p(t|s), i.e. it would never override the statistical translation. Optionally, experts dominated by
+#one translation (majority share) are skipped as well, but only if leave-one-out agrees with the argmax to the same
+#extent. The decisions are written to an index that contextmoses consults both when training and when testing (experts
+#not in the index fall back to the statistical baseline).
+
+INDEXFILE = "experts.index"
+
+
+def oracleoptions(timbloptions):
+    """IB1 options for the leave-one-out estimate, following the k and weighting of the configured Timbl options where the numpy backend supports them"""
+    timbloptions = timbloptions.split()
+    options = []
+    for i, option in enumerate(timbloptions):
+        if option in ('-k','-w') and i + 1 < len(timbloptions):
+            options.append(option + " " + timbloptions[i+1])
+        elif option == '-s':
+            options.append(option)
+    try:
+        parseoptions(" ".join(options))
+    except ValueError:
+        options = [ option for option in options if not option.startswith('-w') ] #unsupported weighting, use the default (gain ratio)
+    return " ".join(options)
+
+
+MAXINSTANCES = 1000 #leave-one-out is quadratic, larger experts are estimated on a sample of this many instances
+
+
+def analyse(trainprefix, argmax=None, timbloptions="", maxinstances=MAXINSTANCES):
+    """Analyse the training data of an expert (trainprefix.train). Argmax is the phrase-table translation with the highest p(t|s), the majority class is used if it is not given. Returns a dictionary with the number of instances, classes, class entropy (bits), majority share and leave-one-out agreement with the argmax (estimated on a sample of maxinstances instances for larger experts, 0 = all)"""
+    classifier = IB1Classifier(trainprefix, oracleoptions(timbloptions))
+    classifier.train()
+    counts = numpy.bincount(classifier.labels, weights=classifier.weights, minlength=len(classifier.classes))
+    if argmax is None or argmax not in classifier.classes:
+        argmax = classifier.classes[int(numpy.argmax(counts))]
+    predictions = classifier.leaveoneout(maxinstances)
+    agreement = sum( 1 for prediction in predictions if prediction == argmax ) / len(predictions) if predictions else 1.0
+    return {'instances': len(classifier.labels), 'classes': len(classifier.classes), 'entropy': entropy(counts), 'majority': float(counts.max() / counts.sum()) if counts.sum() else 1.0, 'argmax': argmax, 'agreement': agreement}
+
+
+def worthtraining(stats, maxmajority=0, maxagreement=1.0):
+    """An expert is skipped if it has a single class, if it never overrides the argmax in leave-one-out classification (agreement of at least maxagreement), or if its majority share is at least maxmajority (0 = disabled) while it also agrees with the argmax on that share of the instances: a dominant translation alone does not tell whether the context matters for the rest"""
+    if stats['classes'] <= 1 or stats['agreement'] >= maxagreement:
+        return False
+    if maxmajority and stats['majority'] >= maxmajority and stats['agreement'] >= maxmajority:
+        return False
+    return True
+
+
+def buildindex(trainfiles, indexfile, argmax=None, timbloptions="", maxmajority=0, maxagreement=1.0, maxinstances=MAXINSTANCES):
+    """Analyse all expert training files and write the index. Argmax is a function mapping the expert name (the basename of the training file without .train) to the phrase-table argmax, or None. Returns the set of experts worth training"""
+    experts = set()
+    progress = Progress("experts analysed", len(trainfiles))
+    with open(indexfile,'w',encoding='utf-8') as f:
+        f.write("#expert\tinstances\tclasses\tentropy\tmajority\tagreement\ttrain\n")
+        for trainfile in trainfiles:
+            name = os.path.basename(trainfile)[:-len('.train')]
+            stats = analyse(trainfile[:-len('.train')], argmax(name) if argmax else None, timbloptions, maxinstances)
+            train = worthtraining(stats, maxmajority, maxagreement)
+            if train:
+                experts.add(name)
+            f.write(name + "\t" + str(stats['instances']) + "\t" + str(stats['classes']) + "\t" + str(round(stats['entropy'],4)) + "\t" + str(round(stats['majority'],4)) + "\t" + str(round(stats['agreement'],4)) + "\t" + str(int(train)) + "\n")
+            progress.update()
+    progress.done()
+    log.info("Expert oracle: " + str(len(experts)) + " of " + str(len(trainfiles)) + " experts are worth training, index written to " + indexfile)
+    return experts
+
+
+def loadindex(indexfile):
+    """Returns the set of experts worth training from an index, or None if there is no index"""
+    if not os.path.exists(indexfile):
+        return None
+    experts = set()
+    with open(indexfile,'r',encoding='utf-8') as f:
+        for line in f:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if fields[-1] == "1":
+                experts.add(fields[0])
+    return experts
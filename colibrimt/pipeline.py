@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import itertools
+import subprocess
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import colibrimt.cache
+from colibrimt.instrumentation import metrics, addmetricsarguments, setupmetrics
+from colibrimt.logger import log, addloggingarguments, setuplogging
+
+#Experiment pipeline runner (colibri-mt), replaces scripts/colibri-mt-exp.sh and reads the same experiment
+#configuration files. The experiment is described as a graph of stages with their dependencies; independent stages
+#(e.g. class encoding of source and target, the language model and the phrase table, multiple MERT runs) run
+#concurrently within a core and memory budget.
+
+#stage groups in pipeline order, LASTSTAGE refers to these
+STAGEGROUPS = ('buildphrasetable','patternmodels','buildalignmentmodel','featureextraction','trainclassifiers','decoder','evaluation')
+
+DEFAULTS = {
+    'THREADS': '1',
+    'MERT': '0',
+    'MAXLENGTH': '8',
+    'OCCURRENCES': '2',
+    'MIN_PTS': '0.05',
+    'MIN_PST': '0.05',
+    'CLASSIFIERTYPE': 'X',
+    'INSTANCETHRESHOLD': '2',
+    'SCOREHANDLING': 'append',
+    'LEFT': '1',
+    'RIGHT': '1',
+    'TIMBL_A': '0',
+    'TIMBL_K': '1',
+    'TIMBL_W': 'gr',
+    'TIMBL_M': 'O',
+    'TIMBL_D': 'Z',
+    'LMWEIGHT': '1',
+    'DWEIGHT': '1',
+    'WWEIGHT': '0',
+    'PWEIGHT': '0',
+    'LASTSTAGE': 'evaluation',
+    'TRAINMODEL': '/vol/customopt/machine-translation/src/mosesdecoder/scripts/training/train-model.perl',
+    'EXTERNALBINDIR': '/vol/customopt/machine-translation/bin',
+}
+
+
+def readconfig(filename):
+    """Reads the variable assignments from a (bash) experiment configuration file, as used by colibri-mt-exp.sh. Arrays become lists, $VAR and ${VAR} references are expanded. Anything else (like sourcing the experiment script) is ignored"""
+    config = dict(DEFAULTS)
+
+    def expand(value):
+        return re.sub(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)\}?", lambda m: " ".join(config[m.group(1)]) if isinstance(config.get(m.group(1)), list) else config.get(m.group(1), os.environ.get(m.group(1), "")), value)
+
+    with open(filename,'r',encoding='utf-8') as f:
+        for line in f:
+            m = re.match(r"^\s*(?:export\s+)?([A-Za-z_][A-Za-z0-9_]*)=(.*)$", line)
+            if not m:
+                continue
+            key, value = m.groups()
+            value = value.strip()
+            if value.startswith('('):
+                value = value[1:value.find(')')] if ')' in value else value[1:]
+                config[key] = [ expand(x.strip("'\"")) for x in value.split() ]
+                continue
+            if value[:1] in ('"',"'"):
+                quote = value[0]
+                value = value[1:value.find(quote,1)] if quote in value[1:] else value[1:]
+                config[key] = expand(value) if quote == '"' else value
+            else:
+                config[key] = expand(re.sub(r"\s+#.*$", "", value).strip())
+    return config
+
+
+class Stage:
+    def __init__(self, name, cmd, group, inputs=(), outputs=(), deps=(), cores=1, memory=0, cacheable=False):
+        self.name = name
+        self.cmd = cmd #shell command (bash), run in the experiment directory
+        self.group = group
+        self.inputs = list(inputs) #input files, for the cache key
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.cores = cores
+        self.memory = memory #estimated peak memory in MB, 0 = negligible
+        self.cacheable = cacheable #outputs go through the artifact cache (rather than: skip if they exist)
+        self.status = None
+        self.begintime = self.endtime = None
+
+    def duration(self):
+        if self.begintime is None or self.endtime is None:
+            return 0.0
+        return self.endtime - self.begintime
+
+
+class Pipeline:
+    def __init__(self, workdir, logdir=None, cache=True):
+        self.workdir = workdir
+        self.logdir = logdir if logdir else os.path.join(workdir, "logs")
+        self.stages = [] #in declaration (pipeline) order
+        self.signatures = {} #(command, outputs) => stage, for merging sweep points
+        self.cache = colibrimt.cache.ArtifactCache() if cache else None
+
+    def _add(self, stage):
+        for dep in stage.deps:
+            if self[dep] is None:
+                raise KeyError("Stage " + stage.name + " depends on unknown stage " + dep)
+        self.stages.append(stage)
+        return stage
+
+    def merge(self, other, suffix):
+        """Merge the stages of another pipeline (a sweep point) into this one. Stages with the same signature (command and outputs, which encode all parameters a stage depends on) are shared rather than added again. Returns a dictionary mapping the stage names of the other pipeline to the names in this one"""
+        names = {}
+        outputs = { output: stage for stage in self.stages for output in stage.outputs }
+        for stage in other.stages:
+            signature = (stage.cmd, tuple(stage.outputs))
+            if signature in self.signatures:
+                names[stage.name] = self.signatures[signature].name
+                continue
+            for output in stage.outputs:
+                if output in outputs:
+                    raise ValueError("Sweep points write the same output " + output + " with different commands (stages " + outputs[output].name + " and " + stage.name + "@" + suffix + "), the swept parameter must be part of the directory names")
+            names[stage.name] = stage.name if self[stage.name] is None else stage.name + "@" + suffix
+            stage.name = names[stage.name]
+            stage.deps = [ names[dep] for dep in stage.deps ]
+            self.add(stage)
+            for output in stage.outputs:
+                outputs[output] = stage
+        return names
+
+    def add(self, stage):
+        stage = self._add(stage)
+        self.signatures[(stage.cmd, tuple(stage.outputs))] = stage
+        return stage
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name:
+                return stage
+        return None
+
+    def select(self, laststage='evaluation'):
+        """Returns the names of the stages to run when halting after the given stage group: the stages in that group or earlier groups, and everything they depend on"""
+        if laststage not in STAGEGROUPS:
+            raise ValueError("Invalid last stage: " + laststage + ", expected one of " + ", ".join(STAGEGROUPS))
+        selected = set()
+        def visit(stage):
+            if stage.name not in selected:
+                selected.add(stage.name)
+                for dep in stage.deps:
+                    visit(self[dep])
+        for stage in self.stages:
+            if STAGEGROUPS.index(stage.group) <= STAGEGROUPS.index(laststage):
+                visit(stage)
+        return selected
+
+    def path(self, filename):
+        return filename if os.path.isabs(filename) else os.path.join(self.workdir, filename)
+
+    def execute(self, stage):
+        """Runs a single stage (in a worker thread), returns True on success"""
+        with metrics.span('stage:' + stage.name):
+            return self._execute(stage)
+
+    def _execute(self, stage):
+        logfile = os.path.join(self.logdir, stage.name + ".log")
+
+        def func():
+            log.info("[" + stage.name + "] " + stage.cmd)
+            with open(logfile,'w',encoding='utf-8') as f:
+                r = subprocess.call(stage.cmd, shell=True, cwd=self.workdir, stdout=f, stderr=subprocess.STDOUT, executable='/bin/bash')
+            if r != 0:
+                with open(logfile,'r',encoding='utf-8',errors='replace') as f:
+                    tail = f.readlines()[-25:]
+                log.error("[" + stage.name + "] failed with exit code " + str(r) + ", see " + logfile + ", tail:\n" + "".join(tail).rstrip())
+                return False
+            for outputfile in stage.outputs:
+                if not os.path.exists(self.path(outputfile)):
+                    log.error("[" + stage.name + "] expected output " + outputfile + " was not produced")
+                    return False
+            return True
+
+        outputs = [ self.path(x) for x in stage.outputs ]
+        if stage.cacheable and self.cache is not None and outputs:
+            result = self.cache.run(stage.name, outputs, func, [ self.path(x) for x in stage.inputs ], {'command': stage.cmd})
+            stage.status = result if result in ('uptodate','cached') else ('done' if result else 'failed')
+        elif outputs and all( os.path.exists(x) for x in outputs ):
+            log.info("[" + stage.name + "] already done")
+            stage.status = 'uptodate'
+        else:
+            stage.status = 'done' if func() else 'failed'
+        return stage.status != 'failed'
+
+    def run(self, laststage='evaluation', cores=None, memory=0, dryrun=False):
+        """Runs the selected stages, as soon as their dependencies are done and resources are available. Returns True if all succeeded"""
+        selected = self.select(laststage)
+        stages = [ stage for stage in self.stages if stage.name in selected ]
+        if dryrun:
+            for stage in stages:
+                print(stage.name + "\t" + stage.group + "\tdeps=" + ",".join(stage.deps) + "\tcores=" + str(stage.cores) + "\n\t" + stage.cmd)
+            return True
+        os.makedirs(self.logdir, exist_ok=True)
+        if not cores:
+            cores = os.cpu_count() or 1
+
+        pending = list(stages)
+        running = {} #future => stage
+        done = set()
+        failed = False
+        usedcores = usedmemory = 0
+        with ThreadPoolExecutor(max_workers=max(1,len(stages))) as pool:
+            while (pending and not failed) or running:
+                if not failed:
+                    for stage in list(pending):
+                        if not all( dep in done for dep in stage.deps ):
+                            continue
+                        fits = usedcores + stage.cores <= cores and (not memory or usedmemory + stage.memory <= memory)
+                        if not fits and running:
+                            continue #stages exceeding the entire budget still run, but alone
+                        pending.remove(stage)
+                        usedcores += stage.cores
+                        usedmemory += stage.memory
+                        stage.begintime = time.time()
+                        future = pool.submit(self.execute, stage)
+                        running[future] = stage
+                if not running:
+                    log.error("Unable to schedule the remaining stages: " + ", ".join([ stage.name for stage in pending ]))
+                    failed = True
+                    break
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    stage.endtime = time.time()
+                    usedcores -= stage.cores
+                    usedmemory -= stage.memory
+                    try:
+                        ok = future.result()
+                    except Exception as e:
+                        log.error("[" + stage.name + "] " + str(e))
+                        stage.status = 'failed'
+                        ok = False
+                    if ok:
+                        done.add(stage.name)
+                        log.info("[" + stage.name + "] " + stage.status + " (" + str(round(stage.duration(),2)) + "s)")
+                    else:
+                        failed = True
+        self.writetiming(stages)
+        return not failed
+
+    def writetiming(self, stages):
+        """Writes per-stage timing to pipeline.timing.json in the log directory"""
+        timing = [ {'stage': stage.name, 'group': stage.group, 'status': stage.status, 'begin': stage.begintime, 'end': stage.endtime, 'duration': round(stage.duration(),3)} for stage in stages ]
+        with open(os.path.join(self.logdir, "pipeline.timing.json"),'w',encoding='utf-8') as f:
+            json.dump(timing, f, indent=4)
+        for stage in stages:
+            log.info(stage.name.ljust(24) + str(stage.status).ljust(10) + str(round(stage.duration(),2)) + "s")
+
+
+def experiment(config, workdir, cache=True):
+    """Builds the experiment pipeline from a configuration (see readconfig()), mirroring colibri-mt-exp.sh"""
+    c = config
+    for key in ('NAME','TRAINSOURCE','TRAINTARGET','TESTSOURCE','TESTTARGET','SOURCELANG','TARGETLANG'):
+        if not c.get(key):
+            raise ValueError("Experiment configuration lacks " + key)
+    threads = int(c['THREADS'])
+    mert = int(c['MERT'])
+    name = c['NAME']
+    reordering = c.get('REORDERING','')
+    p = Pipeline(workdir, cache=cache)
+
+    extraoptions = extraname = ""
+    if c.get('WEIGHBYOCCURRENCE') == "1":
+        extraoptions += " -w"
+        extraname += "w"
+    if c.get('WEIGHBYSCORE') == "1":
+        extraoptions += " -W"
+        extraname += "W"
+    if c['CLASSIFIERTYPE'] == 'M' and int(c.get('SHARDS') or 1) > 1:
+        extraoptions += " --shards " + c['SHARDS']
+        extraname += "S" + c['SHARDS']
+    contextmosesoptions = "-I" if c.get('IGNORECLASSIFIER') == "1" else ""
+    classifierdir = "classifierdata-" + c['CLASSIFIERTYPE'] + "I" + c['INSTANCETHRESHOLD'] + "l" + c['LEFT'] + "r" + c['RIGHT'] + extraname
+    if c.get('IGNORECLASSIFIER') == "1":
+        classifiersubdir = classifierdir + "/classifiers-H" + c['SCOREHANDLING'] + "-ignored"
+    else:
+        classifiersubdir = classifierdir + "/classifiers-H" + c['SCOREHANDLING'] + "-ta" + c['TIMBL_A']
+    #the classifiers are trained with -a only, the other Timbl parameters are used when classifying: they go in the
+    #names of the decode directories (only if they differ from the default, so default runs keep the layout of colibri-mt-exp.sh)
+    timblname = "".join([ "-t" + key.lower() + c['TIMBL_' + key] for key in ('K','W','M','D') if c['TIMBL_' + key] != DEFAULTS['TIMBL_' + key] ])
+    tweights = c.get('TWEIGHTS') or []
+    if isinstance(tweights, str): tweights = tweights.split()
+    if mert >= 1:
+        decodedir = classifiersubdir + "/decode-mert" + timblname
+    else:
+        if not tweights:
+            raise ValueError("No TWEIGHTS in experiment configuration")
+        decodedir = classifiersubdir + "/decode-T" + ",".join(tweights) + "-L" + c['LMWEIGHT'] + "-D" + c['DWEIGHT'] + "-W" + c['WWEIGHT'] + "-P" + c['PWEIGHT'] + timblname
+    decodemertdir = classifiersubdir + "/dev-mert" + timblname
+    if int(c['LEFT']) >= 1 or int(c['RIGHT']) >= 1:
+        baselinedir = os.path.join(c.get('EXPDIR',".."), name, "classifierdata-MI1l0r0" + extraname, "classifiers-H" + c['SCOREHANDLING'] + "-ignored", "decode-mert")
+    else:
+        baselinedir = ""
+
+    trainsource = "../" + c['TRAINSOURCE'] + ".txt"
+    traintarget = "../" + c['TRAINTARGET'] + ".txt"
+    testsource = "../" + c['TESTSOURCE'] + ".txt"
+    testtarget = "../" + c['TESTTARGET'] + ".txt"
+    lm = c['TARGETLANG'] + ".lm"
+    timbloptions = " --ta " + c['TIMBL_A'] + " --tk " + c['TIMBL_K'] + " --td " + c['TIMBL_D'] + " --tw " + c['TIMBL_W'] + " --tm " + c['TIMBL_M']
+    corpuslinks = "ln -sf " + trainsource + " corpus." + c['SOURCELANG'] + " && ln -sf " + traintarget + " corpus." + c['TARGETLANG']
+    trainmodel = c['TRAINMODEL'] + " -external-bin-dir " + c['EXTERNALBINDIR'] + " -root-dir . --corpus corpus --f " + c['SOURCELANG'] + " --e " + c['TARGETLANG']
+    if reordering:
+        trainmodel += " -reordering " + reordering
+
+    p.add(Stage('lm', "ngram-count -text " + traintarget + " -order 3 -interpolate -kndiscount -unk -lm " + lm, 'buildphrasetable', inputs=[traintarget], outputs=[lm], cacheable=True))
+
+    if c.get('MOSESONLY') == "1":
+        p.add(Stage('phrasetable', corpuslinks + " && " + trainmodel + " --last-step 9 --lm 0:3:" + os.path.abspath(os.path.join(workdir, lm)), 'buildphrasetable', inputs=[trainsource, traintarget], outputs=["model/phrase-table.gz", "model/moses.ini"], deps=['lm']))
+        runs = range(1, mert+1) if mert >= 1 else [0]
+        for run in runs:
+            suffix = "-mert-" + str(run) if run else ""
+            ini = "model/moses.ini"
+            deps = ['phrasetable']
+            if run:
+                p.add(Stage('mert' + str(run), c.get('MOSESDIR','') + "/scripts/training/mert-moses.pl --decoder-flags=\"-threads " + str(threads) + "\" --working-dir=mert-work-" + str(run) + " --mertdir=" + c.get('MOSESDIR','') + "/mert/ ../" + c.get('DEVSOURCE','') + ".txt ../" + c.get('DEVTARGET','') + ".txt `which moses` model/moses.ini", 'decoder', outputs=["mert-work-" + str(run) + "/moses.ini"], deps=deps, cores=threads))
+                ini = "mert-work-" + str(run) + "/moses.ini"
+                deps = ['mert' + str(run)]
+            output = "output.mosesonly" + suffix + ".txt"
+            p.add(Stage('decode' + suffix, "moses -threads " + str(threads) + " -f " + ini + " < " + testsource + " > " + output, 'decoder', outputs=[output], deps=deps, cores=threads))
+            p.add(Stage('evaluate' + suffix, "colibri-evaluate --matrexdir " + c.get('MATREXDIR','') + " --input " + testsource + " --ref " + testtarget + " --out " + output, 'evaluation', outputs=["output.mosesonly" + suffix + ".summary.score"], deps=['decode' + suffix]))
+        return p
+
+    #phrase table (and reordering table)
+    cmd = corpuslinks + " && ( [ -f model/phrase-table.gz ] || " + trainmodel + " --last-step 8 ) && cp model/phrase-table.gz " + name + ".phrasetable.gz && gunzip -f " + name + ".phrasetable.gz"
+    outputs = [name + ".phrasetable"]
+    if reordering:
+        cmd += " && ln -sf model/reordering-table*.gz reordering-table.gz"
+        outputs.append("reordering-table.gz")
+    p.add(Stage('phrasetable', cmd, 'buildphrasetable', inputs=[trainsource, traintarget], outputs=outputs))
+
+    #class encoding and pattern models, source and target side are independent
+    for side, corpus, field, sort in (('source', c['TRAINSOURCE'], 1, ""), ('target', c['TRAINTARGET'], 4, " | sort")):
+        p.add(Stage(side + 'encode', "colibri-classencode ../" + corpus + ".txt", 'patternmodels', inputs=["../" + corpus + ".txt"], outputs=[corpus + ".colibri.cls", corpus + ".colibri.dat"], cacheable=True))
+        if c.get('PATTERNCONSTRAIN') == "1":
+            cmd = "colibri-patternmodeller -f " + corpus + ".colibri.dat -o " + corpus + ".colibri.indexedpatternmodel -l " + c['MAXLENGTH'] + " -t " + c['OCCURRENCES']
+            deps = [side + 'encode']
+            inputs = [corpus + ".colibri.dat"]
+        else:
+            dump = name + ".phrasetable." + side + "dump"
+            tmpmodel = side[:3] + "tmp.colibri.unindexedpatternmodel"
+            if side == 'target': tmpmodel = "tgttmp.colibri.unindexedpatternmodel"
+            cmd = "cat " + name + ".phrasetable | awk 'BEGIN { FS=\"|\" } { gsub(/^[ \\t]+/, \"\", $" + str(field) + "); gsub(/[ \\t]+$/, \"\", $" + str(field) + "); if ($" + str(field) + " != \"\") print $" + str(field) + "; }'" + sort + " | uniq > " + dump
+            cmd += " && colibri-classencode -c " + corpus + ".colibri.cls " + dump
+            cmd += " && colibri-patternmodeller -u -f " + dump + ".colibri.dat -o " + tmpmodel + " -L"
+            cmd += " && colibri-patternmodeller -f " + corpus + ".colibri.dat -o " + corpus + ".colibri.indexedpatternmodel -j " + tmpmodel + " -t 1 -l " + c['MAXLENGTH']
+            deps = [side + 'encode', 'phrasetable']
+            inputs = [corpus + ".colibri.dat", name + ".phrasetable"]
+        p.add(Stage(side + 'patternmodel', cmd, 'patternmodels', inputs=inputs, outputs=[corpus + ".colibri.indexedpatternmodel"], deps=deps, cacheable=True))
+
+    factordeps = []
+    factoroptions = ""
+    if c.get('TRAINFACTOR'):
+        p.add(Stage('factorencode', "colibri-classencode ../" + c['TRAINFACTOR'] + ".txt", 'patternmodels', inputs=["../" + c['TRAINFACTOR'] + ".txt"], outputs=[c['TRAINFACTOR'] + ".colibri.cls", c['TRAINFACTOR'] + ".colibri.dat"], cacheable=True))
+        factordeps = ['factorencode']
+        factoroptions = " -f " + c['TRAINFACTOR'] + ".colibri.dat -l " + c['LEFT'] + " -r " + c['RIGHT'] + " -c " + c['TRAINFACTOR'] + ".colibri.cls"
+
+    src = c['TRAINSOURCE']
+    tgt = c['TRAINTARGET']
+    alignmodel = name + ".colibri.alignmodel"
+    p.add(Stage('alignmodel', "colibri-mosesphrasetable2alignmodel -i " + name + ".phrasetable -S " + src + ".colibri.cls -T " + tgt + ".colibri.cls -o " + alignmodel + " -m " + src + ".colibri.indexedpatternmodel -M " + tgt + ".colibri.indexedpatternmodel -p " + c['MIN_PTS'] + " -P " + c['MIN_PST'], 'buildalignmentmodel', inputs=[name + ".phrasetable", src + ".colibri.cls", tgt + ".colibri.cls", src + ".colibri.indexedpatternmodel", tgt + ".colibri.indexedpatternmodel"], outputs=[alignmodel], deps=['phrasetable','sourcepatternmodel','targetpatternmodel'], cacheable=True))
+
+    p.add(Stage('extractfeatures', "mkdir -p " + classifierdir + " && colibri-extractfeatures -i " + alignmodel + " -s " + src + ".colibri.indexedpatternmodel -t " + tgt + ".colibri.indexedpatternmodel -f " + src + ".colibri.dat -l " + c['LEFT'] + " -r " + c['RIGHT'] + " -c " + src + ".colibri.cls" + factoroptions + " -S " + src + ".colibri.cls -T " + tgt + ".colibri.cls -C -" + c['CLASSIFIERTYPE'] + " -o " + classifierdir + " -I " + c['INSTANCETHRESHOLD'] + extraoptions, 'featureextraction', outputs=[classifierdir + "/classifier.conf"], deps=['alignmodel'] + factordeps))
+
+    testfactor = " -f ../" + c['TESTFACTOR'] + ".txt" if c.get('TESTFACTOR') else ""
+    devfactor = " -f ../" + c['DEVFACTOR'] + ".txt" if c.get('DEVFACTOR') else ""
+    withdev = " -d ../" + c['DEVSOURCE'] + ".txt" if mert >= 1 and c.get('DEVSOURCE') else ""
+    reorderingoptions = " --reordering " + reordering + " --reorderingtable reordering-table.gz" if reordering else ""
+    p.add(Stage('trainclassifiers', "mkdir -p " + classifiersubdir + " && colibri-contextmoses --train -a " + alignmodel + " -S " + src + ".colibri.cls -T " + tgt + ".colibri.cls -f " + testsource + withdev + testfactor + " -w " + classifierdir + " --classifierdir " + classifiersubdir + " --threads " + str(threads) + " --ta " + c['TIMBL_A'] + (" --oracle" if c.get('ORACLE') == "1" else "") + " " + contextmosesoptions + " --ignoreerrors", 'trainclassifiers', outputs=[classifiersubdir + "/trained"], deps=['extractfeatures'], cores=threads))
+
+    contextmoses = "colibri-contextmoses -a " + alignmodel + " -S " + src + ".colibri.cls -T " + tgt + ".colibri.cls -w " + classifierdir + " --lm " + os.path.abspath(os.path.join(workdir, lm)) + " -H " + c['SCOREHANDLING'] + " --classifierdir " + classifiersubdir + " --threads " + str(threads) + timbloptions + " " + contextmosesoptions + " --ignoreerrors" + reorderingoptions
+    decodedeps = ['trainclassifiers','lm']
+    p.add(Stage('decodetest', "mkdir -p " + decodedir + " && " + contextmoses + " -f " + testsource + withdev + testfactor + " --decodedir " + decodedir + (" --skipdecoder" if mert >= 1 else ""), 'decoder', outputs=[decodedir + "/moses.ini", decodedir + "/test.txt"] + ([] if mert >= 1 else [decodedir + "/output.txt"]), deps=decodedeps, cores=threads))
+
+    if mert >= 1:
+        p.add(Stage('mertdev', "mkdir -p " + decodemertdir + " && " + contextmoses + " -f ../" + c.get('DEVSOURCE','') + ".txt" + devfactor + " --mert " + str(mert) + " --ref ../" + c.get('DEVTARGET','') + ".txt --decodedir " + decodemertdir + " --mosesdir " + c.get('MOSESDIR',''), 'decoder', outputs=[decodemertdir + "/mert-work-" + str(mert) + "/moses.ini"], deps=decodedeps, cores=threads))
+        #the test set is decoded with the weights of every MERT run, these are independent
+        outputs = []
+        for run in range(1, mert+1):
+            ini = decodedir + "/mert-work-" + str(run) + "-moses.ini"
+            cmd = "cp -f " + decodemertdir + "/mert-work-" + str(run) + "/moses.ini " + ini
+            cmd += " && sed -i -e 's@[A-Za-z0-9\\.\\/_-]*phrase-table@" + decodedir + "/phrase-table@' " + ini
+            cmd += " && sed -i -e 's@[A-Za-z0-9\\.\\/_-]*reordering-table@" + decodedir + "/reordering-table@' " + ini
+            cmd += " && moses -threads " + str(threads) + " -f " + ini + " < " + decodedir + "/test.txt > " + decodedir + "/output.txt.opt" + str(run)
+            p.add(Stage('decodemert' + str(run), cmd, 'decoder', outputs=[decodedir + "/output.txt.opt" + str(run)], deps=['mertdev','decodetest'], cores=threads))
+            outputs.append(decodedir + "/output.txt.opt" + str(run))
+        #output.txt and moses.ini always refer to the last run
+        p.add(Stage('decodemert', "ln -sf mert-work-" + str(mert) + "-moses.ini " + decodedir + "/moses.ini && ln -sf output.txt.opt" + str(mert) + " " + decodedir + "/output.txt", 'decoder', deps=[ 'decodemert' + str(run) for run in range(1, mert+1) ]))
+        if baselinedir:
+            workdir_abs = os.path.abspath(workdir)
+            cmd = "mkdir -p " + decodedir + "/sentlevel && cd " + c.get('MULTEVALDIR','.') + " && ./multeval.sh eval --refs " + workdir_abs + "/" + testtarget + " --hyps-baseline " + baselinedir + "/output.txt.opt* --hyps-sys1 " + " ".join([ workdir_abs + "/" + x for x in outputs ]) + " --meteor.language " + c['TARGETLANG'] + " --latex " + workdir_abs + "/" + decodedir + "/output.table.tex --sentLevelDir " + workdir_abs + "/" + decodedir + "/sentlevel > " + workdir_abs + "/" + decodedir + "/output.summary.score"
+            p.add(Stage('evaluate', cmd, 'evaluation', outputs=[decodedir + "/output.summary.score"], deps=['decodemert']))
+        else:
+            log.info("No BASELINEDIR (no context), skipping evaluation")
+    else:
+        p.add(Stage('evaluate', "colibri-evaluate --matrexdir " + c.get('MATREXDIR','') + " --input " + testsource + " --ref " + testtarget + " --out " + decodedir + "/output.txt", 'evaluation', outputs=[decodedir + "/output.summary.score"], deps=['decodetest']))
+    return p
+
+
+def readgrid(config, sweeps=()):
+    """Returns the parameter grid of a sweep as a list of (key, values): from SWEEP_<KEY>=(value value ...) in the configuration and KEY=value,value,... arguments. Values of array variables (like TWEIGHTS) are space-separated lists"""
+    grid = []
+    for key, values in sorted(config.items()):
+        if key.startswith('SWEEP_'):
+            grid.append( (key[6:], values if isinstance(values, list) else values.split()) )
+    for sweep in sweeps:
+        if '=' not in sweep:
+            raise ValueError("Invalid sweep, expected KEY=value,value,...: " + sweep)
+        key, values = sweep.split('=',1)
+        grid = [ (k, v) for k, v in grid if k != key ]
+        grid.append( (key, values.split(',')) )
+    for i, (key, values) in enumerate(grid):
+        if isinstance(config.get(key), list):
+            grid[i] = (key, [ value.split() for value in values ])
+    return grid
+
+
+def sweep(config, workdir, grid, cache=True):
+    """Builds one pipeline for all points of a parameter grid, stages that do not depend on the swept parameters are shared between the points. Returns (pipeline, points), where points is a list of (parameters, stage name mapping)"""
+    pipeline = Pipeline(workdir, cache=cache)
+    points = []
+    keys = [ key for key, _ in grid ]
+    for values in itertools.product(*[ values for _, values in grid ]):
+        parameters = OrderedDict(zip(keys, values))
+        pointconfig = dict(config)
+        pointconfig.update(parameters)
+        suffix = ",".join([ key + "=" + (" ".join(value) if isinstance(value, list) else value) for key, value in parameters.items() ])
+        names = pipeline.merge(experiment(pointconfig, workdir, cache), suffix)
+        points.append( (parameters, names) )
+    return pipeline, points
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a colibri-mt experiment: stages are run as a dependency graph, independent stages run concurrently. Reads the same experiment configuration files as colibri-mt-exp.sh (variable assignments in bash syntax)", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('config',type=str,help="Experiment configuration file")
+    parser.add_argument('-j','--cores',type=int,help="Core budget: maximum number of cores used by concurrently running stages (default: all)", action='store',default=0)
+    parser.add_argument('-m','--memory',type=int,help="Memory budget in MB for concurrently running stages (0 = unlimited)", action='store',default=0)
+    parser.add_argument('--laststage',type=str,help="Halt after this stage (overrides LASTSTAGE from the configuration): " + ", ".join(STAGEGROUPS), action='store',default="")
+    parser.add_argument('--dryrun',help="Only show the stages that would be run", action='store_true',default=False)
+    parser.add_argument('--nocache',help="Do not use the artifact cache", action='store_true',default=False)
+    parser.add_argument('--sweep',type=str,help="Parameter sweep: KEY=value,value,... (may be specified multiple times, the grid is the product of all), e.g. --sweep TIMBL_A=0,1 --sweep SCOREHANDLING=append,replace. Sweeps may also be set in the configuration as SWEEP_KEY=(value value ...). Stages that do not depend on the swept parameters are run only once", action='append',default=[])
+    addmetricsarguments(parser)
+    addloggingarguments(parser)
+    args = parser.parse_args()
+    setuplogging(args)
+    setupmetrics(args, 'colibri-mt')
+
+    config = readconfig(args.config)
+    workdir = os.path.join(config.get('EXPDIR') or os.path.dirname(os.path.abspath(args.config)), config['NAME'])
+    os.makedirs(workdir, exist_ok=True)
+    grid = readgrid(config, args.sweep)
+    if grid:
+        pipeline, points = sweep(config, workdir, grid, cache=not args.nocache)
+        log.info("Sweep over " + str(len(points)) + " points: " + str(sum( len(names) for _, names in points )) + " stages, of which " + str(len(pipeline.stages)) + " distinct")
+    else:
+        pipeline = experiment(config, workdir, cache=not args.nocache)
+        points = []
+    #memory estimates (MB) per stage may be given in the configuration as MEMORY_<stage>=...
+    for stage in pipeline.stages:
+        if config.get('MEMORY_' + stage.name.split('@')[0]):
+            stage.memory = int(config['MEMORY_' + stage.name.split('@')[0]])
+    log.info("Experiment " + config['NAME'] + " in " + workdir + ", " + str(len(pipeline.stages)) + " stages")
+    ok = pipeline.run(args.laststage or config['LASTSTAGE'], args.cores, args.memory, args.dryrun)
+    for parameters, names in points:
+        evaluation = pipeline[names.get('evaluate','')]
+        log.info(" ".join([ key + "=" + str(value) for key, value in parameters.items() ]) + "\t" + (evaluation.outputs[0] + " (" + str(evaluation.status) + ")" if evaluation else "(no evaluation)"))
+    metrics.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
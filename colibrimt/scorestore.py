@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import numpy
+from colibrimt.lm import quantise, nearest
+
+#Compact storage of the score vectors of an alignment model: all scores live in one contiguous fixed-width array (one
+#row per phrase pair, one column per score), either as float16 or as 8-bit codes into a per-column codebook of 256
+#values. Word alignments (a trailing list of (sourceindex, targetindex) tuples in the score vector, as produced by
+#colibri-extractskipgrams) are packed as uint8 pairs in a side buffer.
+#Scores are staged in float32 and only reduced to float16 or uint8 by freeze(). Probability columns (all values in
+#(0,1]) are then stored in the log domain, so small probabilities keep their relative precision rather than being
+#rounded to zero.
+
+MODES = ('float16','uint8')
+
+
+class ScoreStore:
+    def __init__(self, mode='float16', capacity=1024):
+        if mode not in MODES:
+            raise ValueError("Invalid score storage mode: " + str(mode))
+        self.mode = mode
+        self.columns = None #number of score columns, set by the first row
+        self.hasalignments = False
+        self.rows = 0
+        self.capacity = capacity
+        self.data = None #float32 (staging), float16 or uint8 codes once frozen
+        self.frozen = False
+        self.codebooks = None #(columns, 256) float32, only when frozen in uint8 mode
+        self.logcolumns = None #per column: stored in the log domain, set when frozen
+        self.alignments = bytearray()
+        self.alignmentoffsets = numpy.zeros(capacity + 1, dtype=numpy.uint64)
+
+    def _grow(self):
+        self.capacity *= 2
+        data = numpy.zeros((self.capacity, self.columns), dtype=self.data.dtype)
+        data[:self.rows] = self.data[:self.rows]
+        self.data = data
+        offsets = numpy.zeros(self.capacity + 1, dtype=numpy.uint64)
+        offsets[:self.rows+1] = self.alignmentoffsets[:self.rows+1]
+        self.alignmentoffsets = offsets
+
+    def _split(self, features):
+        if features and isinstance(features[-1], (list, tuple)):
+            return features[:-1], features[-1]
+        return features, None
+
+    def append(self, features):
+        """Adds a score vector, returns its row number"""
+        scores, alignment = self._split(features)
+        if self.columns is None:
+            self.columns = len(scores)
+            self.hasalignments = alignment is not None
+            self.data = numpy.zeros((self.capacity, self.columns), dtype=numpy.float32)
+        if self.rows == self.capacity:
+            self._grow()
+        row = self.rows
+        self.rows += 1
+        self.alignmentoffsets[row+1] = self.alignmentoffsets[row]
+        self[row] = features
+        return row
+
+    def __setitem__(self, row, features):
+        scores, alignment = self._split(features)
+        if len(scores) != self.columns:
+            raise ValueError("Score vector has " + str(len(scores)) + " columns, the score store has a fixed width of " + str(self.columns))
+        if self.frozen:
+            self.data[row] = self._encode(numpy.asarray(scores, dtype=numpy.float64).reshape(1,-1))[0]
+        else:
+            self.data[row] = scores
+        if alignment is not None and self.hasalignments:
+            packed = bytes( x for pair in alignment for x in pair ) #raises ValueError for indices over 255
+            begin = int(self.alignmentoffsets[row])
+            end = int(self.alignmentoffsets[row+1])
+            if row == self.rows - 1:
+                del self.alignments[begin:]
+                self.alignments += packed
+                self.alignmentoffsets[row+1] = begin + len(packed)
+            elif len(packed) == end - begin:
+                self.alignments[begin:end] = packed
+            else:
+                raise ValueError("Word alignments of a stored row can only be replaced by an alignment of the same size")
+
+    def __getitem__(self, row):
+        """Returns the score vector of a row as a list (with the word alignments as last element, if any)"""
+        if self.frozen:
+            features = [ float(x) for x in self._decode(self.data[row:row+1])[0] ]
+        else:
+            features = [ float(x) for x in self.data[row] ]
+        if self.hasalignments:
+            packed = self.alignments[int(self.alignmentoffsets[row]):int(self.alignmentoffsets[row+1])]
+            features.append([ (packed[i], packed[i+1]) for i in range(0, len(packed), 2) ])
+        return features
+
+    def __len__(self):
+        return self.rows
+
+    def _encode(self, scores):
+        with numpy.errstate(divide='ignore'):
+            scores = numpy.where(self.logcolumns, numpy.log(numpy.maximum(scores, 0)), scores)
+        if self.codebooks is None:
+            return scores.astype(numpy.float16)
+        codes = numpy.zeros(scores.shape, dtype=numpy.uint8)
+        for i in range(self.columns):
+            order = numpy.argsort(self.codebooks[i], kind='stable')
+            codes[:,i] = order[nearest(self.codebooks[i][order], scores[:,i])]
+        return codes
+
+    def _decode(self, data):
+        if self.codebooks is None:
+            scores = data.astype(numpy.float64)
+        else:
+            scores = numpy.stack([ self.codebooks[i][data[:,i]] for i in range(self.columns) ], axis=1).astype(numpy.float64)
+        return numpy.where(self.logcolumns, numpy.exp(scores), scores)
+
+    def freeze(self):
+        """Reduce the (float32) scores added so far to float16, or in uint8 mode quantise them to 8-bit codes. Rows added afterwards are encoded the same way"""
+        if self.frozen or self.columns is None:
+            return
+        staged = self.data[:self.rows].astype(numpy.float64)
+        self.logcolumns = numpy.array([ self.rows > 0 and bool(numpy.all((staged[:,i] > 0) & (staged[:,i] <= 1))) for i in range(self.columns) ])
+        with numpy.errstate(divide='ignore'):
+            staged = numpy.where(self.logcolumns, numpy.log(numpy.maximum(staged, 0)), staged)
+        if self.mode == 'uint8':
+            data = numpy.zeros((self.capacity, self.columns), dtype=numpy.uint8)
+            self.codebooks = numpy.zeros((self.columns, 256), dtype=numpy.float32)
+            for i in range(self.columns):
+                self.codebooks[i], data[:self.rows,i] = quantise(staged[:,i])
+        else:
+            data = numpy.zeros((self.capacity, self.columns), dtype=numpy.float16)
+            data[:self.rows] = staged
+        self.data = data
+        self.frozen = True
+
+    def thaw(self):
+        """Undo freeze(): decode the scores back to float32, so that they can be modified and frozen anew"""
+        if not self.frozen:
+            return
+        data = numpy.zeros((self.capacity, self.columns), dtype=numpy.float32)
+        data[:self.rows] = self._decode(self.data[:self.rows])
+        self.data = data
+        self.codebooks = None
+        self.logcolumns = None
+        self.frozen = False
+
+    def memory(self):
+        """Memory used by the store, in bytes"""
+        total = len(self.alignments) + self.alignmentoffsets.nbytes
+        if self.data is not None:
+            total += self.data.nbytes
+        if self.codebooks is not None:
+            total += self.codebooks.nbytes
+        return total
+
+    def save(self, filename):
+        self.freeze()
+        data = self.data[:self.rows] if self.data is not None else numpy.zeros((0,0), dtype=numpy.float16)
+        arrays = {'data': data, 'alignments': numpy.frombuffer(bytes(self.alignments), dtype=numpy.uint8), 'alignmentoffsets': self.alignmentoffsets[:self.rows+1], 'hasalignments': numpy.array([self.hasalignments])}
+        if self.logcolumns is not None:
+            arrays['logcolumns'] = self.logcolumns
+        if self.codebooks is not None:
+            arrays['codebooks'] = self.codebooks
+        with open(filename,'wb') as f:
+            numpy.savez(f, **arrays)
+
+    @staticmethod
+    def load(filename):
+        with numpy.load(filename) as arrays:
+            store = ScoreStore('uint8' if 'codebooks' in arrays else 'float16', max(1,len(arrays['data'])))
+            store.data = arrays['data'].copy()
+            store.rows = len(store.data)
+            store.columns = store.data.shape[1] if store.rows else None
+            store.capacity = max(1, store.rows)
+            if not store.rows:
+                store.data = None
+            store.hasalignments = bool(arrays['hasalignments'][0])
+            store.alignments = bytearray(arrays['alignments'].tobytes())
+            store.alignmentoffsets = numpy.zeros(store.capacity + 1, dtype=numpy.uint64)
+            store.alignmentoffsets[:store.rows+1] = arrays['alignmentoffsets']
+            if 'codebooks' in arrays:
+                store.codebooks = arrays['codebooks'].copy()
+            if store.rows:
+                store.frozen = True
+                store.logcolumns = arrays['logcolumns'].copy() if 'logcolumns' in arrays else numpy.zeros(store.columns, dtype=bool)
+        return store
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function, unicode_literals, division, absolute_import
+
+import os
+import sys
+import gzip
+import heapq
+import pickle
+import tempfile
+from colibrimt.instrumentation import metrics
+from colibrimt.logger import log
+
+#External-memory buffer for feature extraction on corpora whose occurrence lists do not fit in memory: records (tuples)
+#are collected in memory until they exceed a memory cap, then sorted and spilled to a compressed run file. Iterating
+#yields all records in sorted order, with a streaming k-way merge (heapq.merge) over the runs, so only one record per
+#run is in memory at a time.
+
+
+def recordsize(record):
+    """Approximate memory used by a record (a tuple of scalars and strings)"""
+    return sys.getsizeof(record) + sum( sys.getsizeof(field) for field in record )
+
+
+class SpillBuffer:
+    def __init__(self, maxmemory, tmpdir=None, compresslevel=1):
+        """Maxmemory in bytes, runs are written to tmpdir (the system default if not set)"""
+        self.maxmemory = maxmemory
+        self.tmpdir = tmpdir
+        self.compresslevel = compresslevel
+        self.records = []
+        self.memory = 0
+        self.runs = []
+        self.count = 0
+
+    def append(self, record):
+        self.records.append(record)
+        self.memory += recordsize(record)
+        self.count += 1
+        if self.memory >= self.maxmemory:
+            self.spill()
+
+    def __len__(self):
+        return self.count
+
+    def spill(self):
+        """Sort the records in memory and write them to a new run file"""
+        if not self.records:
+            return
+        self.records.sort()
+        fd, filename = tempfile.mkstemp(prefix="colibrimt-run-", suffix=".gz", dir=self.tmpdir)
+        os.close(fd)
+        with gzip.open(filename,'wb',compresslevel=self.compresslevel) as f:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            for record in self.records:
+                pickler.dump(record)
+                pickler.clear_memo()
+        log.debug("Spilled " + str(len(self.records)) + " records to " + filename)
+        metrics.count('spilledruns')
+        metrics.count('spilledrecords', len(self.records))
+        self.runs.append(filename)
+        self.records = []
+        self.memory = 0
+
+    def _readrun(self, filename):
+        with gzip.open(filename,'rb') as f:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    yield unpickler.load()
+                except EOFError:
+                    break
+
+    def __iter__(self):
+        """All records in sorted order"""
+        self.records.sort()
+        if not self.runs:
+            return iter(self.records)
+        return heapq.merge(self.records, *[ self._readrun(filename) for filename in self.runs ])
+
+    def close(self):
+        """Remove the run files"""
+        for filename in self.runs:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        self.runs = []
+        self.records = []
+        self.memory = 0
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -3,7 +3,7 @@
 from __future__ import print_function, unicode_literals, division, absolute_import
 import colibricore
 
-from colibrimt.alignmentmodel import FeaturedAlignmentModel
+from colibrimt.alignmentmodel import AlignmentModel
 
 sourceencoder = colibricore.ClassEncoder()
 targetencoder = colibricore.ClassEncoder()
@@ -19,13 +19,13 @@ targetencoder.save('/tmp/t.cls')
 sd = colibricore.ClassDecoder('/tmp/s.cls')
 td = colibricore.ClassDecoder('/tmp/t.cls')
 
-model = FeaturedAlignmentModel()
+model = AlignmentModel()
 model.add(s1,t1,[1,0,1,0])
 model.add(s1,t2,[1,0,1,0])
 model.add(s2,t2,[1,0,1,0])
 model.add(s2,t3,[1,0,1,0])
 model.normalize('s-t-')
 
-for source, target,scores in model:
+for source, target,scores in model.triples():
     print(source.tostring(sd)+"\t"+target.tostring(td)+"\t" + " ".join([str(x) for x in scores]))
 
@@ -6,25 +6,62 @@
 #include <classencoder.h>
 #include <classdecoder.h>
 #include <map>
+#include <unordered_map>
 #include <cmath>
+#include <stdint.h>
+
+//binary, sorted, memory-mapped language model format, produced by colibri-lmconvert (colibrimt/lm.py), see there for a description
+#define LM_MAGIC "COLIBLM2"
+#define LM_MAXORDER 9
+
+struct BinaryLMHeader {
+    char magic[8];
+    uint32_t order;
+    uint32_t reserved;
+    uint64_t count;
+    double unkprob;
+    uint64_t total[LM_MAXORDER+1];
+} __attribute__((packed));
 
 class LanguageModel {
     private:
         bool DEBUG;
         int order;
         ClassDecoder * classdecoder;
+
+        //binary memory-mapped model
+        bool binary;
+        void * mapped;
+        size_t mappedsize;
+        uint64_t count;
+        double unkprob;
+        const float * probcodebook;
+        const float * backoffcodebook;
+        const uint64_t * keys;
+        const uint8_t * probs;
+        const uint8_t * backoffs;
+        std::unordered_map<Pattern,uint64_t> tokenhashes; //token => hash, filled on first use (not thread-safe)
+
+        bool loadbinary(const std::string & filename);
+        uint64_t tokenhash(const Pattern & token);
+        uint64_t hash(const Pattern * ngram);
+        int64_t findbinary(const Pattern * ngram);
+        bool findngram(const Pattern * ngram, double & logprob);
+        bool findbackoff(const Pattern * ngram, double & weight);
     public:
         PatternMap<double> ngrams;
         PatternMap<double> backoff;  
         std::map<int,unsigned int> total;
         
-        LanguageModel(const std::string & filename,  ClassEncoder & encoder, ClassDecoder * classdecoder, bool debug = false);
+        LanguageModel(const std::string & filename,  ClassEncoder & encoder, ClassDecoder * classdecoder, bool debug = false); //filename may be an ARPA file or a binary model (detected automatically)
+        ~LanguageModel();
         
         double score(const Pattern * ngram, const Pattern * history = NULL); //returns logprob (base e)        
         double scoreword(const Pattern * word, const Pattern * history = NULL); //returns logprob (base e)
                  
         int getorder() { return order; }
-        size_t size() { return ngrams.size(); }
+        size_t size() { return binary ? count : ngrams.size(); }
+        bool isbinary() { return binary; }
 };
 
 #endif
@@ -73,6 +73,13 @@ if [ -z "$THREADS" ]; then
     THREADS=1
 fi
 
+#Stages wrapped by colibri-cache are rerun when their inputs or options change, and reused (also across experiments) otherwise. Set NOCACHE=1 to disable
+if [ "$NOCACHE" != "1" ] && command -v colibri-cache >/dev/null 2>&1; then
+    CACHE=1
+else
+    CACHE=0
+fi
+
 RUN=1
 if [ "$MOSESONLY" = "1" ]; then
     if [ ! -z "$SELECT" ]; then
@@ -172,7 +179,9 @@ if [ "$RUN" = "1" ]; then
 
 
 
-    if [ ! -f "$TARGETLANG.lm" ]; then
+    if [ "$CACHE" = "1" ]; then
+        colibri-cache run -s lm -i ../$TRAINTARGET.txt -o $TARGETLANG.lm -- ngram-count -text ../$TRAINTARGET.txt -order 3 -interpolate -kndiscount -unk -lm $TARGETLANG.lm
+    elif [ ! -f "$TARGETLANG.lm" ]; then
         echo -e "${blue}$NAME -- Building language model${NC}">&2
         ngram-count -text ../$TRAINTARGET.txt -order 3 -interpolate -kndiscount -unk -lm $TARGETLANG.lm
     fi
@@ -387,9 +396,12 @@ if [ "$RUN" = "1" ]; then
             exit 0
         fi
 
-        if [ ! -f "$NAME.colibri.alignmodel" ]; then
+        if [ "$CACHE" = "1" ] || [ ! -f "$NAME.colibri.alignmodel" ]; then
             echo -e "${blue}[$NAME]\nConverting phrasetable to alignment model${NC}">&2
             CMD="colibri-mosesphrasetable2alignmodel -i $NAME.phrasetable -S $TRAINSOURCE.colibri.cls -T $TRAINTARGET.colibri.cls -o $NAME.colibri.alignmodel -m $TRAINSOURCE.colibri.indexedpatternmodel -M $TRAINTARGET.colibri.indexedpatternmodel -p $MIN_PTS -P $MIN_PST"
+            if [ "$CACHE" = "1" ]; then
+                CMD="colibri-cache run -s alignmodel -i $NAME.phrasetable -i $TRAINSOURCE.colibri.cls -i $TRAINTARGET.colibri.cls -i $TRAINSOURCE.colibri.indexedpatternmodel -i $TRAINTARGET.colibri.indexedpatternmodel -o $NAME.colibri.alignmodel -- $CMD"
+            fi
             echo $CMD>&2
             $CMD
             if [[ $? -ne 0 ]]; then
@@ -410,21 +422,29 @@ if [ "$RUN" = "1" ]; then
             TRAINFILES=`find $CLASSIFIERDIR -type f -name "*.train" | wc -l`
         fi
 
-        if [ ! -d $CLASSIFIERDIR ] || [[ $TRAINFILES -eq 0 ]]; then
+        if [ "$CACHE" = "1" ] || [ ! -d $CLASSIFIERDIR ] || [[ $TRAINFILES -eq 0 ]]; then
             echo -e "${blue}[$NAME/$CLASSIFIERDIR]\nExtracting features and building classifiers${NC}">&2
-            mkdir $CLASSIFIERDIR
+            mkdir -p $CLASSIFIERDIR
             if [ ! -z "$TRAINFACTOR" ]; then
                 FACTOROPTIONS="-f ${TRAINFACTOR}.colibri.dat -l $LEFT -r $RIGHT -c ${TRAINFACTOR}.colibri.cls"
+                FACTORINPUTS="-i ${TRAINFACTOR}.colibri.dat -i ${TRAINFACTOR}.colibri.cls"
             else
                 FACTOROPTIONS=""
+                FACTORINPUTS=""
             fi
             CMD="colibri-extractfeatures -i $NAME.colibri.alignmodel -s $TRAINSOURCE.colibri.indexedpatternmodel -t $TRAINTARGET.colibri.indexedpatternmodel -f $TRAINSOURCE.colibri.dat -l $LEFT -r $RIGHT -c $TRAINSOURCE.colibri.cls $FACTOROPTIONS -S $TRAINSOURCE.colibri.cls -T $TRAINTARGET.colibri.cls -C -$CLASSIFIERTYPE -o $CLASSIFIERDIR -I $INSTANCETHRESHOLD $EXTRAOPTIONS"
+            if [ "$CACHE" = "1" ]; then
+                #the classifier directory is keyed on the alignment model, the corpus and the context size; the stamp it gets is the input of the training stage
+                #its classifier subdirectories are the outputs of the training stages, they are excluded (the pattern is not expanded by the shell, nothing in $NAME matches it)
+                CMD="colibri-cache run -s extractfeatures -i $NAME.colibri.alignmodel -i $TRAINSOURCE.colibri.indexedpatternmodel -i $TRAINTARGET.colibri.indexedpatternmodel -i $TRAINSOURCE.colibri.dat -i $TRAINSOURCE.colibri.cls -i $TRAINTARGET.colibri.cls $FACTORINPUTS -p left=$LEFT -p right=$RIGHT -o $CLASSIFIERDIR -x classifiers-* -- $CMD"
+            fi
             echo $CMD>&2
-            $CMD 2> $CLASSIFIERDIR/extractfeatures.log
+            #logs are written next to (not in) the directories that may be restored from the cache
+            $CMD 2> $CLASSIFIERDIR.extractfeatures.log
             if [[ $? -ne 0 ]]; then
                 echo -e "${red}[$NAME/$CLASSIFIERDIR]\nError in colibri-extractfeatures${NC}" >&2
-                echo -e "See $CLASSIFIERDIR/extractfeatures , tail:" >&2
-                tail -n 25 $CLASSIFIERDIR/extractfeatures.log >&2
+                echo -e "See $CLASSIFIERDIR.extractfeatures.log , tail:" >&2
+                tail -n 25 $CLASSIFIERDIR.extractfeatures.log >&2
                 sleep 3
                 exit 2
             fi
@@ -463,16 +483,31 @@ if [ "$RUN" = "1" ]; then
         else
             WITHDEVSOURCE=""
         fi
-        if [ ! -f $CLASSIFIERDIR/$CLASSIFIERSUBDIR/trained ]; then
+        if [ "$CACHE" = "1" ]; then
+            CACHEINPUTS="-i $NAME.colibri.alignmodel -i ../$TESTSOURCE.txt"
+            if [ ! -z "$WITHDEVSOURCE" ]; then
+                CACHEINPUTS="$CACHEINPUTS -i ../$DEVSOURCE.txt"
+            fi
+            if [ ! -z "$TESTFACTOR" ]; then
+                CACHEINPUTS="$CACHEINPUTS -i ../$TESTFACTOR.txt"
+            fi
+            CACHEPARAMS="-p left=$LEFT -p right=$RIGHT -p scorehandling=$SCOREHANDLING -p ta=${TIMBL_A} -p tk=${TIMBL_K} -p tw=${TIMBL_W} -p tm=${TIMBL_M} -p td=${TIMBL_D}"
+        fi
+        if [ "$CACHE" = "1" ] || [ ! -f $CLASSIFIERDIR/$CLASSIFIERSUBDIR/trained ]; then
             #classifiers are built even when ignored later
             echo -e "${blue}[$NAME/$CLASSIFIERDIR/$CLASSIFIERSUBDIR]\nTraining classifiers${NC}">&2
             CMD="colibri-contextmoses --train -a $NAME.colibri.alignmodel -S $TRAINSOURCE.colibri.cls -T $TRAINTARGET.colibri.cls -f ../$TESTSOURCE.txt $WITHDEVSOURCE $FACTOROPTIONS -w $CLASSIFIERDIR --classifierdir $CLASSIFIERDIR/$CLASSIFIERSUBDIR --threads $THREADS --ta ${TIMBL_A} ${CONTEXTMOSES_EXTRAOPTIONS} --ignoreerrors"
+            if [ "$CACHE" = "1" ]; then
+                #keyed on the stamp of the classifier directory (the key of the feature extraction) rather than its contents, which include the classifier subdirectories
+                #the decode directories are the outputs of the decoding stages, they are excluded
+                CMD="colibri-cache run -s trainclassifiers -i .$CLASSIFIERDIR.cachekey $CACHEINPUTS $CACHEPARAMS -o $CLASSIFIERDIR/$CLASSIFIERSUBDIR -x decode-* -- $CMD"
+            fi
             echo $CMD>&2
-            $CMD 2> $CLASSIFIERDIR/$CLASSIFIERSUBDIR/contextmoses-train.log
+            $CMD 2> $CLASSIFIERDIR/$CLASSIFIERSUBDIR.train.log
             if [[ $? -ne 0 ]]; then
                 echo -e "${red}[$NAME/$CLASSIFIERDIR/$CLASSIFIERSUBDIR]\nError in colibri-contextmoses${NC}" >&2
-                echo -e "See $CLASSIFIERDIR/$CLASSIFIERSUBDIR/contextmoses-train.log , tail:" >&2
-                tail -n 25 $CLASSIFIERDIR/$CLASSIFIERSUBDIR/contextmoses-train.log >&2
+                echo -e "See $CLASSIFIERDIR/$CLASSIFIERSUBDIR.train.log , tail:" >&2
+                tail -n 25 $CLASSIFIERDIR/$CLASSIFIERSUBDIR.train.log >&2
                 sleep 3
                 exit 2
             fi
@@ -516,7 +551,7 @@ if [ "$RUN" = "1" ]; then
             fi 
         fi
 
-        if [ ! -d "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR" ] || [ ! -f "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/moses.ini" ] || [ ! -f "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/test.txt" ]; then
+        if ([ "$CACHE" = "1" ] && [[ $MERT -eq 0 ]]) || [ ! -d "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR" ] || [ ! -f "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/moses.ini" ] || [ ! -f "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/test.txt" ]; then
             mkdir "$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR" 2>/dev/null
             echo -e "${blue}[$NAME/$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR]\nProcessing test data and invoking moses${NC}">&2
             #CMD="colibri-contextmoses -a $NAME.colibri.alignmodel -S $TRAINSOURCE.colibri.cls -T $TRAINTARGET.colibri.cls -f ../$TESTSOURCE.txt $FACTOROPTIONS -w $CLASSIFIERDIR --lm $EXPDIR/$NAME/$TARGETLANG.lm -H $SCOREHANDLING $TWEIGHTS_OPTIONS --lmweight $LMWEIGHT --dweight $DWEIGHT --wweight $WWEIGHT --pweight $PWEIGHT $REORDERINGWEIGHTS_OPTIONS --classifierdir $CLASSIFIERDIR/$CLASSIFIERSUBDIR --decodedir $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR --threads $THREADS --ta ${TIMBL_A} --tk ${TIMBL_K} --td ${TIMBL_D} --tw ${TIMBL_W} --tm ${TIMBL_M} ${CONTEXTMOSES_EXTRAOPTIONS} --ignoreerrors"
@@ -528,12 +563,19 @@ if [ "$RUN" = "1" ]; then
             if [ ! -z "$REORDERING" ]; then
                 CMD="$CMD --reordering $REORDERING --reorderingtable reordering-table.gz"
             fi
+            if [ "$CACHE" = "1" ] && [[ $MERT -eq 0 ]]; then
+                #with MERT the decode directory is completed by the runs below, it is not cached
+                if [ ! -z "$REORDERING" ]; then
+                    CACHEINPUTS="$CACHEINPUTS -i reordering-table.gz"
+                fi
+                CMD="colibri-cache run -s contextmoses -i $CLASSIFIERDIR/.$CLASSIFIERSUBDIR.cachekey -i $EXPDIR/$NAME/$TARGETLANG.lm $CACHEINPUTS $CACHEPARAMS -o $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR -- $CMD"
+            fi
             echo $CMD>&2
-            $CMD 2> $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/contextmoses.log
+            $CMD 2> $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR.contextmoses.log
             if [[ $? -ne 0 ]]; then
                 echo -e "${red}[$NAME/$CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR]\nError in colibri-contextmoses${NC}" >&2
-                echo -e "See $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/contextmoses.log , tail:" >&2
-                tail -n 25 $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR/contextmoses.log >&2
+                echo -e "See $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR.contextmoses.log , tail:" >&2
+                tail -n 25 $CLASSIFIERDIR/$CLASSIFIERSUBDIR/$DECODEDIR.contextmoses.log >&2
                 sleep 3
                 exit 2
             fi
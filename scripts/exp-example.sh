@@ -23,12 +23,14 @@ MIN_PST=0.05
 
 #Classifier options
 CLASSIFIERTYPE='X' # Can be X for experts, M for monolithic, and I for ignoring the classifier
+SHARDS=1 #Split a monolithic classifier into this many shards, trained in parallel (only used by the colibri-mt runner)
 INSTANCETHRESHOLD=2 #Classifier are only built and used if they have at least this number of instances
 SCOREHANDLING='append' #Score handling: append, replace or weighed
 LEFT=1 #Left context size
 RIGHT=1 #Right context size
 WEIGHBYOCCURRENCE=0  #Boolean: When building classifier data (-C), use exemplar weighting to reflect occurrence count, rather than duplicating instances
 WEIGHBYSCORE=0 #Boolean: When building classifier data (-C), use exemplar weighting to weigh in p(t|s) from score vector
+ORACLE=0 #Boolean: Only train and query the classifier experts that are judged worth it by the expert oracle (colibri-contextmoses --oracle, only used by the colibri-mt runner)
 
 #timbl options
 TIMBL_A=0
@@ -56,6 +58,7 @@ NAME="europarl50k-$SOURCELANG-$TARGETLANG-t$OCCURRENCES-l$MAXLENGTH"
 
 MATREXDIR=/home/proycon/mtevalscripts/
 
+#This file can also be run with the colibri-mt pipeline runner (colibri-mt exp-example.sh), which runs independent stages concurrently
 EXPSCRIPT=/vol/customopt/uvt-ru/src/colibri-mt/scripts/colibri-mt-exp.sh
 
 . $EXPSCRIPT
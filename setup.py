@@ -31,9 +31,14 @@ setup(
             'colibri-alignmodel = colibrimt.alignmentmodel:main_alignmodel',
             'colibri-extractfeatures = colibrimt.alignmentmodel:main_extractfeatures',
             'colibri-evaluate = colibrimt.evaluation:main',
-            'colibri-contextmoses = colibrimt.contextmoses:main'
+            'colibri-contextmoses = colibrimt.contextmoses:main',
+            'colibri-benchmark = colibrimt.benchmark:main',
+            'colibri-lmconvert = colibrimt.lm:main',
+            'colibri-filter = colibrimt.filter:main',
+            'colibri-cache = colibrimt.cache:main',
+            'colibri-mt = colibrimt.pipeline:main'
         ]
     },
     package_data = {},
-    install_requires=['colibricore >= 2.0.2']
+    install_requires=['colibricore >= 2.0.2','numpy']
 )
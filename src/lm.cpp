@@ -1,4 +1,9 @@
 #include <lm.h>
+#include <cstring>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#include <unistd.h>
 
 
 using namespace std;
@@ -7,6 +12,11 @@ LanguageModel::LanguageModel(const std::string & filename, ClassEncoder & encode
     this->DEBUG = debug; 
     this->classdecoder = classdecoder;
     order = 0;
+    binary = false;
+    mapped = NULL;
+    mappedsize = 0;
+    count = 0;
+    if (loadbinary(filename)) return;
     bool hasunk = false;
     ifstream f;    
     f.open(filename.c_str(), ios::in);
@@ -104,6 +114,139 @@ LanguageModel::LanguageModel(const std::string & filename, ClassEncoder & encode
 }
 
 
+LanguageModel::~LanguageModel() {
+    if (mapped != NULL) munmap(mapped, mappedsize);
+}
+
+bool LanguageModel::loadbinary(const std::string & filename) {
+    //memory-map the model if it is in the binary format, returns false if it is not
+    int fd = open(filename.c_str(), O_RDONLY);
+    if (fd < 0) return false;
+    struct stat st;
+    if ((fstat(fd, &st) != 0) || ((size_t) st.st_size < sizeof(BinaryLMHeader) + 256 * 2 * sizeof(float))) {
+        close(fd);
+        return false;
+    }
+    char magic[8];
+    if ((read(fd, magic, 8) != 8) || (strncmp(magic, LM_MAGIC, 7) != 0)) {
+        close(fd);
+        return false;
+    }
+    if (strncmp(magic, LM_MAGIC, 8) != 0) {
+        cerr << "ERROR: Binary language model " << filename << " was converted by an older version, convert the ARPA file again" << endl;
+        exit(3);
+    }
+    mappedsize = st.st_size;
+    mapped = mmap(NULL, mappedsize, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (mapped == MAP_FAILED) {
+        cerr << "ERROR: Unable to memory-map language model " << filename << endl;
+        exit(3);
+    }
+    const BinaryLMHeader * header = (const BinaryLMHeader *) mapped;
+    order = header->order;
+    count = header->count;
+    unkprob = header->unkprob;
+    for (int n = 0; n <= LM_MAXORDER; n++) {
+        if (header->total[n] > 0) total[n] = header->total[n];
+    }
+    const char * p = (const char *) mapped + sizeof(BinaryLMHeader);
+    probcodebook = (const float *) p;
+    p += 256 * sizeof(float);
+    backoffcodebook = (const float *) p;
+    p += 256 * sizeof(float);
+    keys = (const uint64_t *) p;
+    p += count * sizeof(uint64_t);
+    probs = (const uint8_t *) p;
+    p += count;
+    backoffs = (const uint8_t *) p;
+    p += count;
+    if ((size_t) (p - (const char *) mapped) > mappedsize) {
+        cerr << "ERROR: Binary language model " << filename << " is truncated" << endl;
+        exit(3);
+    }
+    binary = true;
+    if (DEBUG) cerr << "Memory-mapped binary language model: " << count << " n-grams, order=" << order << endl;
+    return true;
+}
+
+uint64_t LanguageModel::tokenhash(const Pattern & token) {
+    //64-bit FNV-1a hash of the token string, unknown words as <unk> (same as colibrimt/lm.py), every class is decoded and hashed only once
+    std::unordered_map<Pattern,uint64_t>::const_iterator iter = tokenhashes.find(token);
+    if (iter != tokenhashes.end()) return iter->second;
+    const string s = (token == UNKPATTERN) ? string("<unk>") : token.tostring(*classdecoder);
+    uint64_t h = 14695981039346656037ULL;
+    for (string::const_iterator c = s.begin(); c != s.end(); c++) {
+        h ^= (unsigned char) *c;
+        h *= 1099511628211ULL;
+    }
+    tokenhashes[token] = h;
+    return h;
+}
+
+uint64_t LanguageModel::hash(const Pattern * ngram) {
+    //combines the token hashes in order (same as ngramhash() in colibrimt/lm.py)
+    uint64_t h = 14695981039346656037ULL;
+    const int n = ngram->n();
+    for (int i = 0; i < n; i++) {
+        h = (h ^ tokenhash(Pattern(ngram, i, 1))) * 1099511628211ULL;
+        h ^= h >> 32;
+    }
+    return h;
+}
+
+int64_t LanguageModel::findbinary(const Pattern * ngram) {
+    //binary search in the sorted keys, returns -1 if not found
+    const uint64_t key = hash(ngram);
+    uint64_t begin = 0;
+    uint64_t end = count;
+    while (begin < end) {
+        const uint64_t middle = begin + (end - begin) / 2;
+        if (keys[middle] < key) {
+            begin = middle + 1;
+        } else {
+            end = middle;
+        }
+    }
+    if ((begin < count) && (keys[begin] == key)) return begin;
+    return -1;
+}
+
+bool LanguageModel::findngram(const Pattern * ngram, double & logprob) {
+    if (binary) {
+        const int64_t i = findbinary(ngram);
+        if (i < 0) {
+            if (ngram->n() == 1) {
+                //unknown word
+                logprob = unkprob;
+                return true;
+            }
+            return false;
+        }
+        logprob = probcodebook[probs[i]];
+        return true;
+    } else {
+        PatternMap<double>::iterator iter = ngrams.find(*ngram);
+        if (iter == ngrams.end()) return false;
+        logprob = iter->second;
+        return true;
+    }
+}
+
+bool LanguageModel::findbackoff(const Pattern * ngram, double & weight) {
+    if (binary) {
+        const int64_t i = findbinary(ngram);
+        if (i < 0) return false;
+        weight = backoffcodebook[backoffs[i]];
+        return true;
+    } else {
+        PatternMap<double>::iterator iter = backoff.find(*ngram);
+        if (iter == backoff.end()) return false;
+        weight = iter->second;
+        return true;
+    }
+}
+
 double LanguageModel::score(const Pattern * ngram, const Pattern * history) { //returns logprob (base 10)
     
     if (DEBUG) {
@@ -167,12 +310,12 @@ double LanguageModel::scoreword(const Pattern * word, const Pattern * history) {
         lookup = word;
     }
     const int n = lookup->n();
-    PatternMap<double>::iterator iter = ngrams.find(*lookup);
+    double logprob;
          
-    if (iter != ngrams.end()) {
-        if (DEBUG) cerr << "\t\t\tLM DEBUG: scoreword(): Found " << n << "-gram, score=" << iter->second << endl;
+    if (findngram(lookup, logprob)) {
+        if (DEBUG) cerr << "\t\t\tLM DEBUG: scoreword(): Found " << n << "-gram, score=" << logprob << endl;
         if (history != NULL) delete lookup;        
-        return iter->second;        
+        return logprob;        
     } else {
         if (DEBUG) cerr << "\t\t\tLM DEBUG: scoreword(): " << n << "-gram not found. Backing off..." << endl;        
     }
@@ -202,10 +345,8 @@ double LanguageModel::scoreword(const Pattern * word, const Pattern * history) {
         } else {
             newhistory = NULL;
         }
-        PatternMap<double>::iterator iter = backoff.find(*history);
-        if (iter != backoff.end()) {
-            if (DEBUG) cerr << "\t\t\tLM DEBUG: backoffpart=" << iter->first.tostring(*classdecoder) << " = " << iter->second << endl;
-            backoffweight = iter->second;        
+        if (findbackoff(history, backoffweight)) {
+            if (DEBUG) cerr << "\t\t\tLM DEBUG: backoffpart=" << history->tostring(*classdecoder) << " = " << backoffweight << endl;
         }
         //if (DEBUG) cerr << "LM DEBUG: scoreword(): Backoffpart=" << backoffpart->decode(*classdecoder) << endl;
               
@@ -2,10 +2,24 @@
 
 import sys
 import os
+import math
 import unittest
 import colibricore
 import glob
-from colibrimt.alignmentmodel import AlignmentModel
+import gzip
+from colibrimt.alignmentmodel import AlignmentModel, fishersignificance
+from colibrimt.evaluation import sentencestats, pairedbootstrap, bleu, ter
+from colibrimt.lm import convertarpa, BinaryLanguageModel
+from colibrimt.ib1 import IB1Classifier
+from colibrimt.oracle import analyse, worthtraining
+from colibrimt.checkpoint import Checkpoint, filekey, syncedsize, truncate
+from colibrimt.spill import SpillBuffer
+from colibrimt.keywordstore import KeywordStore, bitset
+from colibrimt.bloomfilter import BloomFilter, rejectline
+from colibrimt.scorestore import ScoreStore
+from colibrimt.cache import ArtifactCache
+from colibrimt.pipeline import Pipeline, Stage, DEFAULTS, sweep
+import colibrimt.native
 
 class TestExperiment(unittest.TestCase):
     def test001_alignmodel(self):
@@ -79,6 +93,342 @@ class TestExperiment(unittest.TestCase):
         """Running contextmoses on monolithic system"""
         r = os.system("contextmoses -M ")
 
+    def test009_bootstrap(self):
+        """Paired bootstrap resampling on sentence statistics"""
+        refs = [ "the bank is closed".split(), "he sits on the bank".split() ] * 10
+        base = [ "the couch is closed".split(), "he sits on the couch".split() ] * 10
+        stats = sentencestats(refs, refs)
+        self.assertEqual( bleu(stats.sum(axis=0))[0], 1.0 )
+        self.assertEqual( ter(stats.sum(axis=0))[0], 0.0 )
+        results = pairedbootstrap(sentencestats(base, refs), stats, 200)
+        self.assertTrue( results['BLEU']['delta'] > 0 )
+        self.assertTrue( results['TER']['delta'] < 0 )
+        self.assertEqual( results['BLEU']['p'], 0.0 )
+
+    def test010_binarylm(self):
+        """Converting an ARPA language model to the binary format and querying it"""
+        with open("test-en-nl/test.arpa",'w',encoding='utf-8') as f:
+            f.write("\\data\\\nngram 1=5\nngram 2=3\n\n\\1-grams:\n-1.0\t<unk>\t0\n-99\t<s>\t-0.5\n-0.7\t</s>\n-0.6\tbank\t-0.3\n-0.8\toever\t-0.2\n\n\\2-grams:\n-0.2\t<s> bank\n-0.3\tbank oever\n-0.4\toever </s>\n\n\\end\\\n")
+        convertarpa("test-en-nl/test.arpa", "test-en-nl/test.colibri.lm")
+        lm = BinaryLanguageModel("test-en-nl/test.colibri.lm")
+        self.assertEqual( len(lm), 8 )
+        self.assertEqual( lm.order, 2 )
+        self.assertAlmostEqual( lm.scoresentence("bank oever"), (-0.2-0.3-0.4) * math.log(10), places=4 )
+        self.assertAlmostEqual( lm.scoresentence("oever bank"), (-0.5-0.8-0.2-0.6-0.3-0.7) * math.log(10), places=4 )
+        self.assertAlmostEqual( lm.scoreword("zee"), -1.0 * math.log(10), places=4 )
+
+    def test011_ib1(self):
+        """Training and batch classification with the numpy IB1 backend"""
+        with open("test-en-nl/ib1.train",'w',encoding='utf-8') as f:
+            f.write("the\tbank\tclosed\tbank\nthe\tbank\triver\toever\nsits\tbank\triver\toever\nthe\tbank\tmoney\tbank\n")
+        classifier = IB1Classifier("test-en-nl/ib1", "-a 0 -k 1 -w gr -m O -d Z")
+        classifier.train()
+        classifier.save()
+        classifier = IB1Classifier("test-en-nl/ib1", "-a 0 -k 1 -w gr -m O -d Z")
+        results = classifier.classifybatch([ ["the","bank","closed"], ["on","bank","river"] ])
+        self.assertEqual( results[0], ("bank", {"bank": 1.0}, 0.0) )
+        self.assertEqual( results[1][0], "oever" )
+        self.assertEqual( classifier.classify(["on","bank","river"]), results[1] )
+
+    def test012_keywords(self):
+        """Keyword store and sparse keyword bitsets with the numpy IB1 backend"""
+        store = KeywordStore("test-en-nl/keywords.store", 'w')
+        store.add("bank", [ ("river","oever",3,0.5), ("money","bank",4,0.25) ])
+        store.add("couch", [ ("sits","bank",3,0.1) ])
+        store.close()
+        store = KeywordStore("test-en-nl/keywords.store")
+        self.assertEqual( store.keywords("bank"), ("river","money") )
+        self.assertEqual( store.get("couch"), [ ("sits","bank",3,0.1) ] )
+        self.assertFalse( "the bank" in store )
+        self.assertEqual( bitset(store.keywords("bank"), "he walks along the river".split()), 1 )
+        with open("test-en-nl/kw.train",'w',encoding='utf-8') as f:
+            f.write("the\tbank\tkw:1\toever\nthe\tbank\tkw:1\toever\nthe\tbank\tkw:2\tbank\nthe\tbank\tkw:0\tbank\n")
+        classifier = IB1Classifier("test-en-nl/kw", "-a 0 -k 1 -w gr -m O -d Z")
+        classifier.train()
+        self.assertEqual( classifier.classify(["the","bank","kw:1"])[0], "oever" )
+        self.assertEqual( classifier.classify(["the","bank","kw:6"])[0], "bank" )
+
+    def test013_bloomfilter(self):
+        """Bloom filter membership, false positive rate and the raw-line phrase-table prefilter"""
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add("phrase " + str(i))
+        self.assertEqual( len(bloom), 1000 )
+        self.assertTrue( all( "phrase " + str(i) in bloom for i in range(1000) ) ) #no false negatives
+        falsepositives = sum( 1 for i in range(10000) if "other " + str(i) in bloom )
+        self.assertTrue( falsepositives < 300 ) #1% expected
+        source = BloomFilter(10)
+        source.add("the bank")
+        target = BloomFilter(10)
+        target.add("de oever")
+        self.assertFalse( rejectline("the bank ||| de oever ||| 0.5 0.5 1 1\n", "|||", source, target) )
+        self.assertTrue( rejectline("the couch ||| de oever ||| 0.5 0.5 1 1\n", "|||", source, target) )
+        self.assertTrue( rejectline("the bank ||| de bank ||| 0.5 0.5 1 1\n", "|||", source, target) )
+        self.assertFalse( rejectline("the bank ||| de bank ||| 0.5 0.5 1 1\n", "|||", source, None) )
+        self.assertFalse( rejectline("invalid line\n", "|||", source, target) )
+
+    def test014_pruning(self):
+        """Significance and top-k pruning when loading a phrase table"""
+        self.assertAlmostEqual( fishersignificance(1, 1, 1, 100), math.log(100), places=6 ) #p = 1/n
+        self.assertAlmostEqual( fishersignificance(0, 5, 5, 100), 0.0, places=9 ) #p = 1
+        self.assertTrue( fishersignificance(10, 10, 10, 1000) > fishersignificance(5, 10, 10, 1000) )
+        s = colibricore.ClassEncoder("test-en-nl/test-en-train.colibri.cls")
+        t = colibricore.ClassEncoder("test-en-nl/test-nl-train.colibri.cls")
+        model = AlignmentModel()
+        model.loadmosesphrasetable("test-en-nl.phrasetable", s, t, quiet=True, native=False, topk=1)
+        #only the best option by p(t|s) survives, ties go to the first in the file
+        self.assertTrue( (s.buildpattern('bank'), t.buildpattern('oever')) in model )
+        self.assertFalse( (s.buildpattern('bank'), t.buildpattern('bank')) in model )
+        self.assertFalse( (s.buildpattern('bank'), t.buildpattern('sturen')) in model )
+        self.assertTrue( (s.buildpattern('the bank'), t.buildpattern('de oever')) in model )
+        self.assertFalse( (s.buildpattern('the bank'), t.buildpattern('de bank')) in model )
+        self.assertEqual( len(list(model.triples())), 12 )
+        #ties at position k: of equally scored options the earliest in the file are kept
+        with open("test-en-nl/ties.phrasetable",'w',encoding='utf-8') as f:
+            f.write("bank ||| oever ||| 0.5 0.5 1 1\nbank ||| bank ||| 0.5 0.5 2 1\nbank ||| sturen ||| 0.5 0.5 1 1\n")
+            f.write("the bank ||| de oever ||| 0.5 0.5 1 1\nthe bank ||| de bank ||| 0.5 0.5 1 1\nthe bank ||| een ||| 0.5 0.5 2 1\n")
+        model = AlignmentModel()
+        model.loadmosesphrasetable("test-en-nl/ties.phrasetable", s, t, quiet=True, native=False, topk=2)
+        self.assertTrue( (s.buildpattern('bank'), t.buildpattern('oever')) in model )
+        self.assertTrue( (s.buildpattern('bank'), t.buildpattern('bank')) in model )
+        self.assertFalse( (s.buildpattern('bank'), t.buildpattern('sturen')) in model )
+        self.assertTrue( (s.buildpattern('the bank'), t.buildpattern('de oever')) in model )
+        self.assertFalse( (s.buildpattern('the bank'), t.buildpattern('de bank')) in model )
+        self.assertTrue( (s.buildpattern('the bank'), t.buildpattern('een')) in model )
+
+    def test015_scorestore(self):
+        """Compact score storage: small probabilities survive freezing, rows are reused, saving and loading"""
+        for mode in ('float16','uint8'):
+            store = ScoreStore(mode, capacity=2)
+            for i in range(300):
+                store.append([ 10 ** -(1 + i % 9), 0.5, 2.718, [(0,0),(1,i % 256)] ])
+            store.freeze()
+            self.assertEqual( len(store), 300 )
+            self.assertTrue( abs(store[7][0] - 1e-8) / 1e-8 < 0.05 ) #probability column, stored in the log domain
+            self.assertAlmostEqual( store[7][2], 2.718, places=2 ) #not a probability column
+            self.assertEqual( store[7][3], [(0,0),(1,7)] )
+            row = store.append([ 1e-5, 0.5, 2.718, [(2,2)] ])
+            self.assertTrue( abs(store[row][0] - 1e-5) / 1e-5 < 0.05 )
+            store.save("test-en-nl/scores." + mode)
+            loaded = ScoreStore.load("test-en-nl/scores." + mode)
+            self.assertEqual( loaded.mode, mode )
+            self.assertEqual( loaded[row], store[row] )
+            self.assertEqual( loaded[7], store[7] )
+        model = AlignmentModel(compact='uint8')
+        model.add("the bank", "de oever", [0.5, 0.5, 2.718])
+        model.add("the bank", "de oever", [0.25, 0.5, 2.718])
+        self.assertEqual( len(model.scores), 1 ) #the existing row is overwritten
+        self.assertEqual( model[("the bank","de oever")][0], 0.25 )
+
+    def test016_savephrasetable(self):
+        """Phrase-table export: chunked, parallel and gzipped output equals the plain serial output, sorted by source"""
+        s = colibricore.ClassEncoder("test-en-nl/test-en-train.colibri.cls")
+        t = colibricore.ClassEncoder("test-en-nl/test-nl-train.colibri.cls")
+        sdec = colibricore.ClassDecoder("test-en-nl/test-en-train.colibri.cls")
+        tdec = colibricore.ClassDecoder("test-en-nl/test-nl-train.colibri.cls")
+        model = AlignmentModel()
+        for source, target in (('only','maar'),('bank','oever'),('the bank','de oever'),('a','een'),('couch','bank'),('bank','bank'),('just','maar')):
+            model.add(s.buildpattern(source), t.buildpattern(target), [0.5, 0.25, 0.5, 0.25])
+        model.savemosesphrasetable("test-en-nl/export.phrasetable", sdec, tdec, processes=1, chunksize=100)
+        with open("test-en-nl/export.phrasetable",'rb') as f:
+            plain = f.read()
+        lines = plain.decode('utf-8').splitlines()
+        self.assertEqual( len(lines), 7 )
+        sources = [ line.split(" ||| ")[0] for line in lines ]
+        self.assertEqual( sources, sorted(sources) )
+        self.assertEqual( model.savemosesphrasetable("test-en-nl/export.phrasetable.gz", sdec, tdec, processes=3, chunksize=2, compresslevel=1), 7 )
+        with gzip.open("test-en-nl/export.phrasetable.gz",'rb') as f: #concatenated gzip members
+            self.assertEqual( f.read(), plain )
+
+    def test017_cache(self):
+        """Artifact cache: up-to-date outputs are skipped, removed outputs restored, changed inputs or parameters rerun"""
+        with open("test-en-nl/cache.in",'w') as f:
+            f.write("a\n")
+        cache = ArtifactCache("test-en-nl/cache", 10 ** 9)
+        cache.evict(0)
+        runs = []
+        def stage():
+            runs.append(1)
+            with open("test-en-nl/cache.in") as fin, open("test-en-nl/cache.out",'w') as fout:
+                fout.write(fin.read().upper())
+            return True
+        self.assertEqual( cache.run("upper", ["test-en-nl/cache.out"], stage, ["test-en-nl/cache.in"], {'x': 1}), True )
+        self.assertEqual( cache.run("upper", ["test-en-nl/cache.out"], stage, ["test-en-nl/cache.in"], {'x': 1}), 'uptodate' )
+        os.unlink("test-en-nl/cache.out")
+        self.assertEqual( cache.run("upper", ["test-en-nl/cache.out"], stage, ["test-en-nl/cache.in"], {'x': 1}), 'cached' )
+        with open("test-en-nl/cache.out") as f:
+            self.assertEqual( f.read(), "A\n" )
+        self.assertEqual( len(runs), 1 )
+        self.assertEqual( cache.run("upper", ["test-en-nl/cache.out"], stage, ["test-en-nl/cache.in"], {'x': 2}), True )
+        with open("test-en-nl/cache.in",'w') as f:
+            f.write("b\n")
+        self.assertEqual( cache.run("upper", ["test-en-nl/cache.out"], stage, ["test-en-nl/cache.in"], {'x': 2}), True )
+        self.assertEqual( len(runs), 3 )
+        self.assertEqual( len(cache.entries()), 3 )
+        self.assertEqual( cache.evict(0), 3 )
+        self.assertEqual( cache.size(), 0 )
+        #a directory output whose subdirectories are the outputs of later stages: these are not stored, nor removed on restore
+        os.system("rm -Rf test-en-nl/cache.dir")
+        def dirstage():
+            os.makedirs("test-en-nl/cache.dir/classifiers-1", exist_ok=True)
+            with open("test-en-nl/cache.dir/x.train",'w') as f:
+                f.write("x\n")
+            with open("test-en-nl/cache.dir/classifiers-1/trained",'w') as f:
+                f.write("")
+            return True
+        self.assertEqual( cache.run("features", ["test-en-nl/cache.dir"], dirstage, ["test-en-nl/cache.in"], exclude=["classifiers-*"]), True )
+        self.assertFalse( os.path.exists(os.path.join(cache.entries()[0][2], "0", "classifiers-1")) )
+        os.makedirs("test-en-nl/cache.dir/classifiers-2")
+        os.unlink("test-en-nl/cache.dir/x.train")
+        with open("test-en-nl/cache.dir/stale.train",'w') as f:
+            f.write("")
+        os.unlink("test-en-nl/.cache.dir.cachekey")
+        self.assertEqual( cache.run("features", ["test-en-nl/cache.dir"], dirstage, ["test-en-nl/cache.in"], exclude=["classifiers-*"]), 'cached' )
+        self.assertEqual( sorted(os.listdir("test-en-nl/cache.dir")), ["classifiers-1", "classifiers-2", "x.train"] )
+        self.assertTrue( os.path.exists("test-en-nl/cache.dir/classifiers-1/trained") )
+        cache.evict(0)
+
+
+    def test018_pipeline(self):
+        """Pipeline scheduling: dependencies, the core budget, halting after a stage group and failures"""
+        os.system("rm -Rf test-en-nl/pipeline")
+        os.makedirs("test-en-nl/pipeline")
+        p = Pipeline("test-en-nl/pipeline", cache=False)
+        p.add(Stage('a', "sleep 0.2 && echo a > a.txt", 'buildphrasetable', outputs=["a.txt"], cores=2))
+        p.add(Stage('b', "sleep 0.2 && echo b > b.txt", 'buildphrasetable', outputs=["b.txt"], cores=2))
+        p.add(Stage('c', "cat a.txt b.txt > c.txt", 'patternmodels', outputs=["c.txt"], deps=['a','b']))
+        p.add(Stage('d', "cp c.txt d.txt", 'decoder', outputs=["d.txt"], deps=['c']))
+        self.assertRaises( KeyError, p.add, Stage('e', "true", 'decoder', deps=['unknown']) )
+        self.assertEqual( p.select('patternmodels'), {'a','b','c'} )
+        self.assertTrue( p.run('patternmodels', cores=2) )
+        self.assertTrue( p['b'].begintime >= p['a'].endtime or p['a'].begintime >= p['b'].endtime ) #both need the entire budget
+        self.assertTrue( p['c'].begintime >= max(p['a'].endtime, p['b'].endtime) )
+        self.assertIsNone( p['d'].status )
+        with open("test-en-nl/pipeline/c.txt") as f:
+            self.assertEqual( f.read(), "a\nb\n" )
+        self.assertTrue( p.run('evaluation', cores=2) )
+        self.assertEqual( [ p[x].status for x in 'abcd' ], ['uptodate','uptodate','uptodate','done'] )
+        p = Pipeline("test-en-nl/pipeline", cache=False)
+        p.add(Stage('fail', "false", 'buildphrasetable', outputs=["never.txt"]))
+        p.add(Stage('after', "touch after.txt", 'patternmodels', outputs=["after.txt"], deps=['fail']))
+        self.assertFalse( p.run() )
+        self.assertEqual( p['fail'].status, 'failed' )
+        self.assertIsNone( p['after'].status )
+
+
+    def test019_sweep(self):
+        """Parameter sweeps: stages independent of the swept Timbl parameters are shared, the others get their own directories"""
+        config = dict(DEFAULTS)
+        config.update({'NAME': 'sweep', 'TRAINSOURCE': 'train-en', 'TRAINTARGET': 'train-nl', 'TESTSOURCE': 'test-en', 'TESTTARGET': 'test-nl', 'SOURCELANG': 'en', 'TARGETLANG': 'nl', 'TWEIGHTS': ['1','1','1','1']})
+        pipeline, points = sweep(config, "test-en-nl/sweep", [ ('TIMBL_K', ['1','3']), ('TIMBL_W', ['gr','nw']) ], cache=False)
+        self.assertEqual( len(points), 4 )
+        for stagename in ('lm','alignmodel','extractfeatures','trainclassifiers'):
+            self.assertEqual( len(set( names[stagename] for _, names in points )), 1 )
+        decodestages = [ pipeline[names['decodetest']] for _, names in points ]
+        self.assertEqual( len(set( stage.name for stage in decodestages )), 4 )
+        self.assertEqual( len(set( stage.outputs[0] for stage in decodestages )), 4 )
+        self.assertTrue( decodestages[0].outputs[0].split("/")[2].endswith("-P0") ) #defaults keep the plain directory name
+        self.assertTrue( decodestages[3].outputs[0].split("/")[2].endswith("-tk3-twnw") )
+        self.assertEqual( pipeline[points[3][1]['evaluate']].deps, [ points[3][1]['decodetest'] ] )
+        #stages writing the same output with different commands can not be merged
+        other = Pipeline("test-en-nl/sweep", cache=False)
+        other.add(Stage('lm', "true", 'buildphrasetable', outputs=["nl.lm"]))
+        self.assertRaises( ValueError, pipeline.merge, other, "X=1" )
+
+
+    def test020_oracle(self):
+        """Expert oracle: sampled leave-one-out and the decision whether an expert is worth training"""
+        with open("test-en-nl/oracle.train",'w',encoding='utf-8') as f:
+            for i in range(3000):
+                f.write("the\tbank\t" + ("river" if i % 3 == 0 else "money") + str(i % 7) + "\t" + ("oever" if i % 3 == 0 else "bank") + "\n")
+        classifier = IB1Classifier("test-en-nl/oracle", "-k 1")
+        classifier.train()
+        self.assertEqual( len(classifier.leaveoneout(200)), 200 )
+        self.assertEqual( classifier.leaveoneout(200), classifier.leaveoneout(200) ) #the sample is deterministic
+        stats = analyse("test-en-nl/oracle", "bank", maxinstances=200)
+        self.assertEqual( stats['instances'], 3000 )
+        self.assertAlmostEqual( stats['majority'], 2/3, places=3 )
+        self.assertAlmostEqual( stats['agreement'], 2/3, delta=0.1 ) #the context predicts oever
+        self.assertTrue( worthtraining(stats) )
+        self.assertFalse( worthtraining(stats, maxmajority=0.6) ) #dominant and confirmed by leave-one-out
+        self.assertTrue( worthtraining({'classes': 2, 'majority': 0.97, 'agreement': 0.5}, maxmajority=0.95) ) #dominant, but the context matters
+        self.assertFalse( worthtraining({'classes': 2, 'majority': 0.97, 'agreement': 0.97}, maxmajority=0.95) )
+        self.assertFalse( worthtraining({'classes': 2, 'majority': 0.5, 'agreement': 1.0}) )
+        self.assertFalse( worthtraining({'classes': 1, 'majority': 1.0, 'agreement': 0.0}) )
+
+
+    def test021_checkpoint(self):
+        """Checkpoints: resuming trusts the journal only up to the last checkpoint, outputs are truncated to their recorded size"""
+        with open("test-en-nl/ckpt.in",'w') as f:
+            f.write("input\n")
+        key = (filekey("test-en-nl/ckpt.in"), 1)
+        checkpoint = Checkpoint("test-en-nl/ckpt", key, 0)
+        self.assertIsNone( checkpoint.resume() )
+        checkpoint.start()
+        output = open("test-en-nl/ckpt.out",'w')
+        output.write("a\nb\n")
+        checkpoint.log("a")
+        checkpoint.log("b")
+        self.assertTrue( checkpoint.due() )
+        checkpoint.save({'output': syncedsize(output)})
+        output.write("c\n") #lost: the job is killed before the next checkpoint
+        checkpoint.log("c")
+        output.close()
+        checkpoint.journal.close()
+        checkpoint = Checkpoint("test-en-nl/ckpt", key, 0)
+        state, entries = checkpoint.resume()
+        self.assertEqual( entries, ["a","b"] )
+        truncate("test-en-nl/ckpt.out", state['output'])
+        with open("test-en-nl/ckpt.out") as f:
+            self.assertEqual( f.read(), "a\nb\n" )
+        checkpoint.start(resume=True)
+        checkpoint.log("c")
+        checkpoint.save(state)
+        checkpoint.journal.close()
+        self.assertEqual( Checkpoint("test-en-nl/ckpt", key, 0).resume()[1], ["a","b","c"] )
+        #a changed input invalidates the checkpoint
+        with open("test-en-nl/ckpt.in",'a') as f:
+            f.write("more input\n")
+        self.assertRaises( ValueError, Checkpoint("test-en-nl/ckpt", (filekey("test-en-nl/ckpt.in"), 1), 0).resume )
+        checkpoint.remove()
+        self.assertFalse( os.path.exists("test-en-nl/ckpt") or os.path.exists("test-en-nl/ckpt.journal") )
+
+
+    def test022_spill(self):
+        """Spill buffer merge, and out-of-core occurrence grouping yielding the same as in-memory grouping"""
+        records = [ (i * 7919 % 1000, "x" + str(i)) for i in range(1000) ]
+        with SpillBuffer(2000, "test-en-nl") as buffer:
+            for record in records:
+                buffer.append(record)
+            self.assertEqual( len(buffer), 1000 )
+            self.assertTrue( len(buffer.runs) > 1 )
+            runs = list(buffer.runs)
+            self.assertEqual( list(buffer), sorted(records) )
+        self.assertFalse( any( os.path.exists(run) for run in runs ) )
+        options = colibricore.PatternModelOptions(mintokens=1,doreverseindex=False)
+        sdec = colibricore.ClassDecoder("test-en-nl/test-en-train.colibri.cls")
+        sourcemodel = colibricore.IndexedPatternModel("test-en-nl/test-en-train.colibri.indexedpatternmodel", options)
+        targetmodel = colibricore.IndexedPatternModel("test-en-nl/test-nl-train.colibri.indexedpatternmodel", options)
+        model = AlignmentModel()
+        model.load("test-en-nl/test-en-nl.colibri.alignmodel",options)
+        inmemory = list(model.patternswithindexes(sourcemodel, targetmodel, sdec, showprogress=False))
+        external = list(model.patternswithindexes(sourcemodel, targetmodel, sdec, showprogress=False, maxmemory=500, tmpdir="test-en-nl"))
+        self.assertTrue( inmemory )
+        self.assertEqual( external, inmemory )
+
+    def test023_nativestats(self):
+        """Parsing the counts reported by the native phrase-table converter, the progress dots precede them on the same line"""
+        with open("test-en-nl/fakeconverter",'w') as f:
+            f.write("#!/bin/sh\nprintf '....:.Read 5300 lines\\nAdded: 4000 -- skipped due to threshold: 1000 -- skipped by constraint: 300\\n' >&2\n")
+        os.chmod("test-en-nl/fakeconverter", 0o755)
+        executable = colibrimt.native.EXEC_MOSESPHRASETABLE2ALIGNMODEL
+        colibrimt.native.EXEC_MOSESPHRASETABLE2ALIGNMODEL = "test-en-nl/fakeconverter"
+        try:
+            stats = colibrimt.native.mosesphrasetable2alignmodel("test-en-nl.phrasetable", "test-en-nl/fake.colibri.alignmodel", "s.cls", "t.cls", quiet=True)
+        finally:
+            colibrimt.native.EXEC_MOSESPHRASETABLE2ALIGNMODEL = executable
+        self.assertEqual( stats, {'lines': 5300, 'added': 4000, 'skipped': 1000, 'constrained': 300} )
+
 
 
 
@@ -97,4 +447,3 @@ if __name__ == '__main__':
         r = os.system("./exp-test.sh")
 
         unittest.main()
-